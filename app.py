@@ -4,18 +4,41 @@ import io
 import re
 import json
 import time
+import hashlib
 from typing import List, Dict, Optional, Tuple
+from dataclasses import astuple
 import streamlit as st
 
 from pcs_tables_engine import TablesEngine, TablesTrie
 from pcs_index import PCSIndex
 from suggest_from_index import suggest_from_index
 from pcs_definitions import PCSDefinitions
+from pcs_keys import KeyMaps
+from pcs_sqlite import compile_db, open_store
+from engine_warmup import Job, Warmup
+from note_cache import LRUCache, NoteCache, fingerprint
+from search_cache import SearchCache
+from pcs_scoring import Weights
 from gemini_client import GeminiHelper
 from utils_ingest import extract_text_from_upload
 
 st.set_page_config(page_title="ICD-10-PCS Coder (2025)", layout="wide")
 
+TOPK_HITS = 60      # Index hits kept per query
+weights = Weights()  # pcs_scoring feature weights for auto-suggest
+
+# The only directory the sidebar may read stores from or compile them into
+STORE_DIR = os.getenv("PCS_STORE_DIR") or (os.path.dirname(os.path.abspath(os.environ["PCS_SQLITE_DB"]))
+                                           if os.getenv("PCS_SQLITE_DB") else "")
+STORE_NAME_RE = re.compile(r"[A-Za-z0-9_-][A-Za-z0-9_.-]*\.db")
+
+def store_file(name: str) -> Optional[str]:
+    # Plain file names only: no separators or "..", so typed input can't reach files outside STORE_DIR
+    name = (name or "").strip()
+    if not STORE_DIR or not STORE_NAME_RE.fullmatch(name) or ".." in name:
+        return None
+    return os.path.join(STORE_DIR, name)
+
 st.title("ICD-10-PCS Coder (2025)")
 st.caption("Upload official XMLs in the sidebar, then analyze procedure notes and validate PCS codes.")
 
@@ -25,6 +48,19 @@ with st.sidebar:
     index_xml = st.file_uploader("icd10pcs_index_2025.xml", type=["xml"])
     defs_xml = st.file_uploader("icd10pcs_definitions_2025.xml", type=["xml"])
 
+    with st.expander("Low-memory mode (SQLite store)"):
+        store_name = st.text_input("Store file", value=os.path.basename(os.getenv("PCS_SQLITE_DB", "")),
+                                   help="A file name inside PCS_STORE_DIR (default: the directory of PCS_SQLITE_DB). "
+                                        "Compiled with `python pcs_sqlite.py compile` or the button below.")
+        store_path = store_file(store_name)
+        if store_name and not store_path:
+            st.warning("Stores are limited to a plain *.db file name inside PCS_STORE_DIR.")
+        use_store = st.toggle("Query the store instead of loading XMLs", value=bool(os.getenv("PCS_SQLITE_DB")))
+        if st.button("Compile store from uploaded XMLs", disabled=not (store_path and (tables_xml or index_xml or defs_xml))):
+            with st.spinner("Compiling store..."):
+                compile_db(store_path, *(f.getvalue() if f else None for f in (tables_xml, index_xml, defs_xml)))
+            st.success(f"Wrote {store_path}.")
+
     st.markdown("---")
     st.header("Optional Knowledge")
     bp_key = st.file_uploader("Body Part Key.md", type=["md"], key="bpkey")
@@ -32,6 +68,9 @@ with st.sidebar:
     dev_key = st.file_uploader("Device Key.md", type=["md"], key="devkey")
     sub_key = st.file_uploader("Substance Key.md", type=["md"], key="subkey")
 
+    retriever = st.radio("Index matching", ["fuzzy", "tfidf"], horizontal=True,
+                         help="fuzzy: rapidfuzz token-set ratio. tfidf: sparse word + character n-gram TF-IDF (faster on long notes).")
+
     proc_checklist_files = st.file_uploader("Procedure Checklist (.md, multiple)", type=["md"], accept_multiple_files=True)
 
     st.markdown("---")
@@ -39,36 +78,132 @@ with st.sidebar:
     model_name = st.text_input("Model", value="gemini-2.0-flash", help="Adjust if your account uses a different name.")
     use_llm = st.toggle("Use Gemini to propose codes", value=False)
     temperature = st.slider("Temperature", 0.0, 1.0, 0.2, 0.05)
+    prompt_budget = st.number_input("Prompt token budget", min_value=200, max_value=8000, value=1200, step=100,
+                                    help="Estimated tokens; the most relevant note sentences are kept within it.")
 
     st.caption("Set GEMINI_API_KEY in Streamlit Secrets. App still works without the LLM.")
 
-@st.cache_resource(show_spinner=True)
-def build_tables_engine(xml_bytes: bytes) -> TablesEngine:
-    return TablesEngine.from_bytes(xml_bytes)
+@st.cache_resource(show_spinner=False)
+def get_warmup() -> Warmup:
+    # Process-wide background builds keyed by XML digest, shared by all sessions
+    return Warmup(max_workers=3)
 
-@st.cache_resource(show_spinner=True)
-def load_index(xml_bytes: Optional[bytes]) -> Optional[PCSIndex]:
-    if not xml_bytes:
-        return None
-    return PCSIndex.from_bytes(xml_bytes)
+@st.cache_resource(show_spinner=False)
+def get_search_cache() -> SearchCache:
+    # Process-wide phrase-search memo; set PCS_SEARCH_CACHE to a file path to persist it
+    return SearchCache(maxsize=8192, path=os.getenv("PCS_SEARCH_CACHE") or None)
+
+@st.cache_resource(show_spinner=False)
+def load_store(path: str, mtime: float):
+    # mtime keys the cache so a recompiled store is reopened
+    return open_store(path, pool_size=8, cache=get_search_cache())
+
+@st.cache_resource(show_spinner=False)
+def get_note_cache(tables_digest: str, index_digest: str, retriever: str, keys_digest: str, weights: tuple,
+                   topk_hits: int) -> NoteCache:
+    # One process-wide cache per setting that changes the scores (Tables/Index, retriever, key files,
+    # weights, hits per query), shared by all sessions
+    return NoteCache(maxsize=512)
+
+@st.cache_resource(show_spinner=False)
+def get_llm_cache() -> LRUCache:
+    # Gemini proposals (codes, prompt stats) per (note fingerprint, model, temperature, budget)
+    return LRUCache(maxsize=256)
 
-@st.cache_resource(show_spinner=True)
-def load_definitions(xml_bytes: Optional[bytes]) -> Optional[PCSDefinitions]:
-    if not xml_bytes:
+@st.cache_resource(show_spinner=False)
+def compile_key_maps(_engine: TablesEngine, tables_digest: str, bp: Optional[bytes], dev_agg: Optional[bytes],
+                     dev: Optional[bytes], sub: Optional[bytes]) -> KeyMaps:
+    # tables_digest only keys the cache; the engine itself is unhashable
+    return KeyMaps.compile(_engine, {"body_part": bp, "device_agg": dev_agg, "device": dev, "substance": sub})
+
+# Engines are built in the background as soon as their XML is uploaded; the script
+# only blocks on one (need()) where validation or suggestion actually uses it.
+loaded: Dict[str, object] = {}  # ready engines ("tables" / "index" / "definitions")
+jobs: Dict[str, Job] = {}       # background builds of the same
+tables_digest = index_digest = ""
+if use_store and store_path and os.path.exists(store_path):
+    engine, pcs_index, pcs_defs = load_store(store_path, os.path.getmtime(store_path))
+    loaded = {k: v for k, v in (("tables", engine), ("index", pcs_index), ("definitions", pcs_defs)) if v is not None}
+    meta = (engine or pcs_index or pcs_defs).db.meta
+    tables_digest, index_digest = meta.get("tables", ""), meta.get("index", "")
+    st.success(f"Using SQLite store {store_path} ({meta.get('codes', 0)} codes, {meta.get('entries', 0)} Index entries).")
+else:
+    if use_store:
+        st.sidebar.warning("Store file not found; loading the uploaded XMLs instead.")
+    warmup = get_warmup()
+    if tables_xml:
+        tables_bytes = tables_xml.getvalue()
+        tables_digest = hashlib.sha1(tables_bytes).hexdigest()
+        jobs["tables"] = warmup.start("tables", tables_digest,
+                                      lambda report, b=tables_bytes: TablesEngine.from_bytes(b, progress=report))
+    if index_xml:
+        index_bytes = index_xml.getvalue()
+        index_digest = hashlib.sha1(index_bytes).hexdigest()
+        search_cache = get_search_cache()  # st.cache_resource must be called from the script thread
+        jobs["index"] = warmup.start("index", index_digest,
+                                     lambda report, b=index_bytes: PCSIndex.from_bytes(b, cache=search_cache))
+    if defs_xml:
+        defs_bytes = defs_xml.getvalue()
+        jobs["definitions"] = warmup.start("definitions", hashlib.sha1(defs_bytes).hexdigest(),
+                                           lambda report, b=defs_bytes: PCSDefinitions.from_bytes(b))
+
+def has(name: str) -> bool:
+    return name in loaded or name in jobs
+
+def ready(name: str):
+    # The engine if it is available now, else None (never blocks)
+    job = jobs.get(name)
+    return loaded.get(name) or (job.result() if job and job.done() and not job.failed() else None)
+
+def need(name: str):
+    # Wait for a background build; only called where the engine is actually used
+    job = jobs.get(name)
+    if name in loaded or job is None:
+        return loaded.get(name)
+    if not job.done():
+        with st.spinner(f"Waiting for {job.describe()}..."):
+            job.future.exception()
+    if job.failed():
+        st.error(job.describe())
         return None
-    return PCSDefinitions.from_bytes(xml_bytes)
-
-engine = None
-pcs_index = None
-pcs_defs = None
-if tables_xml:
-    with st.spinner("Building Tables trie (first load may take ~30–90s)..."):
-        engine = build_tables_engine(tables_xml.read())
-        st.success(f"Loaded {engine.stats()['nodes']} trie nodes from Tables.")
-if index_xml:
-    pcs_index = load_index(index_xml.read())
-if defs_xml:
-    pcs_defs = load_definitions(defs_xml.read())
+    return job.result()
+
+def get_key_maps(engine: TablesEngine) -> KeyMaps:
+    return compile_key_maps(engine, tables_digest, *(f.getvalue() if f else None for f in (bp_key, dev_agg, dev_key, sub_key)))
+
+def show_job_status():
+    for job in jobs.values():
+        st.caption(("✅ " if job.done() and not job.failed() else "⏳ ") + job.describe())
+
+building = [job for job in jobs.values() if not job.done()]
+if building:
+    # Poll only while something is still building; the rerun it triggers renders the static captions below
+    # Older Streamlit has neither: fall back to a one-shot render and let the user rerun
+    _fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda **_: lambda f: f)
+
+    @_fragment(run_every=1.0)
+    def show_build_status():
+        show_job_status()
+        if any(job.done() for job in building):
+            st.rerun()  # a build finished: rerun the page so the explorer/lookups appear
+
+    with st.sidebar:
+        show_build_status()
+elif jobs:
+    with st.sidebar:
+        show_job_status()
+
+note_cache = None
+llm_cache = get_llm_cache()
+if has("tables") and has("index"):
+    keys_digest = hashlib.sha1(b"\0".join(f.getvalue() if f else b"" for f in (bp_key, dev_agg, dev_key, sub_key))).hexdigest()
+    note_cache = get_note_cache(tables_digest, index_digest, retriever, keys_digest, astuple(weights), TOPK_HITS)
+    with st.sidebar:
+        cs = note_cache.stats()
+        st.caption(f"Note cache: {cs['size']} notes · {cs['exact_hits']} exact / {cs['near_hits']} near-duplicate hits · "
+                   f"hit rate {cs['hit_rate']:.0%}")
+        ss = get_search_cache().stats()
+        st.caption(f"Search cache: {ss['size']} phrases · {ss['hits']} hits / {ss['misses']} misses · hit rate {ss['hit_rate']:.0%}")
 
 colA, colB = st.columns([3,2], gap="large")
 
@@ -100,19 +235,30 @@ with colA:
     llm_codes = []
 
     auto_codes = []
-    if suggest_btn and note_text and engine and pcs_index:
+    if suggest_btn and note_text and has("tables") and has("index"):
+        engine, pcs_index = need("tables"), need("index")
         with st.spinner("Mining Index and expanding via Tables..."):
-            auto_codes = suggest_from_index(note_text, pcs_index, engine, topk_hits=60, max_codes=150)
+            auto_codes = suggest_from_index(note_text, pcs_index, engine, topk_hits=TOPK_HITS, max_codes=150,
+                                            keys=get_key_maps(engine), cache=note_cache,
+                                            retriever=retriever, weights=weights) if engine and pcs_index else []
         if not auto_codes:
             st.info("No legal codes could be generated from the Index search. Try adding more clinical detail.")
         else:
             st.success(f"Found {len(auto_codes)} candidate code(s) from Index.")
 
-    if use_llm and note_text and engine:
+    if use_llm and note_text and has("tables"):
         with st.spinner("Asking Gemini..."):
             helper = GeminiHelper.build_from_secrets(st.secrets, model_name=model_name, temperature=temperature)
+            helper.max_prompt_tokens = int(prompt_budget)
             if helper.available:
-                llm_codes = helper.propose_pcs_codes(note_text)
+                llm_key = (fingerprint(note_text), model_name, temperature, helper.max_prompt_tokens)
+                cached = llm_cache.get(llm_key)
+                if cached is None:
+                    cached = (helper.propose_pcs_codes(note_text), helper.last_prompt_stats)
+                    llm_cache.put(llm_key, cached)
+                llm_codes, prompt_stats = cached
+                st.caption(f"Gemini prompt: ~{prompt_stats.get('prompt_tokens', 0)} tokens "
+                           f"(budget {prompt_stats.get('budget', 0)}, {prompt_stats.get('sentences_dropped', 0)} sentence(s) left out)")
             else:
                 st.warning("Gemini not configured. Add GEMINI_API_KEY to Secrets.")
     unique = []
@@ -121,10 +267,11 @@ with colA:
             unique.append(c)
 
     st.header("4) Validation")
-    if not engine:
+    if not has("tables"):
         st.info("Load the Tables XML to enable strict validation.")
     else:
-        if unique:
+        engine = need("tables") if unique else None
+        if engine:
             rows = []
             for code in unique:
                 ok = engine.is_valid(code)
@@ -136,18 +283,25 @@ with colA:
 
 with colB:
     st.header("5) Explore the Tables")
+    engine = ready("tables")
     if engine:
         prefix = st.text_input("Expand from prefix (1–7 chars)", value="0")
         maxn = st.slider("Max expansions", 10, 500, 50, 10)
+        ac = engine.autocomplete(prefix, n=maxn)
+        if ac["next"]:
+            st.caption(f"{ac['count']} legal code(s) · next: " + ", ".join(f"{c}={label}" for c, label, _ in ac["next"]))
         if st.button("Expand"):
             with st.spinner("Walking trie..."):
                 expansions = engine.expand(prefix, limit=maxn)
             st.write(f"{len(expansions)} result(s):")
             st.code("\n".join(expansions[:maxn]))
+    elif has("tables"):
+        st.caption(f"Explorer opens when the Tables finish loading ({jobs['tables'].describe()}).")
     else:
         st.info("Load the Tables XML to explore expansions.")
 
     st.header("6) Lookups (Index / Definitions)")
+    pcs_index = ready("index")
     if pcs_index:
         term = st.text_input("Index search term", value="arthroplasty")
         if term:
@@ -157,18 +311,24 @@ with colB:
                     st.write(f"- **{m['path']}** → {m.get('codes','')} {m.get('code','')}")
             else:
                 st.caption("No hits in Index.")
+    elif has("index"):
+        st.caption(f"Index search opens when the Index finishes loading ({jobs['index'].describe()}).")
     else:
         st.caption("Upload the Index XML to enable this.")
 
-    if pcs_defs and engine:
+    if has("definitions") and has("tables"):
         code_for_def = st.text_input("Explain a code")
-        if code_for_def:
-            if engine.is_potential_prefix(code_for_def):
-                st.warning("That looks like a prefix. Enter a full 7-character code.")
-            elif engine.is_valid(code_for_def):
+        engine, pcs_defs = (need("tables"), need("definitions")) if code_for_def else (None, None)
+        if engine and pcs_defs:
+            if engine.is_valid(code_for_def):
                 st.write(pcs_defs.describe_code(code_for_def, engine))
+            elif engine.is_potential_prefix(code_for_def):
+                ac = engine.autocomplete(code_for_def, n=10)
+                st.warning(f"That looks like a prefix ({ac['count']} legal codes). Enter a full 7-character code.")
+                st.caption("Next allowed: " + ", ".join(f"{c}={label} ({n})" for c, label, n in ac["next"]))
+                st.code("\n".join(ac["completions"]))
             else:
                 st.error("Not a legal code in the tables.")
 
 st.markdown("---")
-st.caption("Placeholders present for: Body Part Key / Device Aggregation Table / Device Key / Substance Key / Procedure Checklists. Drop them into the repo later — the app will surface them in the sidebar and can be integrated into prompting.")
+st.caption("Body Part Key / Device Aggregation Table / Device Key / Substance Key uploads constrain table expansion to the body parts, devices and substances mentioned in the note. Procedure Checklists are placeholders for prompting.")
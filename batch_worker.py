@@ -0,0 +1,401 @@
+
+from __future__ import annotations
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, List, Optional, Tuple
+from dataclasses import dataclass
+from pathlib import Path
+import argparse
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+
+@dataclass
+class Task:
+    note_id: str
+    text: str
+    attempts: int
+
+class WorkQueue(ABC):
+    """Batches of notes leased to workers.
+
+    A claimed task belongs to its worker until the lease runs out. After
+    that, any worker may claim it again. complete() is idempotent: the first
+    result stored for a note wins, and later commits (for example from a
+    worker whose lease expired) return False. Implementations for other
+    backends (a database server, a cloud queue) only need these methods.
+    """
+
+    @abstractmethod
+    def enqueue(self, notes: Iterable[Tuple[str, str]]) -> int:
+        ...
+
+    @abstractmethod
+    def claim(self, worker: str, n: int, lease_s: float) -> List[Task]:
+        ...
+
+    @abstractmethod
+    def extend(self, worker: str, note_ids: List[str], lease_s: float):
+        ...
+
+    @abstractmethod
+    def complete(self, worker: str, note_id: str, result: Dict, elapsed: float) -> bool:
+        ...
+
+    @abstractmethod
+    def fail(self, worker: str, note_id: str, error: str):
+        ...
+
+    @abstractmethod
+    def progress(self) -> Dict[str, int]:
+        ...
+
+    @abstractmethod
+    def get_meta(self, key: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    def set_meta(self, key: str, value: str):
+        ...
+
+class SqliteWorkQueue(WorkQueue):
+    """WorkQueue in a local SQLite file (WAL mode), shared by worker processes on one host.
+
+    Every claim is one IMMEDIATE transaction, so two workers never lease the
+    same note. SQLite locking is not reliable on network filesystems, so
+    workers on other hosts need a server-backed WorkQueue.
+    """
+
+    def __init__(self, path: str, max_attempts: int = 3):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS tasks (id TEXT PRIMARY KEY, text TEXT, state TEXT DEFAULT 'pending',
+                                              worker TEXT, lease_until REAL DEFAULT 0, attempts INTEGER DEFAULT 0,
+                                              error TEXT);
+            CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, lease_until);
+            CREATE TABLE IF NOT EXISTS results (id TEXT PRIMARY KEY, worker TEXT, result TEXT,
+                                                elapsed REAL, finished REAL);
+        """)
+
+    def _tx(self):
+        self._db.execute("BEGIN IMMEDIATE")
+
+    def enqueue(self, notes: Iterable[Tuple[str, str]]) -> int:
+        # Re-enqueueing a known note id is a no-op, so a coordinator can be rerun safely
+        self._tx()
+        try:
+            before = self._db.total_changes
+            self._db.executemany("INSERT OR IGNORE INTO tasks (id, text) VALUES (?, ?)", notes)
+            added = self._db.total_changes - before
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+        return added
+
+    def claim(self, worker: str, n: int, lease_s: float) -> List[Task]:
+        now = time.time()
+        self._tx()
+        try:
+            rows = self._db.execute(
+                "SELECT id, text, attempts FROM tasks WHERE (state = 'pending' OR (state = 'leased' AND lease_until < ?)) "
+                "AND attempts < ? ORDER BY state = 'leased', rowid LIMIT ?", (now, self.max_attempts, n)).fetchall()
+            self._db.executemany("UPDATE tasks SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                                 "WHERE id = ?", [(worker, now + lease_s, r[0]) for r in rows])
+            # Expired leases that used up their attempts are given up on
+            self._db.execute("UPDATE tasks SET state = 'failed', error = coalesce(error, 'lease expired') "
+                             "WHERE state = 'leased' AND lease_until < ? AND attempts >= ?", (now, self.max_attempts))
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+        return [Task(note_id, text, attempts + 1) for note_id, text, attempts in rows]
+
+    def extend(self, worker: str, note_ids: List[str], lease_s: float):
+        self._db.executemany("UPDATE tasks SET lease_until = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+                             [(time.time() + lease_s, i, worker) for i in note_ids])
+
+    def complete(self, worker: str, note_id: str, result: Dict, elapsed: float) -> bool:
+        self._tx()
+        try:
+            cur = self._db.execute("INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?, ?)",
+                                   (note_id, worker, json.dumps(result), elapsed, time.time()))
+            stored = cur.rowcount == 1
+            if stored:
+                self._db.execute("UPDATE tasks SET state = 'done', worker = ?, error = NULL WHERE id = ?", (worker, note_id))
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+        return stored
+
+    def fail(self, worker: str, note_id: str, error: str):
+        # Back to pending while attempts remain; only the current lease holder can fail a note
+        self._db.execute("UPDATE tasks SET state = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, "
+                         "lease_until = 0, error = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+                         (self.max_attempts, error[:2000], note_id, worker))
+
+    def progress(self) -> Dict[str, int]:
+        counts = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+        counts.update(dict(self._db.execute("SELECT state, count(*) FROM tasks GROUP BY state").fetchall()))
+        return counts
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        self._db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    def results(self) -> Iterable[Tuple[str, str, Dict, float, float]]:
+        for note_id, worker, result, elapsed, finished in self._db.execute("SELECT * FROM results ORDER BY finished"):
+            yield note_id, worker, json.loads(result), elapsed, finished
+
+    def report(self) -> Dict:
+        """Aggregate throughput: notes/s over the run's wall clock, plus per-worker counts and busy time."""
+        p = self.progress()
+        workers = {w: {"notes": n, "busy_s": round(busy, 3), "notes_per_s": round(n / busy, 2) if busy else 0.0}
+                   for w, n, busy in self._db.execute("SELECT worker, count(*), sum(elapsed) FROM results GROUP BY worker")}
+        started = float(self.get_meta("started") or 0)
+        last = self._db.execute("SELECT max(finished) FROM results").fetchone()[0]
+        wall = (last - started) if (last and started) else 0.0
+        return {**p, "workers": workers, "wall_s": round(wall, 3),
+                "notes_per_s": round(p["done"] / wall, 2) if wall else 0.0}
+
+# ------------- Worker ------------------
+def snapshot_id(meta: Dict[str, str]) -> str:
+    # Results are only comparable when every worker codes against the same Tables + Index
+    return f"{meta.get('tables', '')}:{meta.get('index', '')}"
+
+def load_key_maps(engine, keys_dir: Optional[str] = None):
+    from pcs_keys import KeyMaps
+    if not keys_dir:
+        return None
+    files = {"body_part": "Body Part Key.md", "device_agg": "Device Aggregation Table.md",
+             "device": "Device Key.md", "substance": "Substance Key.md"}
+    keys = {k: (Path(keys_dir) / f).read_bytes() for k, f in files.items() if (Path(keys_dir) / f).exists()}
+    return KeyMaps.compile(engine, keys)
+
+def load_snapshot(store: str, keys_dir: Optional[str] = None):
+    """(engine, index, key maps, snapshot id) from a compiled pcs_sqlite store, the shared read-only snapshot."""
+    from pcs_sqlite import open_store
+    engine, index, _ = open_store(store, pool_size=1)
+    if engine is None or index is None:
+        raise SystemExit(f"{store} must be compiled with both --tables and --index")
+    return engine, index, load_key_maps(engine, keys_dir), snapshot_id(engine.db.meta)
+
+def build_snapshot(tables: str, index: str, keys_dir: Optional[str] = None):
+    """(engine, index, key maps, snapshot id) as frozen in-memory engines built from the XMLs (pcs_frozen).
+
+    Built once in a parent that then forks its workers; the id matches a
+    pcs_sqlite store compiled from the same files.
+    """
+    from pcs_frozen import build_engines
+    tables_xml, index_xml = Path(tables).read_bytes(), Path(index).read_bytes()
+    engines = build_engines(tables_xml, index_xml, frozen=True)
+    # Same digests pcs_sqlite records in a store's meta
+    digest = lambda b: hashlib.blake2b(b, digest_size=16).hexdigest()
+    snapshot = snapshot_id({"tables": digest(tables_xml), "index": digest(index_xml)})
+    return engines["tables"], engines["index"], load_key_maps(engines["tables"], keys_dir), snapshot
+
+def run_worker(queue: WorkQueue, store: Optional[str], worker: Optional[str] = None, batch: int = 8, lease_s: float = 120,
+               keys_dir: Optional[str] = None, idle_exit_s: float = 5, max_codes: int = 100,
+               llm_model: Optional[str] = None, llm_budget: int = 6000, llm_codes: int = 20,
+               snapshot: Optional[Tuple] = None) -> int:
+    """Claim, code and commit batches until the queue has been drained for `idle_exit_s`. Returns notes committed.
+
+    Engines come from `store`, or from `snapshot` when a pre-forking parent already built them (build_snapshot).
+
+    With `llm_model`, each claimed batch's top `llm_codes` candidates and their scores are sent to Gemini
+    in packed requests of at most `llm_budget` prompt tokens (llm_batch). The model's confidences are
+    folded in with pcs_scoring.rerank_with_llm and the re-ranked list is stored under "llm".
+    """
+    from suggest_from_index import rank_from_index
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+    engine, index, key_maps, snap = snapshot or load_snapshot(store, keys_dir)
+    batcher = None
+    if llm_model:
+        from llm_batch import BatchItem, GeminiRestClient, LLMBatcher
+        from pcs_scoring import rerank_with_llm
+        batcher = LLMBatcher(GeminiRestClient(), model=llm_model, budget=llm_budget, labels=engine.axis_labels,
+                             is_valid=engine.is_valid)
+    expected = queue.get_meta("snapshot")
+    if expected and expected != snap:
+        raise SystemExit(f"{worker}: {store or 'the XMLs'} are not the snapshot this queue was created for")
+    done = 0
+    idle_since = None
+    while True:
+        tasks = queue.claim(worker, batch, lease_s)
+        if not tasks:
+            p = queue.progress()
+            if not p["pending"] and not p["leased"]:
+                break
+            # Others still hold leases; wait in case one of them is abandoned
+            idle_since = idle_since or time.time()
+            if time.time() - idle_since > max(idle_exit_s, lease_s):
+                break
+            time.sleep(min(1.0, idle_exit_s))
+            continue
+        idle_since = None
+        coded = []
+        for i, task in enumerate(tasks):
+            t0 = time.perf_counter()
+            try:
+                scored = rank_from_index(task.text, index, engine, topk_hits=60, max_codes=max_codes, keys=key_maps)
+            except Exception as e:
+                queue.fail(worker, task.note_id, f"{type(e).__name__}: {e}")
+                continue
+            codes = [c for c, _ in scored]
+            if batcher is None:
+                if queue.complete(worker, task.note_id, {"codes": codes}, time.perf_counter() - t0):
+                    done += 1
+                queue.extend(worker, [t.note_id for t in tasks[i+1:]], lease_s)
+            else:
+                coded.append((task, scored, time.perf_counter() - t0))
+        if coded:
+            # One packed Gemini request per few notes instead of one round-trip each
+            queue.extend(worker, [t.note_id for t, _, _ in coded], lease_s)
+            t0 = time.perf_counter()
+            # 0..1 confidences for the prompt; the uncapped Index score is the pre-LLM term of the re-rank
+            sent = {t.note_id: [{"code": c, "confidence": round(min(0.99, max(0.0, s)), 4), "features": {"index_score": s}}
+                                for c, s in scored[:llm_codes]] for t, scored, _ in coded}
+            ranked = batcher.run(BatchItem(t.note_id, t.text, [s["code"] for s in sent[t.note_id]],
+                                           {s["code"]: s["confidence"] for s in sent[t.note_id]}) for t, _, _ in coded)
+            share = (time.perf_counter() - t0) / len(coded)
+            for task, scored, elapsed in coded:
+                llm = ranked.get(task.note_id)
+                if llm is not None and sent[task.note_id]:
+                    llm = rerank_with_llm(sent[task.note_id], llm)
+                result = {"codes": [c for c, _ in scored], "llm": llm}
+                if queue.complete(worker, task.note_id, result, elapsed + share):
+                    done += 1
+    return done
+
+# ------------- Coordinator ------------------
+def read_notes(paths: Iterable[str]) -> Iterable[Tuple[str, str]]:
+    # (note id, text) for note files or directories of them; the id is the path relative to its root
+    for root in map(Path, paths):
+        files = sorted(p for p in root.rglob("*") if p.suffix.lower() in (".txt", ".pdf", ".docx")) if root.is_dir() else [root]
+        for f in files:
+            if f.suffix.lower() == ".txt":
+                text = f.read_text("utf-8", errors="ignore")
+            else:
+                from utils_ingest import extract_text_from_upload
+                with open(f, "rb") as fh:
+                    text = extract_text_from_upload(fh)
+            if text.strip():
+                yield (str(f.relative_to(root)) if root.is_dir() else f.name), text
+
+def coordinate(queue_path: str, store: Optional[str], notes: List[str], workers: int = 4,
+               prefork: Optional[Tuple[str, str]] = None, **worker_args) -> Dict:
+    """Enqueue notes, start `workers` local worker processes against the same queue and snapshot, and report.
+
+    By default each worker is a fresh process opening `store`. With `prefork` ((tables, index) XML
+    paths) the engines are built and frozen once here and the workers are forked from this process,
+    sharing their pages (pcs_frozen.prefork; POSIX only).
+    """
+    built = None
+    if prefork:
+        built = build_snapshot(*prefork, keys_dir=worker_args.get("keys_dir"))
+        snap = built[3]
+    else:
+        from pcs_sqlite import ReadPool
+        snap = snapshot_id(ReadPool(store, size=1).meta)
+    queue = SqliteWorkQueue(queue_path)
+    queue.set_meta("snapshot", snap)
+    added = queue.enqueue(read_notes(notes))
+    if queue.get_meta("started") is None or added:
+        queue.set_meta("started", str(time.time()))
+    if built:
+        from pcs_frozen import prefork as fork_workers
+        kwargs = {("lease_s" if k == "lease" else k): v for k, v in worker_args.items() if k != "keys_dir" and v is not None}
+        # Each child opens its own queue connection; SQLite handles must not cross a fork
+        codes = fork_workers(lambda: built, lambda engines, i: run_worker(SqliteWorkQueue(queue_path), None,
+                                                                          snapshot=engines, **kwargs), workers)
+        if any(codes):
+            print(f"worker exit codes: {codes}", file=sys.stderr)
+        return queue.report()
+    cmd = [sys.executable, os.path.abspath(__file__), "worker", queue_path, "--store", store]
+    for k, v in worker_args.items():
+        if v is not None:
+            cmd += [f"--{k.replace('_', '-')}", str(v)]
+    procs = [subprocess.Popen(cmd) for _ in range(workers)]
+    for p in procs:
+        p.wait()
+    return queue.report()
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="Batch back-coding over a shared work queue.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    run = sub.add_parser("run", help="enqueue notes and run local workers until the queue is drained")
+    run.add_argument("queue")
+    run.add_argument("notes", nargs="+", help="note files or directories (.txt/.pdf/.docx)")
+    run.add_argument("--store", help="pcs_sqlite store (the shared snapshot)")
+    run.add_argument("--workers", type=int, default=4)
+    run.add_argument("--prefork", nargs=2, metavar=("TABLES_XML", "INDEX_XML"),
+                     help="instead of --store: build frozen engines from the XMLs once and fork the workers (pcs_frozen)")
+
+    enq = sub.add_parser("enqueue", help="add notes to the queue (for workers started elsewhere)")
+    enq.add_argument("queue")
+    enq.add_argument("notes", nargs="+")
+    enq.add_argument("--store", required=True)
+
+    wk = sub.add_parser("worker", help="claim and code batches until the queue is drained")
+    wk.add_argument("queue")
+    wk.add_argument("--store", required=True)
+    wk.add_argument("--name")
+    for p in (run, wk):
+        p.add_argument("--batch", type=int, default=8)
+        p.add_argument("--lease", type=float, default=120, help="seconds before an unfinished batch can be reclaimed")
+        p.add_argument("--keys-dir", help="directory holding the Body Part / Device / Substance key .md files")
+        p.add_argument("--llm-model", help="re-rank candidates with this Gemini model, several notes per request "
+                                           "(GEMINI_API_KEY; GEMINI_BASE_URL overrides the endpoint)")
+        p.add_argument("--llm-budget", type=int, default=6000, help="prompt tokens per packed Gemini request")
+        p.add_argument("--llm-codes", type=int, default=20, help="top candidates per note sent for re-ranking")
+
+    rep = sub.add_parser("report", help="print throughput and progress")
+    rep.add_argument("queue")
+    exp = sub.add_parser("export", help="write results as JSON lines")
+    exp.add_argument("queue")
+    exp.add_argument("out")
+
+    args = ap.parse_args(argv)
+    if args.cmd == "run":
+        if not (args.store or args.prefork):
+            ap.error("run needs --store or --prefork")
+        report = coordinate(args.queue, args.store, args.notes, workers=args.workers, prefork=args.prefork,
+                            batch=args.batch, lease=args.lease, keys_dir=args.keys_dir,
+                            llm_model=args.llm_model, llm_budget=args.llm_budget, llm_codes=args.llm_codes)
+    elif args.cmd == "enqueue":
+        from pcs_sqlite import ReadPool
+        queue = SqliteWorkQueue(args.queue)
+        queue.set_meta("snapshot", snapshot_id(ReadPool(args.store, size=1).meta))
+        added = queue.enqueue(read_notes(args.notes))
+        if added:
+            queue.set_meta("started", str(time.time()))
+        report = {"enqueued": added, **queue.progress()}
+    elif args.cmd == "worker":
+        queue = SqliteWorkQueue(args.queue)
+        n = run_worker(queue, args.store, worker=args.name, batch=args.batch, lease_s=args.lease, keys_dir=args.keys_dir,
+                       llm_model=args.llm_model, llm_budget=args.llm_budget, llm_codes=args.llm_codes)
+        report = {"worker": args.name or f"{socket.gethostname()}:{os.getpid()}", "committed": n}
+    elif args.cmd == "report":
+        report = SqliteWorkQueue(args.queue).report()
+    else:
+        with open(args.out, "w") as fh:
+            for note_id, worker, result, elapsed, _ in SqliteWorkQueue(args.queue).results():
+                fh.write(json.dumps({"note": note_id, "worker": worker, "elapsed_s": round(elapsed, 4), **result}) + "\n")
+        report = SqliteWorkQueue(args.queue).progress()
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
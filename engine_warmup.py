@@ -0,0 +1,77 @@
+
+from __future__ import annotations
+from typing import Any, Callable, Dict, Hashable, Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+import time
+
+from note_cache import LRUCache
+
+Progress = Callable[..., None]  # progress(rows=..., codes=...) from inside a build
+
+class Job:
+    """One background engine build: a future plus the latest progress counters it reported."""
+
+    def __init__(self, name: str, key: Hashable):
+        self.name = name
+        self.key = key
+        self.future: Optional[Future] = None
+        self.progress: Dict[str, int] = {}
+        self.started = time.time()
+        self.finished: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def report(self, **counts: int):
+        with self._lock:
+            self.progress = {**self.progress, **counts}
+
+    def done(self) -> bool:
+        return self.future is not None and self.future.done()
+
+    def failed(self) -> bool:
+        return self.done() and self.future.exception() is not None
+
+    def result(self, timeout: Optional[float] = None) -> Any:
+        return self.future.result(timeout)
+
+    def describe(self) -> str:
+        # "tables: building 12.3s (rows 4100, codes 51200)" / "tables: ready in 41.0s"
+        with self._lock:
+            counts = ", ".join(f"{k} {v}" for k, v in self.progress.items())
+        if self.failed():
+            return f"{self.name}: failed ({self.future.exception()})"
+        if self.done():
+            return f"{self.name}: ready in {(self.finished or time.time()) - self.started:.1f}s" + (f" ({counts})" if counts else "")
+        return f"{self.name}: building {time.time() - self.started:.1f}s" + (f" ({counts})" if counts else "")
+
+class Warmup:
+    """Starts engine builds in background threads as soon as their input bytes exist.
+
+    start() is keyed by (name, key) – typically a digest of the XML – so
+    reruns and other sessions reuse the running or finished build instead of
+    starting another. Callers block on Job.result() only where the engine is
+    actually needed. Threads (not processes) keep the finished engines in
+    this process without pickling them across.
+    """
+
+    def __init__(self, max_workers: int = 3, keep: int = 8):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pcs-warmup")
+        self._jobs = LRUCache(maxsize=keep)
+        self._lock = threading.Lock()
+
+    def start(self, name: str, key: Hashable, build: Callable[[Progress], Any]) -> Job:
+        with self._lock:
+            job = self._jobs.get((name, key))
+            if job is not None and not job.failed():
+                return job
+            job = Job(name, key)
+
+            def run():
+                try:
+                    return build(job.report)
+                finally:
+                    job.finished = time.time()
+
+            job.future = self._pool.submit(run)
+            self._jobs.put((name, key), job)
+            return job
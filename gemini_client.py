@@ -1,8 +1,10 @@
 
 from __future__ import annotations
-from typing import List
+from typing import Dict, List
 import os
 
+from prompt_budget import build_prompt
+
 try:
     import google.generativeai as genai
 except Exception:
@@ -13,12 +15,25 @@ SYSTEM_HINT = (
     "Return only a newline-separated list of 7-character codes (A–Z, 0–9), no commentary."
 )
 
+PROMPT = SYSTEM_HINT + """
+
+Procedure note (most relevant procedural sentences):
+{note}
+
+Return:
+- Newline-separated ICD-10-PCS codes only.
+- If unsure, propose likely candidates (but avoid non-7-char outputs)."""
+
 class GeminiHelper:
-    def __init__(self, client, model: str, temperature: float):
+    def __init__(self, client, model: str, temperature: float, max_prompt_tokens: int = 1200):
         self.client = client
         self.model = model
         self.temperature = temperature
+        self.max_prompt_tokens = max_prompt_tokens
         self.available = client is not None
+        # Estimated size of the last prompt sent (see prompt_budget.build_prompt)
+        self.last_prompt_tokens = 0
+        self.last_prompt_stats: Dict[str, int] = {}
 
     @classmethod
     def build_from_secrets(cls, secrets, model_name: str = "gemini-2.0-flash", temperature: float = 0.2) -> "GeminiHelper":
@@ -38,14 +53,8 @@ class GeminiHelper:
         if not self.available:
             return []
         model = self.client.GenerativeModel(self.model)
-        prompt = f"""{SYSTEM_HINT}
-
-Procedure note:
-{text}
-
-Return:
-- Newline-separated ICD-10-PCS codes only.
-- If unsure, propose likely candidates (but avoid non-7-char outputs)."""
+        prompt, self.last_prompt_stats = build_prompt(PROMPT, text, self.max_prompt_tokens)
+        self.last_prompt_tokens = self.last_prompt_stats["prompt_tokens"]
         resp = model.generate_content(prompt, generation_config={"temperature": self.temperature})
         content = resp.text if hasattr(resp, "text") else ""
         codes = []
@@ -0,0 +1,303 @@
+
+from __future__ import annotations
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import json
+import os
+import re
+import threading
+import time
+import urllib.request
+
+from prompt_budget import compact_candidates, estimate_tokens, select_spans
+
+DEFAULT_BASE_URL = "https://generativelanguage.googleapis.com"
+
+BATCH_PROMPT = """You are assisting with ICD-10-PCS coding.
+- Several procedure notes follow, each starting with a line "### NOTE <id>".
+- Under each note, "Candidates" lists its candidate codes, one line per shared code prefix ("prefix (labels): suffix(conf) ..."; axes that differ are labelled in [...]).
+- For every note, re-rank and explain only that note's own candidates; never invent a PCS code. When a note's candidates are "none", propose likely 7-character codes.
+Return one JSON object: {"notes": [{"id": "<id>", "codes": [{"code": "<7 characters>", "confidence": 0-1, "why": "1-3 lines", "evidence": ["<=3 short quotes"]}]}]} with one entry per note.
+"""
+
+# ------------- Client ------------------
+class GeminiRestClient:
+    """Minimal generateContent client over the REST API (stdlib only).
+
+    `base_url` (default: GEMINI_BASE_URL, else Google's endpoint) can point
+    at any server speaking the same protocol, e.g. FakeGemini. Anything
+    with the same generate() signature can be passed to LLMBatcher instead.
+    """
+
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None, timeout: float = 120):
+        self.api_key = api_key if api_key is not None else os.getenv("GEMINI_API_KEY", "")
+        self.base_url = (base_url or os.getenv("GEMINI_BASE_URL") or DEFAULT_BASE_URL).rstrip("/")
+        self.timeout = timeout
+
+    def generate(self, model: str, prompt: str, temperature: float = 0.2, max_output_tokens: int = 800) -> str:
+        body = {
+            "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+            "generationConfig": {"temperature": temperature, "maxOutputTokens": max_output_tokens,
+                                 "responseMimeType": "application/json"},
+        }
+        req = urllib.request.Request(f"{self.base_url}/v1beta/models/{model}:generateContent",
+                                     data=json.dumps(body).encode("utf-8"), method="POST",
+                                     headers={"Content-Type": "application/json", "x-goog-api-key": self.api_key})
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+            data = json.load(resp)
+        parts = ((data.get("candidates") or [{}])[0].get("content") or {}).get("parts") or []
+        return "".join(p.get("text", "") for p in parts)
+
+# ------------- Packing ------------------
+@dataclass
+class BatchItem:
+    """One note and its candidate codes (rank order); no candidates means "propose codes"."""
+    note_id: str
+    text: str
+    codes: List[str] = field(default_factory=list)
+    confidences: Dict[str, float] = field(default_factory=dict)
+    terms: Tuple[str, ...] = ()  # extra relevance words for picking note spans (e.g. Index paths)
+
+def render_item(item: BatchItem, note_budget: int, labels=None) -> str:
+    cands = compact_candidates(item.codes, labels=labels, confidences=item.confidences) if item.codes else "none"
+    # The note gets what the candidate list leaves of its share
+    note, _ = select_spans(item.text, max(note_budget - estimate_tokens(cands), 32), item.terms)
+    return f"### NOTE {item.note_id}\n{note}\nCandidates:\n{cands}\n"
+
+def pack(items: Sequence[BatchItem], budget: int = 6000, note_budget: int = 1200, max_notes: int = 8,
+         labels=None) -> List[List[Tuple[BatchItem, str]]]:
+    """Greedy first-fit of rendered notes into batches of at most `budget` prompt tokens / `max_notes` notes.
+
+    Each note is rendered within `note_budget` first, so one long note
+    cannot crowd out the rest of a batch.
+    """
+    fixed = estimate_tokens(BATCH_PROMPT)
+    note_budget = min(note_budget, max(budget - fixed, 64))
+    batches: List[List[Tuple[BatchItem, str]]] = []
+    sizes: List[int] = []
+    for item in items:
+        section = render_item(item, note_budget, labels)
+        cost = estimate_tokens(section)
+        for i, b in enumerate(batches):
+            if len(b) < max_notes and sizes[i] + cost <= budget:
+                b.append((item, section))
+                sizes[i] += cost
+                break
+        else:
+            batches.append([(item, section)])
+            sizes.append(fixed + cost)
+    return batches
+
+def split_response(text: str, items: Sequence[BatchItem],
+                   is_valid: Optional[Callable[[str], bool]] = None) -> Dict[str, List[Dict[str, Any]]]:
+    """Per-note code objects from a batch response; notes missing or malformed in it are left out.
+
+    Codes outside a note's candidates are dropped (or, for notes without
+    candidates, anything that is not a 7-character code `is_valid` accepts).
+    """
+    try:
+        parsed = json.loads(text)
+    except (TypeError, ValueError):
+        return {}
+    notes = parsed.get("notes") if isinstance(parsed, dict) else parsed
+    wanted = {item.note_id: item for item in items}
+    out: Dict[str, List[Dict[str, Any]]] = {}
+    for entry in notes if isinstance(notes, list) else []:
+        if not isinstance(entry, dict) or str(entry.get("id")) not in wanted or not isinstance(entry.get("codes"), list):
+            continue
+        item = wanted[str(entry.get("id"))]
+        allowed = set(item.codes)
+        codes = []
+        for c in entry["codes"]:
+            code = str(c.get("code", "")).strip().upper() if isinstance(c, dict) else ""
+            if (code in allowed) if allowed else (len(code) == 7 and code.isalnum() and (is_valid is None or is_valid(code))):
+                codes.append({**c, "code": code})
+        out[item.note_id] = codes
+    return out
+
+class LLMBatcher:
+    """Packs several notes per Gemini request and splits the answer back per note.
+
+    Notes the batch response does not cover (bad JSON, missing ids) are
+    retried one per request. `stats` counts calls, fallbacks and
+    estimated prompt tokens.
+    """
+
+    def __init__(self, client, model: str = "gemini-2.0-flash", budget: int = 6000, note_budget: int = 1200,
+                 max_notes: int = 8, labels=None, is_valid: Optional[Callable[[str], bool]] = None,
+                 temperature: float = 0.2, output_tokens_per_note: int = 400):
+        self.client = client
+        self.model = model
+        self.budget = budget
+        self.note_budget = note_budget
+        self.max_notes = max_notes
+        self.labels = labels
+        self.is_valid = is_valid
+        self.temperature = temperature
+        self.output_tokens_per_note = output_tokens_per_note
+        self.stats = {"notes": 0, "calls": 0, "batches": 0, "fallbacks": 0, "failed": 0, "prompt_tokens": 0}
+
+    def _call(self, sections: Sequence[str]) -> str:
+        prompt = BATCH_PROMPT + "\n" + "\n".join(sections)
+        self.stats["calls"] += 1
+        self.stats["prompt_tokens"] += estimate_tokens(prompt)
+        return self.client.generate(self.model, prompt, temperature=self.temperature,
+                                    max_output_tokens=min(8192, self.output_tokens_per_note * len(sections)))
+
+    def run(self, items: Iterable[BatchItem]) -> Dict[str, Optional[List[Dict[str, Any]]]]:
+        """note id -> the model's code objects, or None when even the single-note retry failed."""
+        items = list(items)
+        self.stats["notes"] += len(items)
+        results: Dict[str, Optional[List[Dict[str, Any]]]] = {}
+        for batch in pack(items, self.budget, self.note_budget, self.max_notes, self.labels):
+            self.stats["batches"] += 1
+            try:
+                got = split_response(self._call([s for _, s in batch]), [i for i, _ in batch], self.is_valid)
+            except Exception:
+                got = {}
+            for item, section in batch:
+                if item.note_id in got:
+                    results[item.note_id] = got[item.note_id]
+                    continue
+                self.stats["fallbacks"] += 1
+                try:
+                    results[item.note_id] = split_response(self._call([section]), [item], self.is_valid)[item.note_id]
+                except Exception:
+                    results[item.note_id] = None
+                    self.stats["failed"] += 1
+        return results
+
+# ------------- Fake server ------------------
+class FakeGemini:
+    """Local stand-in for the generateContent endpoint, for exercising batching offline.
+
+    It answers every "### NOTE" section of a prompt with that note's
+    candidates in order (confidence falling from 0.9). `latency` adds a
+    per-request delay; every `fail_every`-th request returns malformed
+    JSON so the per-note fallback runs.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, fail_every: int = 0):
+        self.latency = latency
+        self.fail_every = fail_every
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def answer(self, prompt: str) -> str:
+        with self._lock:
+            self.requests += 1
+            n = self.requests
+        if self.fail_every and n % self.fail_every == 0:
+            return '{"notes": [ truncated'
+        notes = []
+        for m in re.finditer(r"^### NOTE (\S+)\n(.*?)(?=^### NOTE |\Z)", prompt, re.M | re.S):
+            block = m.group(2).split("Candidates:\n", 1)[-1]
+            codes = []
+            for line in block.splitlines():
+                head = re.match(r"^([0-9A-Z]{1,7})(?: \(.*?\))?: (.*?)(?: \[.*\])?$", line)
+                if head:
+                    codes += [head.group(1) + re.sub(r"\(.*?\)", "", t) for t in head.group(2).split()]
+            notes.append({"id": m.group(1), "codes": [
+                {"code": c, "confidence": round(max(0.1, 0.9 - 0.05 * i), 2), "why": "fake", "evidence": []}
+                for i, c in enumerate(codes)]})
+        return json.dumps({"notes": notes})
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                prompt = "".join(p.get("text", "") for c in body.get("contents", []) for p in c.get("parts", []))
+                if fake.latency:
+                    time.sleep(fake.latency)
+                out = json.dumps({"candidates": [{"content": {"role": "model", "parts": [{"text": fake.answer(prompt)}]}}]})
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out.encode("utf-8"))
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> 'FakeGemini':
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> 'FakeGemini':
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+# ------------- Benchmark ------------------
+def bench(items: Sequence[BatchItem], client, model: str = "gemini-2.0-flash", **batch_args) -> Dict:
+    """The same notes one per request vs. packed, against `client`: calls, wall time and coverage."""
+    report: Dict[str, Any] = {"notes": len(items)}
+    for name, max_notes in (("single", 1), ("batched", batch_args.pop("max_notes", 8))):
+        batcher = LLMBatcher(client, model=model, max_notes=max_notes, **batch_args)
+        t0 = time.perf_counter()
+        results = batcher.run(items)
+        report[name] = {**batcher.stats, "wall_s": round(time.perf_counter() - t0, 3),
+                        "answered": sum(1 for r in results.values() if r is not None)}
+    return report
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="Batched Gemini requests over several notes.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    fake = sub.add_parser("fake-server", help="serve a fake generateContent endpoint")
+    fake.add_argument("--port", type=int, default=8765)
+    fake.add_argument("--latency", type=float, default=0.2)
+    fake.add_argument("--fail-every", type=int, default=0)
+    b = sub.add_parser("bench", help="per-note vs batched requests for a set of notes")
+    b.add_argument("notes", nargs="+", help="note files or directories")
+    b.add_argument("--store", required=True, help="pcs_sqlite store used to generate candidates")
+    b.add_argument("--base-url", help="endpoint (default GEMINI_BASE_URL); omit with --fake to start one here")
+    b.add_argument("--fake", action="store_true", help="run against an in-process FakeGemini")
+    b.add_argument("--latency", type=float, default=0.2, help="fake per-request latency (s)")
+    b.add_argument("--model", default="gemini-2.0-flash")
+    b.add_argument("--budget", type=int, default=6000)
+    b.add_argument("--max-notes", type=int, default=8)
+    b.add_argument("--max-codes", type=int, default=20)
+    args = ap.parse_args(argv)
+
+    if args.cmd == "fake-server":
+        server = FakeGemini(port=args.port, latency=args.latency, fail_every=args.fail_every)
+        print(f"fake Gemini on {server.url} (GEMINI_BASE_URL={server.url})", flush=True)
+        server.server.serve_forever()
+        return
+
+    from batch_worker import load_snapshot, read_notes
+    from suggest_from_index import suggest_from_index
+    engine, index, _, _ = load_snapshot(args.store)
+    items = [BatchItem(note_id, text, suggest_from_index(text, index, engine, max_codes=args.max_codes))
+             for note_id, text in read_notes(args.notes)]
+    server = FakeGemini(latency=args.latency).start() if args.fake else None
+    try:
+        client = GeminiRestClient(base_url=server.url if server else args.base_url)
+        report = bench(items, client, model=args.model, budget=args.budget, max_notes=args.max_notes,
+                       labels=engine.axis_labels)
+    finally:
+        if server:
+            server.stop()
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+
+from __future__ import annotations
+from typing import Any, Callable, Dict, Hashable, List, Optional, Set, Tuple
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import hashlib
+import re
+import threading
+
+class LRUCache:
+    """Thread-safe LRU map bounded by entry count and, optionally, total weight."""
+
+    def __init__(self, maxsize: int = 256, max_weight: Optional[int] = None,
+                 weigher: Optional[Callable[[Any], int]] = None,
+                 on_evict: Optional[Callable[[Hashable, Any], None]] = None):
+        self.maxsize = maxsize
+        self.max_weight = max_weight
+        self.weigher = weigher or (lambda v: 1)
+        self.on_evict = on_evict
+        self._data: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+        self._weight = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        # Read without touching recency or counters
+        with self._lock:
+            item = self._data.get(key)
+            return default if item is None else item[0]
+
+    def put(self, key: Hashable, value: Any):
+        w = self.weigher(value)
+        evicted = []
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._weight -= old[1]
+            self._data[key] = (value, w)
+            self._weight += w
+            while self._data and (len(self._data) > self.maxsize or
+                                  (self.max_weight is not None and self._weight > self.max_weight and len(self._data) > 1)):
+                k, (v, vw) = self._data.popitem(last=False)
+                self._weight -= vw
+                self.evictions += 1
+                evicted.append((k, v))
+        if self.on_evict:
+            for k, v in evicted:
+                self.on_evict(k, v)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._weight = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {"size": len(self._data), "weight": self._weight, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "hit_rate": (self.hits / total) if total else 0.0}
+
+# ------------- Note fingerprints ------------------
+# Dates, times and long ids (MRNs, accession numbers) don't change the coding; levels and counts
+# ("L4" vs "L5", "2 stents" vs "3 stents") do, so short numbers stay in the fingerprint
+_VOLATILE_NUM_RE = re.compile(r"\d{1,4}[/-]\d{1,2}[/-]\d{2,4}|\d{1,2}:\d{2}(?::\d{2})?|\d{5,}")
+
+def normalize_note(text: str) -> str:
+    # Case, whitespace, punctuation and volatile numbers are ignored
+    t = _VOLATILE_NUM_RE.sub("#", (text or "").lower())
+    return " ".join(re.findall(r"[a-z0-9#]+", t))
+
+def note_sentences(text: str) -> List[str]:
+    out = []
+    for chunk in re.split(r"[.;\n]+", text or ""):
+        s = normalize_note(chunk)
+        if s:
+            out.append(s)
+    return out
+
+def fingerprint(text: str) -> str:
+    return hashlib.blake2b(normalize_note(text).encode("utf-8"), digest_size=16).hexdigest()
+
+_MERSENNE = (1 << 61) - 1
+_PERMS = [((i * 0x9E3779B97F4A7C15 + 1) % _MERSENNE | 1, (i * 0xC2B2AE3D27D4EB4F + 7) % _MERSENNE) for i in range(1, 65)]
+
+def minhash(text: str, shingle: int = 2) -> Tuple[int, ...]:
+    """64-value MinHash signature over word shingles; matching slots estimate Jaccard similarity."""
+    toks = normalize_note(text).split()
+    grams = {" ".join(toks[i:i+shingle]) for i in range(max(1, len(toks) - shingle + 1))}
+    hashes = [int.from_bytes(hashlib.blake2b(g.encode("utf-8"), digest_size=8).digest(), "big") for g in grams]
+    if not hashes:
+        return tuple([0] * len(_PERMS))
+    return tuple(min((a * h + b) % _MERSENNE for h in hashes) for a, b in _PERMS)
+
+def similarity(sig_a: Tuple[int, ...], sig_b: Tuple[int, ...]) -> float:
+    return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / len(sig_a)
+
+@dataclass
+class CachedNote:
+    fingerprint: str
+    signature: Tuple[int, ...]
+    sentences: Set[str]
+    scores: Dict[str, float]
+    extra: Dict[str, Any] = field(default_factory=dict)
+    per_sentence: Dict[str, Dict[str, float]] = field(default_factory=dict)  # sentence -> its own code scores
+
+class NoteCache:
+    """Suggestion results keyed by note fingerprint, with MinHash near-duplicate lookup.
+
+    Signatures are split into 16 LSH bands of 4 values; notes sharing a band
+    are candidates and are accepted when their estimated Jaccard similarity
+    is at least `threshold`.
+    """
+
+    BANDS = 16
+
+    def __init__(self, maxsize: int = 512, threshold: float = 0.8):
+        self.threshold = threshold
+        self._bands: List[Dict[int, Set[str]]] = [dict() for _ in range(self.BANDS)]
+        self._band_lock = threading.Lock()
+        self._lru = LRUCache(maxsize=maxsize, on_evict=self._unband)
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def _band_keys(self, sig: Tuple[int, ...]) -> List[int]:
+        rows = len(sig) // self.BANDS
+        return [hash(sig[i*rows:(i+1)*rows]) for i in range(self.BANDS)]
+
+    def _unband(self, fp: str, entry: CachedNote):
+        with self._band_lock:
+            for i, k in enumerate(self._band_keys(entry.signature)):
+                bucket = self._bands[i].get(k)
+                if bucket:
+                    bucket.discard(fp)
+                    if not bucket:
+                        del self._bands[i][k]
+
+    def lookup(self, text: str) -> Tuple[Optional[str], Optional[CachedNote]]:
+        # ("exact" | "near" | None, entry)
+        fp = fingerprint(text)
+        entry = self._lru.get(fp)
+        if entry is not None:
+            self.exact_hits += 1
+            return "exact", entry
+        sig = minhash(text)
+        best: Optional[CachedNote] = None
+        best_sim = self.threshold
+        with self._band_lock:
+            cands = set()
+            for i, k in enumerate(self._band_keys(sig)):
+                cands |= self._bands[i].get(k, set())
+        for cfp in cands:
+            cand = self._lru.peek(cfp)
+            if cand is None:
+                continue
+            sim = similarity(cand.signature, sig)
+            if sim >= best_sim:
+                best, best_sim = cand, sim
+        if best is not None:
+            self._lru.get(best.fingerprint)  # refresh recency
+            self.near_hits += 1
+            return "near", best
+        self.misses += 1
+        return None, None
+
+    def store(self, text: str, scores: Dict[str, float], sentences: Optional[List[str]] = None,
+              per_sentence: Optional[Dict[str, Dict[str, float]]] = None, **extra) -> CachedNote:
+        entry = CachedNote(fingerprint(text), minhash(text), set(sentences if sentences is not None else note_sentences(text)),
+                           dict(scores), dict(extra), dict(per_sentence or {}))
+        self._lru.put(entry.fingerprint, entry)
+        with self._band_lock:
+            for i, k in enumerate(self._band_keys(entry.signature)):
+                self._bands[i].setdefault(k, set()).add(entry.fingerprint)
+        return entry
+
+    def stats(self) -> Dict:
+        total = self.exact_hits + self.near_hits + self.misses
+        lru = self._lru.stats()
+        return {"size": lru["size"], "evictions": lru["evictions"], "exact_hits": self.exact_hits,
+                "near_hits": self.near_hits, "misses": self.misses,
+                "hit_rate": ((self.exact_hits + self.near_hits) / total) if total else 0.0}
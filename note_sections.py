@@ -0,0 +1,71 @@
+
+from __future__ import annotations
+from typing import Dict, Iterable, List
+from dataclasses import dataclass
+import re
+
+# Canonical section -> header spellings seen in op notes (matched case-insensitively)
+SECTION_ALIASES: Dict[str, List[str]] = {
+    "procedure": ["procedure performed", "procedures performed", "procedure", "procedures", "operation performed",
+                  "operations performed", "operation", "name of procedure", "title of procedure", "title of operation"],
+    "technique": ["technique", "description of procedure", "description of the procedure", "procedure in detail",
+                  "details of procedure", "details of the procedure", "description of operation", "operative technique",
+                  "operative procedure", "procedure description", "operative description", "narrative"],
+    "findings": ["findings", "intraoperative findings", "operative findings"],
+    "implants": ["implants", "implant", "devices", "hardware"],
+    "specimens": ["specimens", "specimen", "pathology"],
+    "indications": ["indications", "indication", "indications for procedure", "indications for surgery"],
+    "diagnosis": ["preoperative diagnosis", "postoperative diagnosis", "pre-operative diagnosis",
+                  "post-operative diagnosis", "diagnosis", "diagnoses"],
+    "history": ["history of present illness", "hpi", "history", "past medical history", "pmh",
+                "past surgical history", "social history", "family history", "review of systems"],
+    "medications": ["medications", "meds", "allergies", "home medications"],
+    "anesthesia": ["anesthesia", "anesthesiologist", "type of anesthesia"],
+    "staff": ["surgeon", "surgeons", "assistant", "assistants", "attending"],
+    "closing": ["estimated blood loss", "ebl", "complications", "drains", "fluids", "urine output",
+                "disposition", "condition", "plan"],
+}
+
+# Sections that carry the coded procedure; Index mining and prompts use only these
+HIGH_YIELD = ("procedure", "technique", "findings", "implants", "specimens")
+
+_ALIAS_TO_SECTION = {alias: name for name, aliases in SECTION_ALIASES.items() for alias in aliases}
+_HEADER_RE = re.compile(r"^[ \t]*([A-Za-z][A-Za-z /&\-()]{1,60}?)[ \t]*:", re.M)
+
+@dataclass
+class Section:
+    name: str      # canonical name ("procedure", "technique", ... / "other" / "preamble")
+    header: str    # header as written
+    start: int     # body offsets into the original note
+    end: int
+    text: str
+
+def _normalize_header(header: str) -> str:
+    h = re.sub(r"\(s\)", "s", header.lower())
+    return " ".join(re.findall(r"[a-z\-]+", h))
+
+def segment_note(text: str) -> List[Section]:
+    """Split an op note at header lines ("PROCEDURE PERFORMED:", "Findings:")."""
+    heads = []
+    for m in _HEADER_RE.finditer(text or ""):
+        header = m.group(1).strip()
+        name = _ALIAS_TO_SECTION.get(_normalize_header(header))
+        if name is None and header.isupper() and len(header) > 2:
+            name = "other"  # unknown all-caps header still ends the previous section
+        if name is not None:
+            heads.append((m.start(), m.end(), name, header))
+    sections: List[Section] = []
+    if not heads:
+        return [Section("preamble", "", 0, len(text or ""), text or "")]
+    if heads[0][0] > 0 and text[:heads[0][0]].strip():
+        sections.append(Section("preamble", "", 0, heads[0][0], text[:heads[0][0]]))
+    for i, (h_start, body_start, name, header) in enumerate(heads):
+        end = heads[i + 1][0] if i + 1 < len(heads) else len(text)
+        sections.append(Section(name, header, body_start, end, text[body_start:end]))
+    return sections
+
+def high_yield_text(text: str, names: Iterable[str] = HIGH_YIELD) -> str:
+    # Procedural sections only; notes without recognizable procedural headers are returned whole
+    wanted = set(names)
+    parts = [s.text.strip() for s in segment_note(text) if s.name in wanted and s.text.strip()]
+    return "\n".join(parts) if parts else (text or "")
@@ -1,52 +1,125 @@
 
 from __future__ import annotations
-from typing import Dict
-from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from dataclasses import dataclass, field
 from lxml import etree
-import io
+from rapidfuzz import process, fuzz
+import re
+
+AXIS_NAMES = {1: "Section", 2: "Body System", 3: "Operation", 4: "Body Part",
+              5: "Approach", 6: "Device", 7: "Qualifier"}
+
+def normalize_key(text: str) -> str:
+    # Case/punctuation-insensitive key: "Knee Joint, Left" -> "knee joint left"
+    return " ".join(re.findall(r"[a-z0-9]+", (text or "").lower()))
+
+def _text(el) -> str:
+    return " ".join("".join(el.itertext()).split()) if el is not None else ""
 
 @dataclass
+class Definition:
+    title: str
+    text: str = ""
+    section: str = ""      # section character, e.g. "0"
+    axis: int = 0          # axis position 1..7 (0 when unknown)
+    explanation: str = ""
+    includes: List[str] = field(default_factory=list)
+
 class PCSDefinitions:
-    # Minimal placeholder; real file can include operation definitions, etc.
-    ops: Dict[str, str]
+    """Definitions XML indexed by normalized key per (section, axis), by title and by includes."""
+
+    def __init__(self, terms: List[Definition]):
+        self.terms = terms
+        self.by_axis: Dict[Tuple[str, int], Dict[str, Definition]] = {}
+        self.by_key: Dict[str, List[Definition]] = {}
+        self.by_include: Dict[str, List[Definition]] = {}
+        for d in terms:
+            key = normalize_key(d.title)
+            self.by_axis.setdefault((d.section, d.axis), {}).setdefault(key, d)
+            self.by_key.setdefault(key, []).append(d)
+            for inc in d.includes:
+                self.by_include.setdefault(normalize_key(inc), []).append(d)
+        # Prebuilt, pre-normalized fuzzy corpus over titles + body text
+        self._corpus = [normalize_key(f"{d.title} {d.text} {d.explanation} {' '.join(d.includes)}") for d in terms]
 
     @classmethod
     def from_bytes(cls, xml_bytes: bytes) -> 'PCSDefinitions':
-        # Parse <axis pos="3"> Operation labels/definitions for tooltips.
-        ops = {}
-        ctx = etree.iterparse(io.BytesIO(xml_bytes), events=("end",))
-        current_pos = None
-        for ev, el in ctx:
-            tag = el.tag.split('}')[-1]
-            if tag == "axis":
+        # Official layout: <section code><axis pos><terms><title/><definition/><explanation/><includes/>...
+        root = etree.fromstring(xml_bytes)
+        terms: List[Definition] = []
+        for section in root.iter("section"):
+            sec = section.get("code") or ""
+            for axis in section.findall("axis"):
                 try:
-                    current_pos = int(el.get("pos"))
+                    pos = int(axis.get("pos"))
                 except Exception:
-                    current_pos = None
-            elif tag == "label" and current_pos == 3:
-                code = el.get("code")
-                text = (el.text or "").strip()
-                if code and text:
-                    ops[code] = text
-            el.clear()
-        return cls(ops)
+                    pos = 0
+                for t in axis.findall("terms"):
+                    title = (t.findtext("title") or "").strip()
+                    if not title:
+                        continue
+                    terms.append(Definition(
+                        title=title,
+                        text=_text(t.find("definition")),
+                        section=sec,
+                        axis=pos,
+                        explanation=_text(t.find("explanation")),
+                        includes=[_text(i) for i in t.findall("includes") if _text(i)],
+                    ))
+        if not terms:
+            # Unknown schema: harvest any node with a <definition> child in one pass
+            for node in root.iter():
+                def_el = node.find("definition") if isinstance(node.tag, str) else None
+                if def_el is None:
+                    continue
+                title = (node.findtext("title") or "").strip() or node.tag
+                text = _text(def_el)
+                if text:
+                    terms.append(Definition(title=title, text=text))
+        return cls(terms)
+
+    def lookup(self, section: str, axis: int, title: str) -> Optional[Definition]:
+        return self.by_axis.get((section, axis), {}).get(normalize_key(title))
+
+    def find_all(self, key: str) -> List[Definition]:
+        return self.by_key.get(normalize_key(key), [])
+
+    def find(self, key: str) -> Optional[str]:
+        for d in self.find_all(key):
+            if d.text:
+                return d.text
+        return None
+
+    def including(self, term: str) -> List[Definition]:
+        # Definitions whose <includes> list this term (e.g. anatomical synonyms of a body part)
+        return self.by_include.get(normalize_key(term), [])
+
+    def search(self, query: str, limit: int = 10, score_cutoff: int = 70) -> List[Tuple[Definition, int]]:
+        q = normalize_key(query)
+        if not q or not self._corpus:
+            return []
+        results = process.extract(q, self._corpus, scorer=fuzz.token_set_ratio, processor=None,
+                                  limit=limit, score_cutoff=score_cutoff)
+        return [(self.terms[idx], int(score)) for _, score, idx in results]
+
+    def axis_definitions(self, code: str, engine) -> List[Tuple[int, str, str, Optional[Definition]]]:
+        # (pos, char, table label, definition) for every axis of `code`
+        code = code.strip().upper()
+        labels = engine.axis_labels(code)
+        return [(pos, ch, label, self.lookup(code[0], pos, label))
+                for pos, (ch, label) in enumerate(zip(code, labels), 1)]
 
     def describe_code(self, code: str, engine) -> str:
-        # Decompose by axis and show labels; include op text if known
+        # Decompose by axis and show table labels plus definitions/includes when known
         code = code.strip().upper()
         if len(code) != 7:
             return "Needs 7 characters."
         parts = []
-        parts.append(f"Section {code[0]}: {engine._label(1, code[0])}")
-        parts.append(f"Body System {code[1]}: {engine._label(2, code[1])}")
-        op = engine._label(3, code[2])
-        op_more = self.ops.get(code[2])
-        if op_more and op_more != op:
-            parts.append(f"Operation {code[2]}: {op} — {op_more}")
-        else:
-            parts.append(f"Operation {code[2]}: {op}")
-        parts.append(f"Body Part {code[3]}: {engine._label(4, code[3])}")
-        parts.append(f"Approach {code[4]}: {engine._label(5, code[4])}")
-        parts.append(f"Device {code[5]}: {engine._label(6, code[5])}")
-        parts.append(f"Qualifier {code[6]}: {engine._label(7, code[6])}")
+        for pos, ch, label, d in self.axis_definitions(code, engine):
+            line = f"{AXIS_NAMES[pos]} {ch}: {label}"
+            if d and d.text and d.text != label:
+                line += f" — {d.text}"
+            if d and d.includes:
+                line += f" (includes: {', '.join(d.includes[:5])})"
+            parts.append(line)
         return "\n".join(parts)
@@ -0,0 +1,451 @@
+
+from __future__ import annotations
+from typing import Any, Callable, Collection, Dict, Iterator, List, Mapping, Optional, Sequence, Tuple
+from collections.abc import Mapping as MappingABC, Sequence as SequenceABC
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from pcs_tables_engine import TablesEngine, expand_sorted
+from pcs_index import IndexTree
+
+# Frozen engines keep their data in a handful of flat buffers (bytes and numpy
+# arrays) instead of millions of small Python objects. A lookup then only
+# touches the refcounts of those few buffer objects, so after a fork the
+# pages holding the data stay shared between workers instead of being
+# copied one refcount write at a time.
+
+CHARS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"  # axis value chars; one bit each in the row masks
+_BIT = {c: 1 << i for i, c in enumerate(CHARS)}
+
+class FrozenStrings(SequenceABC):
+    """Immutable list of strings in one UTF-8 buffer; items are decoded on access."""
+
+    def __init__(self, strings: Sequence[str]):
+        strings = list(strings)
+        lens = np.fromiter((len(s.encode("utf-8")) for s in strings), dtype=np.int64, count=len(strings))
+        self._blob = "\0".join(strings).encode("utf-8")  # XML text never holds NUL
+        self._starts = np.concatenate(([0], np.cumsum(lens + 1)[:-1])) if len(strings) else np.zeros(0, dtype=np.int64)
+        self._lens = lens
+
+    def __len__(self) -> int:
+        return len(self._lens)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        s = int(self._starts[i])
+        return self._blob[s:s + int(self._lens[i])].decode("utf-8")
+
+    def all(self) -> List[str]:
+        # Every string as a fresh (private, short-lived) list, in one C-level split
+        return self._blob.decode("utf-8").split("\0") if len(self) else []
+
+    def nbytes(self) -> int:
+        return len(self._blob) + self._starts.nbytes + self._lens.nbytes
+
+class FrozenMap(MappingABC):
+    """Read-only node id -> tuple map stored CSR-style: offsets per node into one flat values buffer."""
+
+    def __init__(self, data: Mapping[int, Sequence], n: int, ints: bool = False):
+        counts = np.zeros(n, dtype=np.int64)
+        for k, v in data.items():
+            counts[k] = len(v)
+        self._ptr = np.concatenate(([0], np.cumsum(counts)))
+        flat = [x for k in sorted(data) for x in data[k]]
+        self._values = np.asarray(flat, dtype=np.int32) if ints else FrozenStrings(flat)
+        self._ints = ints
+        self._keys = np.flatnonzero(counts)
+
+    def get(self, key: int, default: Any = None) -> Any:
+        if not 0 <= key < len(self._ptr) - 1:
+            return default
+        s, e = int(self._ptr[key]), int(self._ptr[key + 1])
+        if s == e:
+            return default
+        return tuple(self._values[s:e].tolist()) if self._ints else tuple(self._values[s:e])
+
+    def __getitem__(self, key: int) -> Tuple:
+        out = self.get(key)
+        if out is None:
+            raise KeyError(key)
+        return out
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._keys.tolist())
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+# ------------- Tables ------------------
+class FrozenTablesEngine(TablesEngine):
+    """TablesEngine over sorted fixed-width code records, answered by binary search.
+
+    Codes are 7-byte records in one buffer (numpy 'S7', sorted), so a prefix
+    is a [lo, hi) range from two searchsorted calls. Axis 1-3 labels are
+    sorted prefix keys; axis 4-7 labels resolve per table against per-row
+    char bitmasks, the same "first row that also holds the code's other
+    chars" rule as the trie engine. Nothing is memoized: the object never
+    changes after freeze(), so e.g. next_chars costs ~100 us per call where
+    the trie's memo answers in ~1 us.
+    """
+
+    def __init__(self, codes: np.ndarray, head_keys: np.ndarray, head_ids: np.ndarray, tables: np.ndarray,
+                 table_rows: np.ndarray, masks: np.ndarray, label_keys: np.ndarray, label_ids: np.ndarray,
+                 pool: FrozenStrings, nodes: int = 0):
+        self.codes = codes            # 'S7', sorted
+        self.head_keys = head_keys    # 'S3', sorted: "0" / "0S" / "0SR"
+        self.head_ids = head_ids
+        self.tables = tables          # 'S3', sorted table prefixes
+        self.table_rows = table_rows  # per table: [start, end) into the rows
+        self.masks = masks            # (rows, 4) uint64 char bitmasks for axes 4-7
+        self.label_keys = label_keys  # row * 512 + (pos - 4) * 128 + ord(ch), sorted
+        self.label_ids = label_ids
+        self.pool = pool
+        self.nodes = nodes
+
+    @classmethod
+    def freeze(cls, engine: TablesEngine) -> 'FrozenTablesEngine':
+        codes = engine.trie.expand("", limit=engine.trie.root.count)  # already sorted
+        head = sorted(engine.head.items())
+        tables = sorted(engine.rows)
+        masks, keys, ids, table_rows = [], [], [], []
+        for table in tables:
+            start = len(masks)
+            for row in engine.rows[table]:
+                r = len(masks)
+                masks.append([sum(_BIT.get(c, 0) for c in axis) for axis in row])
+                for i, axis in enumerate(row):
+                    for ch, lid in axis.items():
+                        keys.append(r * 512 + i * 128 + ord(ch))
+                        ids.append(lid)
+            table_rows.append((start, len(masks)))
+        order = np.argsort(np.asarray(keys, dtype=np.int64), kind="stable")
+        return cls(
+            codes=np.array([c.encode("ascii") for c in codes], dtype="S7"),
+            head_keys=np.array([k.encode("ascii") for k, _ in head], dtype="S3"),
+            head_ids=np.array([v for _, v in head], dtype=np.int32),
+            tables=np.array([t.encode("ascii") for t in tables], dtype="S3"),
+            table_rows=np.array(table_rows, dtype=np.int64).reshape(-1, 2),
+            masks=np.array(masks, dtype=np.uint64).reshape(-1, 4),
+            label_keys=np.asarray(keys, dtype=np.int64)[order],
+            label_ids=np.asarray(ids, dtype=np.int32)[order],
+            pool=FrozenStrings(engine.pool.strings),
+            nodes=engine.trie.nodes,
+        )
+
+    def _range(self, prefix: str) -> Tuple[int, int]:
+        key = prefix.encode("ascii", "replace")
+        lo = int(np.searchsorted(self.codes, key, "left"))
+        if len(key) == 7:
+            return lo, lo + int(lo < len(self.codes) and self.codes[lo] == key)
+        if len(key) > 7:
+            return lo, lo
+        return lo, int(np.searchsorted(self.codes, key + b"\xff", "left"))
+
+    def is_valid(self, code: str) -> bool:
+        code = code.strip().upper()
+        if len(code) != 7: return False
+        lo, hi = self._range(code)
+        return hi > lo
+
+    def is_potential_prefix(self, token: str) -> bool:
+        token = token.strip().upper()
+        if not (1 <= len(token) <= 7): return False
+        lo, hi = self._range(token)
+        return hi > lo
+
+    def count(self, prefix: str) -> int:
+        lo, hi = self._range(prefix.strip().upper())
+        return hi - lo
+
+    def expand(self, prefix: str, limit: int = 100, constraints: Optional[Dict[int, Collection[str]]] = None) -> List[str]:
+        prefix = prefix.strip().upper()
+        if constraints:
+            return expand_sorted(prefix, limit, constraints, self._chars, self._take)
+        return self._take(prefix, limit)
+
+    def _take(self, prefix: str, n: int) -> List[str]:
+        lo, hi = self._range(prefix)
+        return [c.decode("ascii") for c in self.codes[lo:min(hi, lo + n)].tolist()]
+
+    def _chars(self, prefix: str) -> List[str]:
+        # Sorted distinct next chars: hop from run to run by binary search instead of scanning the range
+        lo, hi = self._range(prefix)
+        pos, out = len(prefix), []
+        while lo < hi:
+            ch = chr(self.codes[lo][pos])
+            out.append(ch)
+            lo = self._range(prefix + ch)[1]
+        return out
+
+    def stats(self):
+        return {"nodes": self.nodes, "codes": len(self.codes), "labels": len(self.pool)}
+
+    def next_chars(self, prefix: str) -> List[Tuple[str, str, int]]:
+        prefix = prefix.strip().upper()
+        if len(prefix) >= 7:
+            return []
+        lo, hi = self._range(prefix)
+        if hi <= lo:
+            return []
+        pos = len(prefix) + 1
+        # Records in range share the prefix, so the next char is sorted: its runs are the options
+        col = self.codes[lo:hi].view(np.uint8).reshape(-1, 7)[:, pos - 1]
+        starts = np.concatenate(([0], np.flatnonzero(col[1:] != col[:-1]) + 1))
+        counts = np.diff(np.append(starts, len(col)))
+        return [(chr(col[s]), self._label(pos, chr(col[s]), prefix), int(n)) for s, n in zip(starts.tolist(), counts.tolist())]
+
+    def autocomplete(self, prefix: str, n: int = 10) -> Dict:
+        prefix = prefix.strip().upper()
+        count = self.count(prefix) if len(prefix) <= 7 else 0
+        if not count:
+            return {"prefix": prefix, "valid": False, "count": 0, "next": [], "completions": []}
+        return {
+            "prefix": prefix,
+            "valid": len(prefix) == 7,
+            "count": count,
+            "next": self.next_chars(prefix),
+            "completions": self.expand(prefix, limit=n),
+        }
+
+    def _label(self, pos: int, ch: str, code: str = "") -> str:
+        # Same resolution as the trie engine: first row of the table that also holds code's other chars
+        code = code.strip().upper()
+        if len(code) < min(pos - 1, 3):
+            return ch
+        if pos <= 3:
+            key = (code[:pos-1] + ch).encode("ascii", "replace")
+            i = int(np.searchsorted(self.head_keys, key))
+            found = i < len(self.head_keys) and self.head_keys[i] == key
+            return (self.pool[int(self.head_ids[i])] if found else "") or ch
+        t = int(np.searchsorted(self.tables, code[:3].encode("ascii", "replace")))
+        if ch not in _BIT or t >= len(self.tables) or self.tables[t] != code[:3].encode("ascii", "replace"):
+            return ch
+        s, e = self.table_rows[t].tolist()
+        masks = self.masks[s:e]
+        has = (masks[:, pos - 4] & np.uint64(_BIT[ch])) != 0
+        ok = has.copy()
+        for i, c in enumerate(code[3:7]):
+            if i != pos - 4:
+                ok &= (masks[:, i] & np.uint64(_BIT.get(c, 0))) != 0
+        hit = np.flatnonzero(ok)
+        if not len(hit):
+            hit = np.flatnonzero(has)
+        if not len(hit):
+            return ch
+        key = (s + int(hit[0])) * 512 + (pos - 4) * 128 + ord(ch)
+        j = int(np.searchsorted(self.label_keys, key))
+        return (self.pool[int(self.label_ids[j])] if j < len(self.label_keys) and self.label_keys[j] == key else "") or ch
+
+    def iter_axis_labels(self) -> Iterator[Tuple[str, int, str, str]]:
+        row_table = np.repeat(np.arange(len(self.tables)), np.diff(self.table_rows, axis=1).ravel())
+        for key, lid in zip(self.label_keys.tolist(), self.label_ids.tolist()):
+            row, rest = divmod(key, 512)
+            yield self.tables[row_table[row]].decode("ascii"), rest // 128 + 4, chr(rest % 128), self.pool[lid]
+
+    def nearest_explanations(self, token: str) -> str:
+        token = token.strip().upper()
+        if token and not self.is_potential_prefix(token):
+            return "Prefix not in tables; try a shorter start."
+        pos = len(token) + 1
+        opts = self.next_chars(token)
+        if not opts:
+            return "Prefix is a dead end per tables."
+        return "Next allowed chars → " + ", ".join(f"{pos}:{c}={label}" for c, label, _ in opts)
+
+    def nbytes(self) -> int:
+        arrays = (self.codes, self.head_keys, self.head_ids, self.tables, self.table_rows, self.masks,
+                  self.label_keys, self.label_ids)
+        return sum(a.nbytes for a in arrays) + self.pool.nbytes()
+
+# ------------- Index ------------------
+SEARCH_CACHE_SIZE = 2048  # memoized queries per worker process
+class FrozenIndexTree(IndexTree):
+    """IndexTree whose titles, paths and per-node code/use/see/ref maps live in flat buffers.
+
+    PCSIndex and IndexStore wrap it unchanged. Fuzzy search splits the
+    preprocessed paths out of one buffer per query (a short-lived private
+    list) instead of keeping 100k+ shared str objects; the TF-IDF retriever
+    is built before freezing and frozen with it.
+
+    That split is the price of sharing, as is FrozenTablesEngine.next_chars
+    recomputing what the trie memoizes (~100 us vs ~1 us): about 7 ms per
+    fuzzy query on a 68k-entry Index, next to ~100 ms for the rapidfuzz
+    scan itself. Repeated queries
+    skip both through `cache`, a SearchCache each process creates for
+    itself on first use (a cache shared across fork would un-share its
+    pages as it fills).
+    """
+
+    @classmethod
+    def freeze(cls, tree: IndexTree, retriever: bool = True) -> 'FrozenIndexTree':
+        n = len(tree.parent)
+        frozen = cls.__new__(cls)
+        frozen.titles = FrozenStrings(tree.titles)
+        frozen._title_ids = {}
+        frozen.parent, frozen.title_id, frozen.end, frozen.entries = tree.parent, tree.title_id, tree.end, tree.entries
+        frozen.codes = FrozenMap(tree.codes, n)
+        frozen.nested = FrozenMap(tree.nested, n)
+        frozen.uses = FrozenMap(tree.uses, n)
+        frozen.sees = FrozenMap(tree.sees, n)
+        frozen.refs = FrozenMap(tree.refs, n, ints=True)
+        frozen._pending = []
+        frozen._paths = FrozenStrings(tree.paths())
+        frozen._search_keys = FrozenStrings(tree.search_keys())
+        frozen._retriever = tree.retriever().freeze() if retriever else None
+        frozen._retriever_lock = tree._retriever_lock
+        frozen.fingerprint = tree.fingerprint
+        frozen._cache, frozen._cache_pid = None, None
+        return frozen
+
+    @property
+    def cache(self):
+        # Created lazily per process, so a forked worker never inherits (and dirties) the parent's
+        if self._cache_pid != os.getpid():
+            from search_cache import SearchCache
+            self._cache, self._cache_pid = SearchCache(maxsize=SEARCH_CACHE_SIZE), os.getpid()
+        return self._cache
+
+    @cache.setter
+    def cache(self, value):
+        self._cache, self._cache_pid = value, os.getpid()
+
+    def paths(self) -> FrozenStrings:
+        return self._paths
+
+    def search_keys(self) -> List[str]:
+        return self._search_keys.all()
+
+# ------------- Pre-fork ------------------
+def memory_usage(pid: str = "self") -> Dict[str, int]:
+    """Memory of a process in KiB from /proc/<pid>/smaps_rollup (Linux): rss, pss, shared and private pages."""
+    out: Dict[str, int] = {}
+    with open(f"/proc/{pid}/smaps_rollup") as fh:
+        for line in fh:
+            parts = line.split()
+            if len(parts) >= 3 and parts[-1] == "kB":
+                out[parts[0].rstrip(":").lower()] = int(parts[1])
+    out["shared"] = out.get("shared_clean", 0) + out.get("shared_dirty", 0)
+    out["private"] = out.get("private_clean", 0) + out.get("private_dirty", 0)
+    return out
+
+def freeze_heap():
+    # Collect once, then move every surviving object to the permanent generation:
+    # later collections in the children never write to their GC headers
+    gc.collect()
+    gc.freeze()
+
+def prefork(build: Callable[[], Any], worker: Callable[[Any, int], Any], workers: int = 4) -> List[int]:
+    """Build engines once in the parent, freeze the heap, fork `workers` children running worker(engines, i).
+
+    Returns the children's exit codes (0 unless worker raised). POSIX only.
+    """
+    engines = build()
+    freeze_heap()
+    pids = []
+    for i in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                worker(engines, i)
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+                code = 1
+            finally:
+                sys.stdout.flush()
+                os._exit(code)
+        pids.append(pid)
+    return [os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]) for pid in pids]
+
+def build_engines(tables_xml: Optional[bytes], index_xml: Optional[bytes], frozen: bool = True) -> Dict[str, Any]:
+    # {"tables": TablesEngine, "index": PCSIndex}, frozen unless asked for the plain in-memory ones
+    from pcs_index import PCSIndex
+    out: Dict[str, Any] = {}
+    if tables_xml:
+        engine = TablesEngine.from_bytes(tables_xml)
+        out["tables"] = FrozenTablesEngine.freeze(engine) if frozen else engine
+    if index_xml:
+        tree = IndexTree.from_bytes(index_xml)
+        tree.retriever()
+        out["index"] = PCSIndex(FrozenIndexTree.freeze(tree) if frozen else tree)
+    return out
+
+def measure(tables_xml: Optional[bytes], index_xml: Optional[bytes], notes: Sequence[str], workers: int = 4,
+            frozen: bool = True, rounds: int = 3) -> Dict:
+    """Private vs shared memory per forked worker after running lookups over `notes`.
+
+    Each child runs suggest_from_index (fuzzy and TF-IDF) plus typeahead
+    and explain over the suggested codes once to warm up, then `rounds`
+    more times, and reports smaps_rollup before/after through a pipe.
+    Private growth over those rounds is what lookups un-shared.
+    """
+    from suggest_from_index import suggest_from_index
+    t0 = time.perf_counter()
+    base = memory_usage()
+    read_fd, write_fd = os.pipe()
+
+    def work(engines, i):
+        os.close(read_fd)
+        engine, index = engines.get("tables"), engines.get("index")
+
+        def run_notes():
+            for note in notes:
+                for method in ("fuzzy", "tfidf"):
+                    codes = suggest_from_index(note, index, engine, retriever=method) if engine and index else []
+                    for c in codes[:10]:
+                        engine.explain(c)
+                        engine.next_chars(c[:3])
+
+        # One warm-up pass first: the allocator's own first-touch pages are not what we are measuring
+        run_notes()
+        gc.collect()
+        before = memory_usage()
+        for _ in range(rounds):
+            run_notes()
+        gc.collect()
+        after = memory_usage()
+        os.write(write_fd, (json.dumps({"worker": i, "before": before, "after": after}) + "\n").encode())
+        os.close(write_fd)
+
+    codes = prefork(lambda: build_engines(tables_xml, index_xml, frozen), work, workers)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as fh:
+        reports = [json.loads(line) for line in fh if line.strip()]
+    parent = memory_usage()
+    return {
+        "frozen": frozen, "workers": workers, "exit_codes": codes, "wall_s": round(time.perf_counter() - t0, 3),
+        "parent_rss_kib": parent["rss"], "engines_kib": parent["rss"] - base["rss"],
+        "per_worker": [{"worker": r["worker"], "rss_kib": r["after"]["rss"], "shared_kib": r["after"]["shared"],
+                        "private_kib": r["after"]["private"],
+                        "private_growth_kib": r["after"]["private"] - r["before"]["private"]}
+                       for r in sorted(reports, key=lambda r: r["worker"])],
+    }
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="Frozen engines: fork workers after one build and report shared vs private pages.")
+    ap.add_argument("--tables")
+    ap.add_argument("--index")
+    ap.add_argument("--workers", type=int, default=4)
+    ap.add_argument("--rounds", type=int, default=3)
+    ap.add_argument("--compare", action="store_true", help="also run with the plain (unfrozen) engines")
+    ap.add_argument("notes", nargs="*", help=".txt note files to run through each worker")
+    args = ap.parse_args(argv)
+    read = lambda p: open(p, "rb").read() if p else None
+    notes = [read(p).decode("utf-8", errors="ignore") for p in args.notes] or ["Left total knee arthroplasty, cemented."]
+    runs = [True, False] if args.compare else [True]
+    print(json.dumps([measure(read(args.tables), read(args.index), notes, args.workers, frozen, args.rounds)
+                      for frozen in runs], indent=2))
+
+if __name__ == "__main__":
+    main()
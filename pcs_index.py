@@ -1,62 +1,289 @@
 
 from __future__ import annotations
 from typing import List, Dict, Optional, Tuple
+from array import array
 from lxml import etree
-from rapidfuzz import process, fuzz
-import io
+from rapidfuzz import process, fuzz, utils
+import hashlib
+import re
+import threading
 
-class PCSIndex:
-    def __init__(self, items: List[Dict]):
-        # items: [{path, titles:[...], codes:[...]}]
-        self.items = items
-        self._keys = [" > ".join(it["titles"]) for it in items]
+from pcs_retrieval import DEFAULT_CUTOFF
+
+EMPTY: Tuple[str, ...] = ()
+
+def _norm(text: str) -> str:
+    return " ".join(re.findall(r"[a-z0-9]+", (text or "").lower()))
+
+class IndexTree:
+    """The Index XML as a preorder parent-pointer tree.
+
+    Node i has parent[i] (-1 for letters), title_id[i] into the interned
+    `titles` pool, and end[i] (one past its last descendant). Codes, `use`
+    and `see` text are kept in sparse dicts keyed by node. Entries are the
+    titled nodes below the letters; their " > "-joined paths are
+    materialized once, on first search.
+
+    `see`/`use` references are resolved at load time into `refs`, direct
+    node -> target node pointers, so callers can follow them in memory.
+
+    search() runs through `cache` (a SearchCache) when one is attached,
+    keyed by the XML `fingerprint`. method="tfidf" ranks with a
+    pcs_retrieval.TfidfRetriever built on first use instead of rapidfuzz.
+    """
+
+    def __init__(self):
+        self.titles: List[str] = []
+        self._title_ids: Dict[str, int] = {}
+        self.parent = array('i')
+        self.title_id = array('i')
+        self.end = array('i')
+        self.entries = array('i')  # node ids of searchable entries, in document order
+        self.codes: Dict[int, Tuple[str, ...]] = {}   # direct <code>/<codes> children
+        self.nested: Dict[int, Tuple[str, ...]] = {}  # codes inside this node's <see>/<use>
+        self.uses: Dict[int, Tuple[str, ...]] = {}
+        self.sees: Dict[int, Tuple[str, ...]] = {}
+        self.refs: Dict[int, Tuple[int, ...]] = {}    # resolved see/use targets
+        self._pending: List[Tuple[int, str]] = []     # (node, reference text) until resolved
+        self._paths: Optional[List[str]] = None
+        self._search_keys: Optional[List[str]] = None
+        self._retriever = None
+        self._retriever_lock = threading.Lock()  # notes may be coded concurrently
+        self.fingerprint = ""
+        self.cache = None  # optional search_cache.SearchCache
+
+    def _intern(self, text: str) -> int:
+        tid = self._title_ids.get(text)
+        if tid is None:
+            tid = self._title_ids[text] = len(self.titles)
+            self.titles.append(text)
+        return tid
+
+    def _add(self, el, parent: int, entry: bool) -> int:
+        node = len(self.parent)
+        title = (el.findtext("title") or "").strip()
+        self.parent.append(parent)
+        self.title_id.append(self._intern(title) if title else -1)
+        self.end.append(node + 1)
+        if title and entry:
+            self.entries.append(node)
+        codes, nested, uses, sees = [], [], [], []
+        for child in el:
+            tag = child.tag if isinstance(child.tag, str) else ""
+            if tag in ("code", "codes"):
+                if child.text and child.text.strip():
+                    codes.append(child.text.strip())
+            elif tag == "use":
+                if child.text and child.text.strip():
+                    uses.append(child.text.strip())
+                    self._pending.append((node, child.text))
+            elif tag == "see":
+                txt = "".join(child.itertext())  # element text plus any child text
+                if txt.strip():
+                    sees.append(txt)
+                    # leading text names the target ("Replacement, Lower Joints"); children hold codes
+                    self._pending.append((node, child.text or txt))
+            if tag in ("use", "see"):
+                nested.extend(c.text.strip() for c in child.iter("code", "codes") if c.text and c.text.strip())
+        if codes:
+            self.codes[node] = tuple(dict.fromkeys(codes))
+        if nested:
+            self.nested[node] = tuple(nested)
+        if uses:
+            self.uses[node] = tuple(uses)
+        if sees:
+            self.sees[node] = tuple(sees)
+        return node
 
     @classmethod
-    def from_bytes(cls, xml_bytes: bytes) -> 'PCSIndex':
-        # Walk the XML preserving hierarchy and capturing codes under each node
+    def from_bytes(cls, xml_bytes: bytes, cache=None) -> 'IndexTree':
         root = etree.fromstring(xml_bytes)
-        items: List[Dict] = []
-
-        def walk(node, titles):
-            # capture this node if it has a title
-            title_el = node.find("title")
-            my_title = title_el.text.strip() if title_el is not None and title_el.text else None
-            cur_titles = titles + ([my_title] if my_title else [])
-
-            # gather codes anywhere under this node's immediate level
-            codes = []
-            for el in node.findall("./code"):
-                if el.text: codes.append(el.text.strip())
-            for el in node.findall("./codes"):
-                if el.text: codes.append(el.text.strip())
-
-            # Only store if we have a title
-            if my_title:
-                items.append({
-                    "titles": cur_titles,
-                    "codes": list(dict.fromkeys(codes)),  # unique
-                })
-
-            # Recurse into child <term> nodes
-            for child in node.findall("term"):
-                walk(child, cur_titles)
-
+        tree = cls()
+        tree.fingerprint = hashlib.blake2b(xml_bytes, digest_size=16).hexdigest()
+        tree.cache = cache
+        # Iterative preorder walk: letter -> mainTerm -> term -> term ...
         for letter in root.findall("letter"):
-            letter_title = letter.findtext("title","").strip()
-            for main in letter.findall("mainTerm"):
-                walk(main, [letter_title])
+            lnode = tree._add(letter, -1, entry=False)
+            stack = [(main, lnode) for main in reversed(letter.findall("mainTerm"))]
+            open_nodes = [lnode]
+            while stack:
+                el, parent = stack.pop()
+                while open_nodes[-1] != parent:
+                    open_nodes.pop()
+                node = tree._add(el, parent, entry=True)
+                for anc in open_nodes:
+                    tree.end[anc] = node + 1
+                open_nodes.append(node)
+                stack.extend((child, node) for child in reversed(el.findall("term")))
+        tree._resolve_refs()
+        return tree
 
-        return cls(items)
+    def _resolve_refs(self):
+        # "Main Term, Subterm, ..." -> node, by normalized title under each parent
+        mains: Dict[str, int] = {}
+        children: Dict[int, Dict[str, int]] = {}
+        for node in self.entries:
+            p = self.parent[node]
+            key = _norm(self.title(node))
+            if self.parent[p] == -1:
+                mains.setdefault(key, node)
+            else:
+                children.setdefault(p, {}).setdefault(key, node)
+        refs: Dict[int, List[int]] = {}
+        for node, text in self._pending:
+            parts = [k for k in (_norm(x) for x in text.split(",")) if k]
+            target = mains.get(parts[0]) if parts else None
+            if target is None:
+                continue
+            for part in parts[1:]:
+                nxt = children.get(target, {}).get(part)
+                if nxt is None:
+                    break  # keep the deepest resolved ancestor
+                target = nxt
+            if target != node and target not in refs.get(node, ()):
+                refs.setdefault(node, []).append(target)
+        self.refs = {n: tuple(ts) for n, ts in refs.items()}
+        self._pending = []
 
-    def search(self, query: str, limit: int = 25, score_cutoff: int = 70) -> List[Dict]:
-        if not self.items or not query.strip():
-            return []
-        keys = [" > ".join(it["titles"]) for it in self.items]
-        results = process.extract(query, keys, scorer=fuzz.token_set_ratio, limit=limit, score_cutoff=score_cutoff)
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def title(self, node: int) -> str:
+        tid = self.title_id[node]
+        return self.titles[tid] if tid >= 0 else ""
+
+    def titles_of(self, node: int) -> List[str]:
         out = []
-        for text, score, idx in results:
-            it = dict(self.items[idx])
-            it["path"] = text
-            it["score"] = int(score)
-            out.append(it)
+        while node >= 0:
+            tid = self.title_id[node]
+            if tid >= 0:
+                out.append(self.titles[tid])
+            node = self.parent[node]
+        return out[::-1]
+
+    def paths(self) -> List[str]:
+        # One path string per entry, built top-down from the parent's path
+        if self._paths is None:
+            node_paths: List[str] = []
+            for node in range(len(self.parent)):
+                p = self.parent[node]
+                base = node_paths[p] if p >= 0 else ""
+                title = self.title(node)
+                node_paths.append(f"{base} > {title}" if base and title else (title or base))
+            self._paths = [node_paths[n] for n in self.entries]
+        return self._paths
+
+    def search_keys(self) -> List[str]:
+        # Paths pre-processed once (lowercase, punctuation stripped) so each search skips it
+        if self._search_keys is None:
+            self._search_keys = [utils.default_process(p) for p in self.paths()]
+        return self._search_keys
+
+    def retriever(self):
+        # Sparse TF-IDF index over entry paths + `use` synonyms, built once on first use
+        if self._retriever is None:
+            with self._retriever_lock:
+                if self._retriever is None:
+                    from pcs_retrieval import TfidfRetriever
+                    self._retriever = TfidfRetriever.from_tree(self)
+        return self._retriever
+
+    def search(self, query: str, limit: int = 25, score_cutoff: Optional[float] = None,
+               method: str = "fuzzy") -> List[Tuple[int, float]]:
+        # (entry position, score) for the best-matching entry paths
+        q = " ".join(utils.default_process(query or "").split())
+        if not q or not self.entries:
+            return []
+        if score_cutoff is None:
+            score_cutoff = 70 if method == "fuzzy" else DEFAULT_CUTOFF
+
+        def compute():
+            if method == "tfidf":
+                return self.retriever().search(q, limit=limit, score_cutoff=score_cutoff)
+            results = process.extract(q, self.search_keys(), scorer=fuzz.token_set_ratio, processor=None,
+                                      limit=limit, score_cutoff=score_cutoff)
+            return [(idx, score) for _, score, idx in results]
+
+        if self.cache is None:
+            return compute()
+        key = q if method == "fuzzy" else f"{method}:{q}"
+        return self.cache.get_or_compute(self.fingerprint, key, limit, score_cutoff, compute)
+
+    def search_many(self, queries: List[str], limit: int = 25, score_cutoff: Optional[float] = None,
+                    method: str = "fuzzy") -> List[List[Tuple[int, float]]]:
+        # TF-IDF scores the whole batch in one sparse product; fuzzy searches one query at a time
+        if method != "tfidf" or not self.entries:
+            return [self.search(q, limit, score_cutoff, method) for q in queries]
+        qs = [" ".join(utils.default_process(q or "").split()) for q in queries]
+        return self.retriever().search_many(qs, limit=limit, score_cutoff=DEFAULT_CUTOFF if score_cutoff is None else score_cutoff)
+
+    def subtree(self, node: int) -> range:
+        return range(node, self.end[node])
+
+    def follow(self, node: int, max_depth: int = 3) -> List[Tuple[int, int]]:
+        # (target, hops) reachable through see/use refs; the visited set guards against cycles
+        seen = {node}
+        out: List[Tuple[int, int]] = []
+        frontier = [node]
+        for depth in range(1, max_depth + 1):
+            nxt = []
+            for n in frontier:
+                for t in self.refs.get(n, EMPTY):
+                    if t not in seen:
+                        seen.add(t)
+                        out.append((t, depth))
+                        nxt.append(t)
+            frontier = nxt
+        return out
+
+    def referenced_codes(self, node: int, words: Optional[set] = None, max_depth: int = 3) -> List[Tuple[str, int, int]]:
+        """Codes reachable from `node` via see/use refs as (code, target node, hops).
+
+        Within a target, subterms are followed only while their titles share a
+        word with `words` (e.g. the note's tokens), so "Arthroscopy, see
+        Inspection" lands on "Inspection > Knee Joint > Left" for a left knee note.
+        """
+        out: List[Tuple[str, int, int]] = []
+        for target, depth in self.follow(node, max_depth):
+            ok = {target}
+            for n in range(target + 1, self.end[target]):
+                if self.parent[n] not in ok:
+                    continue
+                tid = self.title_id[n]
+                if tid < 0 or (words and words.intersection(_norm(self.titles[tid]).split())):
+                    ok.add(n)
+            for n in sorted(ok):
+                for c in self.codes.get(n, EMPTY) + self.nested.get(n, EMPTY):
+                    out.append((c, n, depth))
         return out
+
+class PCSIndex:
+    def __init__(self, tree: IndexTree):
+        self.tree = tree
+
+    @classmethod
+    def from_bytes(cls, xml_bytes: bytes, cache=None) -> 'PCSIndex':
+        return cls(IndexTree.from_bytes(xml_bytes, cache=cache))
+
+    def _hit(self, idx: int, score: float) -> Dict:
+        node = self.tree.entries[idx]
+        return {
+            "id": node,
+            "titles": self.tree.titles_of(node),
+            "codes": list(self.tree.codes.get(node, EMPTY)),
+            "path": self.tree.paths()[idx],
+            "score": int(score),
+        }
+
+    def search(self, query: str, limit: int = 25, score_cutoff: Optional[float] = None, method: str = "fuzzy") -> List[Dict]:
+        # method: "fuzzy" (rapidfuzz token_set_ratio) or "tfidf" (pcs_retrieval)
+        return [self._hit(idx, score) for idx, score in self.tree.search(query, limit, score_cutoff, method)]
+
+    def search_many(self, queries: List[str], limit: int = 25, score_cutoff: Optional[float] = None,
+                    method: str = "fuzzy") -> List[List[Dict]]:
+        return [[self._hit(idx, score) for idx, score in hits]
+                for hits in self.tree.search_many(queries, limit, score_cutoff, method)]
+
+    def referenced_codes(self, node: int, words: Optional[set] = None) -> List[Tuple[str, int, int]]:
+        # Codes from entries this hit points to via see/use (no extra searches)
+        return self.tree.referenced_codes(node, words)
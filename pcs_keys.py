@@ -0,0 +1,130 @@
+
+from __future__ import annotations
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+import re
+
+from pcs_tables_engine import TablesEngine
+
+# (section, body system, axis pos, axis char)
+AxisValue = Tuple[str, str, int, str]
+
+# Which axis each key file constrains
+KEY_AXES = {"body_part": 4, "device": 6, "device_agg": 6, "substance": 6}
+
+_END = ""  # terminal marker in the term automaton
+
+def _tokens(text: str) -> List[str]:
+    return re.findall(r"[a-z0-9]+", (text or "").lower())
+
+def _norm(text: str) -> str:
+    return " ".join(_tokens(text))
+
+def parse_key_md(md: bytes) -> List[Tuple[str, str, str]]:
+    """(term, PCS value, body system) rows from a key .md file.
+
+    Accepts markdown tables (2 columns: term | value; 4 columns like the
+    Device Aggregation Table: specific device | operation | body system |
+    general device) and plain "term: value" / "term -> value" lines.
+    "Use:" prefixes and "... in <Body System>" suffixes are split off.
+    """
+    out = []
+    for line in md.decode("utf-8", errors="ignore").splitlines():
+        line = line.strip()
+        if line.startswith("|"):
+            cells = [c.strip() for c in line.strip("|").split("|")]
+            if all(set(c) <= set("-: ") for c in cells):
+                continue  # separator row
+            if len(cells) >= 4:
+                term, value, body_system = cells[0], cells[3], cells[2]
+            elif len(cells) >= 2:
+                term, value, body_system = cells[0], cells[1], ""
+            else:
+                continue
+        else:
+            m = re.match(r"^[-*]?\s*(.+?)\s*(?:→|->|:|—)\s*(.+)$", line)
+            if not m:
+                continue
+            term, value, body_system = m.group(1), m.group(2), ""
+        value = re.sub(r"^use\b:?\s*", "", value, flags=re.I)
+        if not body_system and " in " in value:
+            value, body_system = value.split(" in ", 1)
+        term = term.strip("*_ ")
+        if term and value:
+            out.append((term, value.strip(), body_system.strip()))
+    return out
+
+class KeyMaps:
+    """Compiled term -> axis value maps with an exact-match automaton over note tokens."""
+
+    def __init__(self, terms: Dict[str, FrozenSet[AxisValue]]):
+        self.terms = terms
+        # Word-level trie over normalized terms; scanning a note is one pass of short walks
+        self._trie: Dict = {}
+        for term in terms:
+            node = self._trie
+            for tok in term.split():
+                node = node.setdefault(tok, {})
+            node[_END] = term
+
+    @classmethod
+    def compile(cls, engine: TablesEngine, keys: Optional[Dict[str, bytes]] = None, include_labels: bool = True) -> 'KeyMaps':
+        # keys: {"body_part": md bytes, "device": ..., "device_agg": ..., "substance": ...}
+        by_label: Dict[str, Set[AxisValue]] = {}
+        body_systems: Dict[str, str] = {}  # section + body system char -> normalized label
+        for table, pos, ch, label in engine.iter_axis_labels():
+            s, bs = table[0], table[1]
+            if s + bs not in body_systems:
+                body_systems[s + bs] = _norm(engine._label(2, bs, table))
+            by_label.setdefault(_norm(label), set()).add((s, bs, pos, ch))
+
+        terms: Dict[str, Set[AxisValue]] = {}
+        if include_labels:
+            # Body part and device labels are terms in their own right ("Knee Joint, Left")
+            for label, values in by_label.items():
+                if label and not label.startswith("no "):
+                    keep = {v for v in values if v[2] in (4, 6)}
+                    if keep:
+                        terms.setdefault(label, set()).update(keep)
+        for kind, data in (keys or {}).items():
+            if not data or kind not in KEY_AXES:
+                continue
+            pos = KEY_AXES[kind]
+            for term, value, body_system in parse_key_md(data):
+                values = {v for v in by_label.get(_norm(value), ()) if v[2] == pos}
+                if body_system:
+                    bs_key = _norm(body_system)
+                    values = {v for v in values if body_systems.get(v[0] + v[1]) == bs_key} or values
+                if values and _norm(term):
+                    terms.setdefault(_norm(term), set()).update(values)
+        return cls({t: frozenset(v) for t, v in terms.items()})
+
+    def match(self, text: str) -> List[Tuple[str, FrozenSet[AxisValue]]]:
+        # Longest exact term match at every token position
+        toks = _tokens(text)
+        found: Dict[str, FrozenSet[AxisValue]] = {}
+        for i in range(len(toks)):
+            node = self._trie
+            last = None
+            for tok in toks[i:]:
+                node = node.get(tok)
+                if node is None:
+                    break
+                last = node.get(_END, last)
+            if last is not None:
+                found[last] = self.terms[last]
+        return list(found.items())
+
+    @staticmethod
+    def constraints(matches: Iterable[Tuple[str, FrozenSet[AxisValue]]], prefix: str) -> Dict[int, Set[str]]:
+        # Axis pos -> allowed chars for codes under `prefix` (same section and body system)
+        out: Dict[int, Set[str]] = {}
+        if len(prefix) < 2:
+            return out
+        for _, values in matches:
+            for s, bs, pos, ch in values:
+                if s == prefix[0] and bs == prefix[1]:
+                    out.setdefault(pos, set()).add(ch)
+        return out
+
+    def stats(self) -> Dict:
+        return {"terms": len(self.terms)}
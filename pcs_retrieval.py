@@ -0,0 +1,215 @@
+
+from __future__ import annotations
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+import argparse
+import hashlib
+import json
+import math
+import re
+import time
+
+import numpy as np
+
+DEFAULT_CUTOFF = 20.0  # cosine x 100; TF-IDF scores run well below fuzzy ratios
+
+def _words(text: str) -> List[str]:
+    return re.findall(r"[a-z0-9]+", (text or "").lower())
+
+def features(text: str, char_n: Tuple[int, ...] = (3, 4)) -> Tuple[List[str], List[str]]:
+    """(word features, char features): word unigrams + bigrams, and char n-grams inside padded words."""
+    toks = _words(text)
+    words = toks + [f"{a} {b}" for a, b in zip(toks, toks[1:])]
+    chars = []
+    for t in toks:
+        padded = f" {t} "
+        for n in char_n:
+            chars.extend(padded[i:i+n] for i in range(len(padded) - n + 1))
+    return words, chars
+
+def _term_hash(space: int, feature: str) -> int:
+    # Stable across processes (unlike hash()); collisions at 64 bits are negligible for Index-sized vocabularies
+    return int.from_bytes(hashlib.blake2b(f"{space}:{feature}".encode("utf-8"), digest_size=8).digest(), "little")
+
+class TfidfRetriever:
+    """Sparse TF-IDF retrieval over Index entries (title paths plus `use` synonyms).
+
+    Word and character n-gram spaces are weighted separately (sublinear tf,
+    smoothed idf, L2-normalized per space) and stored as term -> posting
+    arrays, i.e. the document-term matrix in CSC form. A batch of queries is
+    scored with one sparse product (a weighted bincount over the postings of
+    the query terms), then top-k per query via argpartition.
+    Scores are alpha * cos(word) + (1 - alpha) * cos(char), scaled to 0..100.
+    """
+
+    def __init__(self, docs: Sequence[str], alpha: float = 0.6):
+        self.alpha = alpha
+        self.n_docs = len(docs)
+        self.vocab: Optional[Dict[Tuple[int, str], int]] = {}
+        rows: List[Tuple[int, int, float]] = []  # (term, doc, tf weight)
+        spaces: Dict[int, int] = {}  # term -> 0 (word) / 1 (char)
+        for d, text in enumerate(docs):
+            for space, feats in enumerate(features(text)):
+                counts: Dict[int, int] = {}
+                for f in feats:
+                    tid = self.vocab.get((space, f))
+                    if tid is None:
+                        tid = self.vocab[(space, f)] = len(self.vocab)
+                        spaces[tid] = space
+                    counts[tid] = counts.get(tid, 0) + 1
+                rows.extend((tid, d, 1.0 + math.log(c)) for tid, c in counts.items())
+        terms = np.fromiter((r[0] for r in rows), dtype=np.int32, count=len(rows))
+        doc_ids = np.fromiter((r[1] for r in rows), dtype=np.int32, count=len(rows))
+        weights = np.fromiter((r[2] for r in rows), dtype=np.float32, count=len(rows))
+        self.space = np.fromiter((spaces[t] for t in range(len(self.vocab))), dtype=np.int8, count=len(self.vocab))
+        df = np.bincount(terms, minlength=len(self.vocab))
+        self.idf = (np.log((1.0 + self.n_docs) / (1.0 + df)) + 1.0).astype(np.float32)
+        weights *= self.idf[terms]
+        # L2-normalize each document within each space, then apply the space weight
+        scale = np.array([alpha, 1.0 - alpha], dtype=np.float32)
+        for s in (0, 1):
+            mask = self.space[terms] == s
+            norms = np.sqrt(np.bincount(doc_ids[mask], weights=weights[mask] ** 2, minlength=self.n_docs))
+            norms[norms == 0] = 1.0
+            weights[mask] = weights[mask] / norms[doc_ids[mask]] * scale[s]
+        order = np.argsort(terms, kind="stable")
+        self.doc_ids = doc_ids[order]
+        self.weights = weights[order]
+        self.ptr = np.zeros(len(self.vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(terms, minlength=len(self.vocab)), out=self.ptr[1:])
+        self.n_terms = len(self.vocab)
+        self._hashes: Optional[np.ndarray] = None  # set by freeze()
+        self._hash_ids: Optional[np.ndarray] = None
+
+    @classmethod
+    def from_tree(cls, tree, alpha: float = 0.6) -> 'TfidfRetriever':
+        # One document per searchable Index entry, in entry order (so results are entry positions)
+        paths = tree.paths()
+        docs = [" ".join((paths[i],) + tree.uses.get(node, ())) for i, node in enumerate(tree.entries)]
+        return cls(docs, alpha=alpha)
+
+    def freeze(self) -> 'TfidfRetriever':
+        """Swap the term dict for a sorted array of 64-bit term hashes (numpy buffers only).
+
+        Lookups then touch no per-term Python objects, so the pages stay
+        shared between forked workers (see pcs_frozen). Irreversible.
+        """
+        if self.vocab is not None:
+            keys = np.fromiter((_term_hash(space, f) for space, f in self.vocab), dtype=np.uint64, count=len(self.vocab))
+            order = np.argsort(keys)
+            self._hashes = keys[order]
+            self._hash_ids = np.fromiter(self.vocab.values(), dtype=np.int64, count=len(self.vocab))[order]
+            self.vocab = None
+        return self
+
+    def _term_ids(self, space: int, feats: List[str]) -> List[int]:
+        if self.vocab is not None:
+            return [tid for tid in (self.vocab.get((space, f)) for f in feats) if tid is not None]
+        if not feats or not len(self._hashes):
+            return []
+        h = np.fromiter((_term_hash(space, f) for f in feats), dtype=np.uint64, count=len(feats))
+        pos = np.minimum(np.searchsorted(self._hashes, h), len(self._hashes) - 1)
+        return self._hash_ids[pos[self._hashes[pos] == h]].tolist()
+
+    def _query(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        # Known query term ids and their normalized, space-weighted tf-idf
+        ids, vals = [], []
+        for space, feats in enumerate(features(text)):
+            counts: Dict[int, int] = {}
+            for tid in self._term_ids(space, feats):
+                counts[tid] = counts.get(tid, 0) + 1
+            if not counts:
+                continue
+            t = np.fromiter(counts, dtype=np.int64, count=len(counts))
+            w = (1.0 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))) * self.idf[t]
+            ids.append(t)
+            vals.append(w / np.linalg.norm(w))
+        if not ids:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        return np.concatenate(ids), np.concatenate(vals)
+
+    def scores(self, queries: Sequence[str]) -> np.ndarray:
+        """(len(queries), n_docs) cosine matrix, computed as one sparse product."""
+        out_rows, out_w = [], []
+        for q, text in enumerate(queries):
+            ids, vals = self._query(text)
+            if not len(ids):
+                continue
+            starts, ends = self.ptr[ids], self.ptr[ids + 1]
+            lens = ends - starts
+            # Gather every posting of every query term in one go
+            idx = np.repeat(starts - np.cumsum(np.concatenate(([0], lens[:-1]))), lens) + np.arange(lens.sum())
+            out_rows.append(self.doc_ids[idx].astype(np.int64) + q * self.n_docs)
+            out_w.append(self.weights[idx] * np.repeat(vals, lens))
+        total = len(queries) * self.n_docs
+        if not out_rows:
+            return np.zeros((len(queries), self.n_docs), dtype=np.float64)
+        flat = np.bincount(np.concatenate(out_rows), weights=np.concatenate(out_w), minlength=total)
+        return flat.reshape(len(queries), self.n_docs)
+
+    def search_many(self, queries: Sequence[str], limit: int = 25, score_cutoff: float = DEFAULT_CUTOFF,
+                    chunk: int = 32) -> List[List[Tuple[int, float]]]:
+        # Top-k (entry position, score 0..100) per query; queries are scored `chunk` at a time to bound memory
+        results: List[List[Tuple[int, float]]] = []
+        for i in range(0, len(queries), chunk):
+            block = self.scores(queries[i:i+chunk]) * 100.0
+            for row in block:
+                k = min(limit, len(row))
+                if k <= 0:
+                    results.append([])
+                    continue
+                top = np.argpartition(-row, k - 1)[:k]
+                top = top[np.lexsort((top, -row[top]))]
+                results.append([(int(d), round(float(row[d]), 2)) for d in top if row[d] >= score_cutoff and row[d] > 0])
+        return results
+
+    def search(self, query: str, limit: int = 25, score_cutoff: float = DEFAULT_CUTOFF) -> List[Tuple[int, float]]:
+        return self.search_many([query], limit=limit, score_cutoff=score_cutoff)[0]
+
+    def stats(self) -> Dict:
+        return {"docs": self.n_docs, "terms": self.n_terms, "postings": int(len(self.doc_ids))}
+
+# ------------- Benchmark ------------------
+def benchmark(index_xml: bytes, notes: Iterable[str], tables_xml: Optional[bytes] = None, topk: int = 10) -> Dict:
+    """Fuzzy vs TF-IDF on the same notes: build and query time, top-k hit overlap and, with Tables, code overlap."""
+    from pcs_index import PCSIndex
+    from note_cache import note_sentences
+    index = PCSIndex.from_bytes(index_xml)
+    notes = list(notes)
+    t0 = time.perf_counter()
+    index.tree.retriever()
+    report: Dict = {"notes": len(notes), "tfidf_build_s": round(time.perf_counter() - t0, 3), **index.tree.retriever().stats()}
+    hits = {}
+    for method in ("fuzzy", "tfidf"):
+        t0 = time.perf_counter()
+        hits[method] = [[{h["id"] for h in index.search(s, limit=topk, method=method)} for s in note_sentences(n)]
+                        for n in notes]
+        report[f"{method}_query_s"] = round(time.perf_counter() - t0, 3)
+    pairs = [(a, b) for na, nb in zip(hits["fuzzy"], hits["tfidf"]) for a, b in zip(na, nb) if a or b]
+    report["sentence_hit_jaccard"] = round(sum(len(a & b) / len(a | b) for a, b in pairs) / len(pairs), 3) if pairs else None
+    if tables_xml:
+        from pcs_tables_engine import TablesEngine
+        from suggest_from_index import suggest_from_index
+        engine = TablesEngine.from_bytes(tables_xml)
+        overlaps = []
+        for method in ("fuzzy", "tfidf"):
+            t0 = time.perf_counter()
+            codes = [suggest_from_index(n, index, engine, retriever=method)[:topk] for n in notes]
+            report[f"{method}_suggest_s"] = round(time.perf_counter() - t0, 3)
+            overlaps.append(codes)
+        pairs = [(set(a), set(b)) for a, b in zip(*overlaps) if a or b]
+        report[f"top{topk}_code_jaccard"] = round(sum(len(a & b) / len(a | b) for a, b in pairs) / len(pairs), 3) if pairs else None
+    return report
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="Compare rapidfuzz and TF-IDF Index retrieval on a set of notes.")
+    ap.add_argument("--index", required=True)
+    ap.add_argument("--tables")
+    ap.add_argument("--topk", type=int, default=10)
+    ap.add_argument("notes", nargs="+", help=".txt note files")
+    args = ap.parse_args(argv)
+    read = lambda p: open(p, "rb").read()
+    notes = [read(p).decode("utf-8", errors="ignore") for p in args.notes]
+    print(json.dumps(benchmark(read(args.index), notes, read(args.tables) if args.tables else None, args.topk), indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+
+from __future__ import annotations
+from typing import Any, Collection, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+from dataclasses import asdict, dataclass
+
+import numpy as np
+
+@dataclass
+class Weights:
+    """Linear weights over candidate features; score = sum(weight * feature)."""
+    index_score: float = 1.0   # Index match score / 100
+    depth: float = 0.01        # per level of the matched Index path (more specific entries)
+    hint_match: float = 0.02   # per axis where the code agrees with note hints / key-file constraints
+    exact: float = 0.2         # full 7-char code on the Index entry (vs. expanded from a partial code)
+    hops: float = -0.05        # per see/use hop between the matched entry and the code's entry
+    llm: float = 0.5           # LLM confidence 0..1 (0 when no model was asked)
+
+FEATURES = tuple(asdict(Weights()))
+
+def hint_matches(codes: Sequence[str], hints: Optional[Mapping[int, Collection[str]]]) -> np.ndarray:
+    # Per code: number of hinted axes (pos -> allowed chars) whose char agrees
+    out = np.zeros(len(codes), dtype=np.int8)
+    if not hints or not codes:
+        return out
+    chars = np.frombuffer("".join(c.ljust(7)[:7] for c in codes).encode("ascii", "replace"), dtype=np.uint8).reshape(-1, 7)
+    for pos, allowed in hints.items():
+        if 1 <= pos <= 7 and allowed:
+            lut = np.zeros(256, dtype=bool)
+            lut[[ord(ch) for ch in allowed if len(ch) == 1 and ord(ch) < 256]] = True
+            out += lut[chars[:, pos - 1]]
+    return out
+
+class CandidateSet:
+    """Candidates as columnar arrays, one row per (code, evidence) occurrence.
+
+    Rows are appended in batches (a hit's exact codes, or one partial code's
+    expansions) and frozen into numpy columns on first scoring. A code's
+    score is the best of its rows under `Weights`; top() selects with
+    partial selection and sorts only the k winners. `meta` keeps an optional
+    provenance object per row (e.g. why/evidence).
+    """
+
+    def __init__(self):
+        self.codes: List[str] = []
+        self._code_ids: Dict[str, int] = {}
+        self._cols: Dict[str, list] = {f: [] for f in ("code",) + FEATURES}
+        self.meta: List[Any] = []
+        self._arrays: Optional[Dict[str, np.ndarray]] = None
+
+    def __len__(self) -> int:
+        return len(self.meta)
+
+    def _id(self, code: str) -> int:
+        cid = self._code_ids.get(code)
+        if cid is None:
+            cid = self._code_ids[code] = len(self.codes)
+            self.codes.append(code)
+        return cid
+
+    def add(self, codes: Sequence[str], index_score: float, depth: int = 0, exact: bool = False, hops: int = 0,
+            hints: Optional[Mapping[int, Collection[str]]] = None, llm: Optional[Sequence[float]] = None,
+            meta: Any = None, hint_match: Optional[int] = None):
+        """Append rows for `codes` sharing one evidence source (`hint_match` overrides counting `hints`)."""
+        if not codes:
+            return
+        n = len(codes)
+        self._arrays = None
+        c = self._cols
+        c["code"].extend(self._id(code) for code in codes)
+        c["index_score"].extend([index_score / 100.0] * n)
+        c["depth"].extend([depth] * n)
+        c["hint_match"].extend([hint_match] * n if hint_match is not None else hint_matches(codes, hints).tolist())
+        c["exact"].extend([1.0 if exact else 0.0] * n)
+        c["hops"].extend([hops] * n)
+        c["llm"].extend(llm if llm is not None else [0.0] * n)
+        self.meta.extend([meta] * n)
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        if self._arrays is None:
+            self._arrays = {f: np.asarray(v, dtype=np.int32 if f == "code" else np.float32) for f, v in self._cols.items()}
+        return self._arrays
+
+    def row_scores(self, weights: Optional[Weights] = None) -> np.ndarray:
+        w = weights or Weights()
+        a = self.arrays()
+        # (rows x features) @ (features,) in one product
+        X = np.stack([a[f] for f in FEATURES], axis=1)
+        return X @ np.asarray([getattr(w, f) for f in FEATURES], dtype=np.float32)
+
+    def code_scores(self, weights: Optional[Weights] = None) -> Tuple[np.ndarray, np.ndarray]:
+        # (best score per code id, the row that achieved it)
+        rows = self.row_scores(weights)
+        code = self.arrays()["code"]
+        best = np.full(len(self.codes), -np.inf, dtype=np.float32)
+        np.maximum.at(best, code, rows)
+        # First row (in insertion order) reaching each code's best score
+        hit = np.flatnonzero(rows == best[code])
+        best_row = np.full(len(self.codes), len(rows), dtype=np.int64)
+        np.minimum.at(best_row, code[hit], hit)
+        return best, best_row
+
+    def scores(self, weights: Optional[Weights] = None) -> Dict[str, float]:
+        best, _ = self.code_scores(weights)
+        return dict(zip(self.codes, best.tolist()))
+
+    def top(self, k: Optional[int] = None, weights: Optional[Weights] = None) -> List[Tuple[str, float, int]]:
+        """Best `k` codes as (code, score, winning row), highest first, ties by code.
+
+        The row indexes `meta` and features() for provenance.
+        """
+        if not self.codes:
+            return []
+        best, best_row = self.code_scores(weights)
+        ids = top_k_ids(best, k, self.codes)
+        return [(self.codes[i], float(best[i]), int(best_row[i])) for i in ids]
+
+    def features(self, row: int) -> Dict[str, float]:
+        a = self.arrays()
+        return {f: float(a[f][row]) for f in FEATURES}
+
+def top_k_ids(scores: np.ndarray, k: Optional[int], names: Sequence[str]) -> List[int]:
+    # argpartition to the k best, then sort only those (score desc, name asc)
+    n = len(scores)
+    if k is None or k >= n:
+        cand = np.arange(n)
+    elif k <= 0:
+        return []
+    else:
+        # k-th best score by partial selection; keep everything tied with it so name tie-breaks stay exact
+        kth = -np.partition(-scores, k - 1)[k - 1]
+        cand = np.flatnonzero(scores >= kth)
+    # Ties break by name; only the candidates' names are looked at
+    order = cand[np.lexsort((np.array([names[i] for i in cand]), -scores[cand]))]
+    return order[:k].tolist() if k is not None else order.tolist()
+
+def top_k(scored: Mapping[str, float], k: int) -> List[Tuple[str, float]]:
+    # Top-k of a code -> score map without sorting all of it
+    if not scored:
+        return []
+    names = list(scored)
+    vals = np.fromiter(scored.values(), dtype=np.float64, count=len(names))
+    return [(names[i], float(vals[i])) for i in top_k_ids(vals, k, names)]
+
+def from_suggestions(suggestions: Iterable[Mapping[str, Any]], llm: Optional[Mapping[str, float]] = None) -> CandidateSet:
+    # Rebuild a CandidateSet from suggestion dicts carrying "features" (e.g. to re-rank with LLM confidence)
+    cands = CandidateSet()
+    for s in suggestions:
+        f = s.get("features") or {}
+        cands.add([s["code"]], index_score=f.get("index_score", s.get("confidence", 0)) * 100.0,
+                  depth=int(f.get("depth", 0)), exact=bool(f.get("exact", 0)), hops=int(f.get("hops", 0)),
+                  llm=[(llm or {}).get(s["code"], f.get("llm", 0.0))], meta=s, hint_match=int(f.get("hint_match", 0)))
+    return cands
+
+def rerank_with_llm(suggestions: Sequence[Mapping[str, Any]], llm_items: Iterable[Mapping[str, Any]],
+                    weights: Optional[Weights] = None) -> List[Dict[str, Any]]:
+    """Suggestions the model returned, re-ranked with its confidence as the `llm` feature.
+
+    `llm_items` are the model's {code, confidence, why, evidence} objects;
+    codes we did not propose are ignored, as are repeats. Confidence is
+    the score rescaled to 0..1 (capped at 0.99).
+    """
+    by_code = {s.get("code"): s for s in suggestions}
+    final, llm_conf = [], {}
+    for item in llm_items:
+        code = item.get("code") if isinstance(item, Mapping) else None
+        if code in by_code and code not in llm_conf:
+            try:
+                llm_conf[code] = float(item.get("confidence", 0))
+            except (TypeError, ValueError):
+                llm_conf[code] = 0.0
+            final.append({**by_code[code], "llm_confidence": llm_conf[code],
+                          "why": item.get("why", ""), "evidence": item.get("evidence", [])})
+    cands = from_suggestions(final, llm=llm_conf)
+    scale = 1.0 + (weights or Weights()).llm  # keep confidences in 0..1 with the LLM term added
+    return [{**cands.meta[row], "score": score, "confidence": round(min(0.99, max(0.0, score / scale)), 4),
+             "features": cands.features(row)} for code, score, row in cands.top(weights=weights)]
@@ -0,0 +1,436 @@
+
+from __future__ import annotations
+from typing import Collection, Dict, Iterator, List, Optional, Tuple
+from contextlib import contextmanager
+from pathlib import Path
+from rapidfuzz import process, fuzz, utils
+import argparse
+import hashlib
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
+
+from pcs_tables_engine import TablesEngine, expand_sorted
+from pcs_index import IndexTree, EMPTY, _norm
+from pcs_definitions import Definition, PCSDefinitions, normalize_key
+from note_cache import LRUCache
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE labels (id INTEGER PRIMARY KEY, text TEXT NOT NULL);
+CREATE TABLE head (prefix TEXT PRIMARY KEY, label INTEGER NOT NULL) WITHOUT ROWID;
+CREATE TABLE codes (code TEXT PRIMARY KEY) WITHOUT ROWID;
+CREATE TABLE rows (id INTEGER PRIMARY KEY, tbl TEXT NOT NULL, a4 TEXT, a5 TEXT, a6 TEXT, a7 TEXT);
+CREATE INDEX rows_tbl ON rows (tbl, id);
+CREATE TABLE row_labels (row INTEGER, pos INTEGER, ch TEXT, label INTEGER, PRIMARY KEY (row, pos, ch)) WITHOUT ROWID;
+CREATE INDEX row_labels_ch ON row_labels (pos, ch);
+CREATE TABLE nodes (id INTEGER PRIMARY KEY, parent INTEGER, title TEXT, end_ INTEGER,
+                    codes TEXT, nested TEXT, uses TEXT, sees TEXT);
+CREATE TABLE refs (node INTEGER, target INTEGER, PRIMARY KEY (node, target)) WITHOUT ROWID;
+CREATE TABLE entries (pos INTEGER PRIMARY KEY, node INTEGER NOT NULL);
+CREATE VIRTUAL TABLE index_fts USING fts5 (path);
+CREATE TABLE defs (id INTEGER PRIMARY KEY, title TEXT, text TEXT, section TEXT, axis INTEGER,
+                   explanation TEXT, includes TEXT, key TEXT);
+CREATE INDEX defs_axis ON defs (section, axis, key);
+CREATE INDEX defs_key ON defs (key);
+CREATE TABLE includes (key TEXT, def INTEGER);
+CREATE INDEX includes_key ON includes (key);
+CREATE VIRTUAL TABLE defs_fts USING fts5 (body);
+"""
+
+def _digest(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def _range(prefix: str) -> Tuple[str, str]:
+    # Codes are [0-9A-Z]; "~" sorts after all of them
+    return prefix, prefix + "~"
+
+def _fts_query(text: str, max_terms: int = 64) -> str:
+    # OR of quoted prefix terms; FTS5 only narrows candidates, rapidfuzz does the scoring
+    toks = list(dict.fromkeys(re.findall(r"\w+", (text or "").lower())))[:max_terms]
+    return " OR ".join(f'"{t}"*' for t in toks)
+
+# ------------- Compile ------------------
+def compile_db(path: str, tables_xml: Optional[bytes] = None, index_xml: Optional[bytes] = None,
+               defs_xml: Optional[bytes] = None) -> Dict[str, str]:
+    """Compile the official XMLs into one SQLite file at `path`.
+
+    Parsing reuses the in-memory loaders, so compiling needs the usual memory
+    once; readers of the result don't. The file is written next to `path` and
+    renamed into place, so processes reading an older store never see a
+    half-written one.
+    """
+    tmp = path + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    con = sqlite3.connect(tmp)
+    con.executescript(SCHEMA)
+    meta: Dict[str, str] = {"format": "1"}
+
+    if tables_xml:
+        engine = TablesEngine.from_bytes(tables_xml)
+        con.executemany("INSERT INTO labels VALUES (?, ?)", enumerate(engine.pool.strings))
+        con.executemany("INSERT INTO head VALUES (?, ?)", engine.head.items())
+        con.executemany("INSERT INTO codes VALUES (?)", ((c,) for c in engine.trie.expand("", limit=engine.trie.root.count)))
+        row_id = 0
+        for table, rows in engine.rows.items():
+            for row in rows:
+                con.execute("INSERT INTO rows VALUES (?, ?, ?, ?, ?, ?)", (row_id, table, *("".join(sorted(axis)) for axis in row)))
+                con.executemany("INSERT INTO row_labels VALUES (?, ?, ?, ?)",
+                                ((row_id, i + 4, ch, lid) for i, axis in enumerate(row) for ch, lid in axis.items()))
+                row_id += 1
+        meta.update(tables=_digest(tables_xml), nodes=str(engine.trie.nodes), codes=str(engine.trie.root.count))
+        del engine
+
+    if index_xml:
+        tree = IndexTree.from_bytes(index_xml)
+        con.executemany("INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (
+            (n, tree.parent[n], tree.title(n), tree.end[n], " ".join(tree.codes.get(n, EMPTY)),
+             " ".join(tree.nested.get(n, EMPTY)), "\n".join(tree.uses.get(n, EMPTY)), "\n".join(tree.sees.get(n, EMPTY)))
+            for n in range(len(tree.parent))))
+        con.executemany("INSERT INTO refs VALUES (?, ?)", ((n, t) for n, ts in tree.refs.items() for t in ts))
+        con.executemany("INSERT INTO entries VALUES (?, ?)", enumerate(tree.entries))
+        con.executemany("INSERT INTO index_fts (rowid, path) VALUES (?, ?)", enumerate(tree.paths()))
+        con.execute("INSERT INTO index_fts (index_fts) VALUES ('optimize')")
+        meta.update(index=tree.fingerprint, entries=str(len(tree.entries)))
+        del tree
+
+    if defs_xml:
+        defs = PCSDefinitions.from_bytes(defs_xml)
+        for i, d in enumerate(defs.terms):
+            con.execute("INSERT INTO defs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (i, d.title, d.text, d.section, d.axis, d.explanation, "\n".join(d.includes), normalize_key(d.title)))
+            con.executemany("INSERT INTO includes VALUES (?, ?)", ((normalize_key(inc), i) for inc in d.includes))
+        con.executemany("INSERT INTO defs_fts (rowid, body) VALUES (?, ?)", enumerate(defs._corpus))
+        meta.update(definitions=_digest(defs_xml), terms=str(len(defs.terms)))
+        del defs
+
+    con.executemany("INSERT INTO meta VALUES (?, ?)", meta.items())
+    con.commit()
+    con.execute("VACUUM")
+    con.close()
+    os.replace(tmp, path)
+    return meta
+
+# ------------- Read-only connection pool ------------------
+class ReadPool:
+    """Bounded pool of read-only connections to one store, shared across threads.
+
+    Connections open with mode=ro and query_only, so any number of processes
+    (other app workers, CLI tools) can read the same file concurrently.
+    """
+
+    def __init__(self, path: str, size: int = 4, cache_kib: int = 2048):
+        self.path = path
+        self.size = size
+        self.cache_kib = cache_kib
+        self._free: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self.meta: Dict[str, str] = dict(self.all("SELECT key, value FROM meta"))
+
+    def _connect(self) -> sqlite3.Connection:
+        con = sqlite3.connect(Path(self.path).resolve().as_uri() + "?mode=ro", uri=True, check_same_thread=False)
+        con.execute("PRAGMA query_only = ON")
+        con.execute(f"PRAGMA cache_size = -{int(self.cache_kib)}")  # per-connection page cache cap
+        return con
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        try:
+            con = self._free.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                fresh = self._created < self.size
+                if fresh:
+                    self._created += 1
+            con = self._connect() if fresh else self._free.get()
+        try:
+            yield con
+        finally:
+            self._free.put(con)
+
+    def all(self, sql: str, args: tuple = ()) -> List[tuple]:
+        with self.connection() as con:
+            return con.execute(sql, args).fetchall()
+
+    def one(self, sql: str, args: tuple = ()) -> Optional[tuple]:
+        with self.connection() as con:
+            return con.execute(sql, args).fetchone()
+
+# ------------- Tables ------------------
+class SqliteTablesEngine(TablesEngine):
+    """TablesEngine answered from the store's codes/rows tables.
+
+    Only typeahead options are memoized in process (a small LRU); everything
+    else is an indexed range query on the sorted `codes` table.
+    """
+
+    def __init__(self, db: ReadPool, memo: int = 4096):
+        self.db = db
+        self._options = LRUCache(maxsize=memo)
+
+    def is_valid(self, code: str) -> bool:
+        code = code.strip().upper()
+        if len(code) != 7: return False
+        return self.db.one("SELECT 1 FROM codes WHERE code = ?", (code,)) is not None
+
+    def is_potential_prefix(self, token: str) -> bool:
+        token = token.strip().upper()
+        if not (1 <= len(token) <= 7): return False
+        return self.db.one("SELECT 1 FROM codes WHERE code >= ? AND code < ? LIMIT 1", _range(token)) is not None
+
+    def count(self, prefix: str) -> int:
+        return self.db.one("SELECT count(*) FROM codes WHERE code >= ? AND code < ?", _range(prefix))[0]
+
+    def expand(self, prefix: str, limit: int = 100, constraints: Optional[Dict[int, Collection[str]]] = None) -> List[str]:
+        prefix = prefix.strip().upper()
+        if constraints:
+            # Branch chars come from the cached next_chars options; leaves are LIMIT range scans
+            return expand_sorted(prefix, limit, constraints, lambda p: [c for c, _, _ in self.next_chars(p)], self._take)
+        return self._take(prefix, limit)
+
+    def _take(self, prefix: str, n: int) -> List[str]:
+        return [c for c, in self.db.all("SELECT code FROM codes WHERE code >= ? AND code < ? ORDER BY code LIMIT ?",
+                                        (*_range(prefix), n))]
+
+    def stats(self):
+        return {"nodes": int(self.db.meta.get("nodes", 0)), "codes": int(self.db.meta.get("codes", 0)),
+                "labels": self.db.one("SELECT count(*) FROM labels")[0]}
+
+    def next_chars(self, prefix: str) -> List[Tuple[str, str, int]]:
+        prefix = prefix.strip().upper()
+        if len(prefix) >= 7:
+            return []
+        opts = self._options.get(prefix)
+        if opts is None:
+            pos = len(prefix) + 1
+            rows = self.db.all("SELECT substr(code, ?, 1) AS c, count(*) FROM codes WHERE code >= ? AND code < ? "
+                               "GROUP BY c ORDER BY c", (pos, *_range(prefix)))
+            opts = tuple((c, self._label(pos, c, prefix), n) for c, n in rows)
+            self._options.put(prefix, opts)
+        return list(opts)
+
+    def autocomplete(self, prefix: str, n: int = 10) -> Dict:
+        prefix = prefix.strip().upper()
+        count = self.count(prefix) if len(prefix) <= 7 else 0
+        if not count:
+            return {"prefix": prefix, "valid": False, "count": 0, "next": [], "completions": []}
+        return {
+            "prefix": prefix,
+            "valid": len(prefix) == 7,
+            "count": count,
+            "next": self.next_chars(prefix),
+            "completions": self.expand(prefix, limit=n),
+        }
+
+    def _label(self, pos: int, ch: str, code: str = "") -> str:
+        # Same resolution as the in-memory engine: first row of the table that also holds code's other chars
+        code = code.strip().upper()
+        if len(code) < min(pos - 1, 3):
+            return ch
+        if pos <= 3:
+            row = self.db.one("SELECT l.text FROM head h JOIN labels l ON l.id = h.label WHERE h.prefix = ?",
+                              (code[:pos-1] + ch,))
+            return (row[0] if row else "") or ch
+        known = [(i, c) for i, c in enumerate(code[3:7]) if i != pos - 4]
+        label = None
+        for text, *axes in self.db.all("SELECT l.text, r.a4, r.a5, r.a6, r.a7 FROM rows r "
+                                       "JOIN row_labels rl ON rl.row = r.id JOIN labels l ON l.id = rl.label "
+                                       "WHERE r.tbl = ? AND rl.pos = ? AND rl.ch = ? ORDER BY r.id",
+                                       (code[:3], pos, ch)):
+            if all(c in axes[i] for i, c in known):
+                label = text
+                break
+            if label is None:
+                label = text
+        return label or ch
+
+    def iter_axis_labels(self) -> Iterator[Tuple[str, int, str, str]]:
+        yield from self.db.all("SELECT r.tbl, rl.pos, rl.ch, l.text FROM row_labels rl "
+                               "JOIN rows r ON r.id = rl.row JOIN labels l ON l.id = rl.label ORDER BY rl.row, rl.pos")
+
+    def nearest_explanations(self, token: str) -> str:
+        token = token.strip().upper()
+        if token and not self.is_potential_prefix(token):
+            return "Prefix not in tables; try a shorter start."
+        pos = len(token) + 1
+        opts = self.next_chars(token)
+        if not opts:
+            return "Prefix is a dead end per tables."
+        return "Next allowed chars → " + ", ".join(f"{pos}:{c}={label}" for c, label, _ in opts)
+
+# ------------- Index ------------------
+class SqliteIndex:
+    """PCSIndex over the store.
+
+    FTS5 (bm25 over entry paths) picks up to `candidates` entries and rapidfuzz
+    scores them with the same token_set_ratio as the in-memory search, so
+    scores and cutoffs are comparable. Entries sharing no word prefix with
+    the query are never seen, unlike the full fuzzy scan. FTS5 already is a
+    sparse term retriever, so `method` is accepted for interface
+    compatibility and always ranks this way.
+    """
+
+    def __init__(self, db: ReadPool, cache=None, candidates: int = 250):
+        self.db = db
+        self.cache = cache  # optional search_cache.SearchCache
+        self.candidates = candidates
+        self.fingerprint = db.meta.get("index", "")
+
+    def _search(self, q: str, limit: int, score_cutoff: float) -> List[Tuple[int, float]]:
+        match = _fts_query(q)
+        if not match:
+            return []
+        rows = self.db.all("SELECT rowid, path FROM index_fts WHERE index_fts MATCH ? ORDER BY bm25(index_fts) LIMIT ?",
+                           (match, max(self.candidates, limit * 10)))
+        choices = {pos: utils.default_process(path) for pos, path in sorted(rows)}  # ties break in document order
+        results = process.extract(q, choices, scorer=fuzz.token_set_ratio, processor=None,
+                                  limit=limit, score_cutoff=score_cutoff)
+        return [(pos, score) for _, score, pos in results]
+
+    def search(self, query: str, limit: int = 25, score_cutoff: Optional[float] = None, method: str = "fuzzy") -> List[Dict]:
+        q = " ".join(utils.default_process(query or "").split())
+        if not q:
+            return []
+        score_cutoff = 70 if score_cutoff is None else score_cutoff
+        if self.cache is None:
+            hits = self._search(q, limit, score_cutoff)
+        else:
+            # Same fingerprint as the in-memory IndexTree, so the key names this engine: FTS5-prefiltered
+            # hits (whatever `method` asked for) must not answer, or be answered by, a full fuzzy/TF-IDF scan
+            key = f"fts{self.candidates}:{q}"
+            hits = self.cache.get_or_compute(self.fingerprint, key, limit, score_cutoff,
+                                             lambda: self._search(q, limit, score_cutoff))
+        if not hits:
+            return []
+        marks = ",".join("?" * len(hits))
+        found = {pos: (node, path, codes) for pos, node, path, codes in self.db.all(
+            f"SELECT e.pos, e.node, f.path, n.codes FROM entries e JOIN index_fts f ON f.rowid = e.pos "
+            f"JOIN nodes n ON n.id = e.node WHERE e.pos IN ({marks})", tuple(pos for pos, _ in hits))}
+        out = []
+        for pos, score in hits:
+            node, path, codes = found[pos]
+            out.append({"id": node, "titles": path.split(" > "), "codes": codes.split(), "path": path, "score": int(score)})
+        return out
+
+    def search_many(self, queries: List[str], limit: int = 25, score_cutoff: Optional[float] = None,
+                    method: str = "fuzzy") -> List[List[Dict]]:
+        return [self.search(q, limit, score_cutoff, method) for q in queries]
+
+    def path_of(self, node: int) -> str:
+        titles = []
+        while node >= 0:
+            parent, title = self.db.one("SELECT parent, title FROM nodes WHERE id = ?", (node,))
+            if title:
+                titles.append(title)
+            node = parent
+        return " > ".join(reversed(titles))
+
+    def follow(self, node: int, max_depth: int = 3) -> List[Tuple[int, int]]:
+        seen = {node}
+        out: List[Tuple[int, int]] = []
+        frontier = [node]
+        for depth in range(1, max_depth + 1):
+            if not frontier:
+                break
+            marks = ",".join("?" * len(frontier))
+            nxt = []
+            for t, in self.db.all(f"SELECT target FROM refs WHERE node IN ({marks})", tuple(frontier)):
+                if t not in seen:
+                    seen.add(t)
+                    out.append((t, depth))
+                    nxt.append(t)
+            frontier = nxt
+        return out
+
+    def referenced_codes(self, node: int, words: Optional[set] = None, max_depth: int = 3) -> List[Tuple[str, int, int]]:
+        # Same walk as IndexTree.referenced_codes, reading each target's subtree in one range query
+        out: List[Tuple[str, int, int]] = []
+        for target, depth in self.follow(node, max_depth):
+            ok = {target}
+            rows = self.db.all("SELECT id, parent, title, codes, nested FROM nodes "
+                               "WHERE id >= ? AND id < (SELECT end_ FROM nodes WHERE id = ?) ORDER BY id", (target, target))
+            for n, parent, title, _, _ in rows[1:]:
+                if parent in ok and (not title or (words and words.intersection(_norm(title).split()))):
+                    ok.add(n)
+            for n, _, _, codes, nested in rows:
+                if n in ok:
+                    out.extend((c, n, depth) for c in codes.split() + nested.split())
+        return out
+
+# ------------- Definitions ------------------
+class SqliteDefinitions(PCSDefinitions):
+    """PCSDefinitions answered from the store's defs tables."""
+
+    _COLUMNS = "d.title, d.text, d.section, d.axis, d.explanation, d.includes"
+
+    def __init__(self, db: ReadPool):
+        self.db = db
+
+    @staticmethod
+    def _definition(row: tuple) -> Definition:
+        title, text, section, axis, explanation, includes = row
+        return Definition(title=title, text=text, section=section, axis=axis, explanation=explanation,
+                          includes=includes.split("\n") if includes else [])
+
+    def lookup(self, section: str, axis: int, title: str) -> Optional[Definition]:
+        row = self.db.one(f"SELECT {self._COLUMNS} FROM defs d WHERE d.section = ? AND d.axis = ? AND d.key = ? "
+                          "ORDER BY d.id LIMIT 1", (section, axis, normalize_key(title)))
+        return self._definition(row) if row else None
+
+    def find_all(self, key: str) -> List[Definition]:
+        return [self._definition(r) for r in self.db.all(f"SELECT {self._COLUMNS} FROM defs d WHERE d.key = ? ORDER BY d.id",
+                                                         (normalize_key(key),))]
+
+    def including(self, term: str) -> List[Definition]:
+        return [self._definition(r) for r in self.db.all(
+            f"SELECT {self._COLUMNS} FROM includes i JOIN defs d ON d.id = i.def WHERE i.key = ? ORDER BY d.id",
+            (normalize_key(term),))]
+
+    def search(self, query: str, limit: int = 10, score_cutoff: int = 70) -> List[Tuple[Definition, int]]:
+        q = normalize_key(query)
+        match = _fts_query(q)
+        if not match:
+            return []
+        rows = self.db.all("SELECT rowid, body FROM defs_fts WHERE defs_fts MATCH ? ORDER BY bm25(defs_fts) LIMIT ?",
+                           (match, max(100, limit * 10)))
+        results = process.extract(q, dict(sorted(rows)), scorer=fuzz.token_set_ratio, processor=None,
+                                  limit=limit, score_cutoff=score_cutoff)
+        out = []
+        for _, score, rowid in results:
+            row = self.db.one(f"SELECT {self._COLUMNS} FROM defs d WHERE d.id = ?", (rowid,))
+            out.append((self._definition(row), int(score)))
+        return out
+
+def open_store(path: str, pool_size: int = 4, cache=None) -> Tuple[Optional[SqliteTablesEngine], Optional[SqliteIndex],
+                                                                   Optional[SqliteDefinitions]]:
+    # Drop-in (engine, index, definitions); parts that weren't compiled in come back as None
+    db = ReadPool(path, size=pool_size)
+    return (SqliteTablesEngine(db) if "tables" in db.meta else None,
+            SqliteIndex(db, cache=cache) if "index" in db.meta else None,
+            SqliteDefinitions(db) if "definitions" in db.meta else None)
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="Compile the ICD-10-PCS XMLs into a SQLite store.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    comp = sub.add_parser("compile", help="build the store")
+    comp.add_argument("db")
+    comp.add_argument("--tables")
+    comp.add_argument("--index")
+    comp.add_argument("--definitions")
+    info = sub.add_parser("info", help="print the store's metadata")
+    info.add_argument("db")
+    args = ap.parse_args(argv)
+    if args.cmd == "compile":
+        read = lambda p: Path(p).read_bytes() if p else None
+        meta = compile_db(args.db, read(args.tables), read(args.index), read(args.definitions))
+    else:
+        meta = ReadPool(args.db, size=1).meta
+    print(json.dumps(meta, indent=2))
+
+if __name__ == "__main__":
+    main()
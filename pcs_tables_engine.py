@@ -1,15 +1,19 @@
 
 from __future__ import annotations
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Collection, Dict, Iterator, List, Optional, Sequence, Tuple
 from dataclasses import dataclass, field
 from lxml import etree
 from collections import defaultdict, deque
 import io
+import itertools
 # --------- Trie data structure ----------
 @dataclass
 class TrieNode:
     children: Dict[str, 'TrieNode'] = field(default_factory=dict)
     terminal: bool = False
+    count: int = 0  # legal codes in this subtree
+    keys: Tuple[str, ...] = ()  # sorted child chars
+    options: Optional[Tuple[Tuple[str, str, int], ...]] = None  # cached (char, label, count) for typeahead
 
 class TablesTrie:
     def __init__(self):
@@ -18,12 +22,32 @@ class TablesTrie:
 
     def add_code(self, code: str):
         node = self.root
+        path = [node]
         for ch in code:
             if ch not in node.children:
                 node.children[ch] = TrieNode()
                 self.nodes += 1
             node = node.children[ch]
-        node.terminal = True
+            path.append(node)
+        if not node.terminal:
+            node.terminal = True
+            for n in path:
+                n.count += 1
+
+    def sorted_keys(self, node: TrieNode) -> Tuple[str, ...]:
+        # Children are only ever added, so a length mismatch means the cache is stale
+        if len(node.keys) != len(node.children):
+            node.keys = tuple(sorted(node.children))
+            node.options = None
+        return node.keys
+
+    def finalize(self):
+        # Precompute sorted child keys for every node so lookups never sort
+        stack = [self.root]
+        while stack:
+            n = stack.pop()
+            self.sorted_keys(n)
+            stack.extend(n.children.values())
 
     def walk(self, token: str) -> Optional[TrieNode]:
         node = self.root
@@ -33,81 +57,164 @@ class TablesTrie:
             node = node.children[ch]
         return node
 
-    def expand(self, prefix: str, limit: int = 100) -> List[str]:
+    def expand(self, prefix: str, limit: int = 100, constraints: Optional[Dict[int, Collection[str]]] = None) -> List[str]:
+        # `constraints` maps axis pos -> preferred chars and prunes the walk itself.
+        # They are soft: where a node offers none of the preferred chars, all children are kept.
         node = self.walk(prefix)
         if not node:
             return []
         out = []
         stack: List[Tuple[str, TrieNode]] = [(prefix, node)]
+        # Push children in reverse sorted order so codes come out sorted and we can stop at `limit`
         while stack and len(out) < limit:
             cur, n = stack.pop()
             if n.terminal and len(cur) == 7:
                 out.append(cur)
-            for ch, child in n.children.items():
-                stack.append((cur + ch, child))
-        return sorted(out)
+            keys = self.sorted_keys(n)
+            allowed = constraints.get(len(cur) + 1) if constraints else None
+            if allowed:
+                keys = tuple(ch for ch in keys if ch in allowed) or keys
+            for ch in reversed(keys):
+                stack.append((cur + ch, n.children[ch]))
+        return out
+
+def expand_sorted(prefix: str, limit: int, constraints: Dict[int, Collection[str]],
+                  chars: Callable[[str], Sequence[str]], take: Callable[[str, int], List[str]]) -> List[str]:
+    """TablesTrie.expand for stores that keep codes sorted instead of in a trie.
+
+    `chars(prefix)` gives the sorted next chars under `prefix` and `take(prefix, n)` its first
+    `n` codes. Branches are only visited down to the last constrained axis, then taken in bulk.
+    """
+    out: List[str] = []
+    last = max(constraints, default=0)
+
+    def walk(cur: str):
+        if len(cur) >= min(last, 7):
+            out.extend(take(cur, limit - len(out)))
+            return
+        keys = chars(cur)
+        allowed = constraints.get(len(cur) + 1)
+        if allowed:
+            keys = [ch for ch in keys if ch in allowed] or keys
+        for ch in keys:
+            walk(cur + ch)
+            if len(out) >= limit:
+                return
+
+    walk(prefix)
+    return out
+
+# ------------- Label pool ------------------
+class LabelPool:
+    """Interned label strings; tables reference them by small integer id."""
+    __slots__ = ("strings", "_ids")
+
+    def __init__(self):
+        self.strings: List[str] = []
+        self._ids: Dict[str, int] = {}
+
+    def intern(self, text: str) -> int:
+        lid = self._ids.get(text)
+        if lid is None:
+            lid = self._ids[text] = len(self.strings)
+            self.strings.append(text)
+        return lid
+
+    def __getitem__(self, lid: int) -> str:
+        return self.strings[lid]
+
+    def __len__(self) -> int:
+        return len(self.strings)
+
+# A row keeps one char -> label id map per axis position 4..7
+Row = Tuple[Dict[str, int], Dict[str, int], Dict[str, int], Dict[str, int]]
+
+def _axis_values(axis_el) -> List[Tuple[str, str]]:
+    values = []
+    for lab in axis_el.iter():
+        if not isinstance(lab.tag, str) or lab.tag.split('}')[-1] != "label":
+            continue
+        c = lab.get("code")
+        if c is not None:
+            values.append((c, (lab.text or "").strip()))
+    return values
 
 # ------------- Engine ------------------
 class TablesEngine:
-    def __init__(self, trie: TablesTrie, labels: Dict[int, Dict[str, str]]):
+    def __init__(self, trie: TablesTrie, head: Dict[str, int], rows: Dict[str, List[Row]], pool: LabelPool):
         self.trie = trie
-        self.labels = labels  # pos -> code -> label
+        self.head = head  # "0" / "0S" / "0SR" -> label id for axes 1-3
+        self.rows = rows  # table prefix (first 3 chars) -> rows with axis 4-7 label ids
+        self.pool = pool
 
     @classmethod
-    def from_bytes(cls, xml_bytes: bytes) -> 'TablesEngine':
+    def from_bytes(cls, xml_bytes: bytes, progress: Optional[Callable[..., None]] = None,
+                   every: int = 500) -> 'TablesEngine':
+        # progress(rows=..., codes=...) is called every `every` rows and once at the end
         trie = TablesTrie()
-        labels: Dict[int, Dict[str, str]] = defaultdict(dict)
+        n_rows = 0
+        pool = LabelPool()
+        head: Dict[str, int] = {}
+        rows: Dict[str, List[Row]] = defaultdict(list)
 
-        # Stream parse, picking codes from each pcsTable/pcsRow combination
+        # Stream parse. Axes 1-3 usually sit on <pcsTable>, axes 4-7 on each <pcsRow>;
+        # a row's axes override the table's so either layout works.
         ctx = etree.iterparse(io.BytesIO(xml_bytes), events=("start","end"))
-        # We will collect axes by pos for each pcsRow, then cartesian product
-        import io as _io
-        import itertools
-        # re-init with BytesIO (above var shadowing)
-        ctx = etree.iterparse(_io.BytesIO(xml_bytes), events=("start","end"))
         in_row = False
-        axes: Dict[int, List[str]] = {}
-        current_axis_pos = None
+        table_axes: Dict[int, List[Tuple[str, str]]] = {}
+        axes: Dict[int, List[Tuple[str, str]]] = {}
 
         for ev, el in ctx:
             tag = el.tag.split('}')[-1]
-            if ev == "start" and tag == "pcsRow":
-                in_row = True
-                axes = {}
-            elif ev == "end" and tag == "pcsRow":
-                # build all legal 7-char codes from this row
-                # pos 1..7 must exist in axes; if some missing, skip
-                if all(p in axes for p in range(1,8)):
-                    for combo in itertools.product(axes[1], axes[2], axes[3], axes[4], axes[5], axes[6], axes[7]):
-                        code = "".join(combo)
-                        if len(code) == 7:
-                            trie.add_code(code)
-                in_row = False
-                axes = {}
-                el.clear()
-            elif in_row and ev == "end" and tag == "axis":
-                # axis has @pos, and nested <label code="X">...</label>
+            if ev == "start":
+                if tag == "pcsTable":
+                    table_axes = {}
+                elif tag == "pcsRow":
+                    in_row = True
+                    axes = {}
+                continue
+            if tag == "axis":
                 try:
                     pos = int(el.get("pos"))
                 except Exception:
                     pos = None
                 if pos is not None:
-                    values = []
-                    for lab in el.findall(".//label"):
-                        c = lab.get("code")
-                        if c is None:
-                            continue
-                        values.append(c)
-                        # save human label
-                        if lab.text:
-                            labels[pos][c] = lab.text
+                    values = _axis_values(el)
                     if values:
-                        axes[pos] = values
+                        (axes if in_row else table_axes)[pos] = values
+                el.clear()
+            elif tag == "pcsRow":
+                merged = {**table_axes, **axes}
+                # pos 1..7 must all be known; if some are missing, skip the row
+                if all(p in merged for p in range(1,8)):
+                    row: Row = tuple({c: pool.intern(text) for c, text in merged[p]} for p in range(4, 8))
+                    for c1, l1 in merged[1]:
+                        head[c1] = pool.intern(l1)
+                        for c2, l2 in merged[2]:
+                            head[c1 + c2] = pool.intern(l2)
+                            for c3, l3 in merged[3]:
+                                head[c1 + c2 + c3] = pool.intern(l3)
+                                rows[c1 + c2 + c3].append(row)
+                    for combo in itertools.product(*(tuple(c for c, _ in merged[p]) for p in range(1,8))):
+                        code = "".join(combo)
+                        if len(code) == 7:
+                            trie.add_code(code)
+                in_row = False
+                axes = {}
                 el.clear()
-            elif ev == "end":
+                n_rows += 1
+                if progress and n_rows % every == 0:
+                    progress(rows=n_rows, codes=trie.root.count)
+            elif tag == "pcsTable":
                 el.clear()
+                # drop already-processed tables so memory stays flat
+                while el.getprevious() is not None:
+                    del el.getparent()[0]
 
-        return cls(trie, labels)
+        trie.finalize()
+        if progress:
+            progress(rows=n_rows, codes=trie.root.count)
+        return cls(trie, head, dict(rows), pool)
 
     def is_valid(self, code: str) -> bool:
         code = code.strip().upper()
@@ -120,27 +227,85 @@ class TablesEngine:
         if not (1 <= len(token) <= 7): return False
         return self.trie.walk(token) is not None
 
-    def expand(self, prefix: str, limit: int = 100) -> List[str]:
+    def expand(self, prefix: str, limit: int = 100, constraints: Optional[Dict[int, Collection[str]]] = None) -> List[str]:
         prefix = prefix.strip().upper()
-        return self.trie.expand(prefix, limit=limit)
+        return self.trie.expand(prefix, limit=limit, constraints=constraints)
 
     def stats(self):
-        return {"nodes": self.trie.nodes}
+        return {"nodes": self.trie.nodes, "codes": self.trie.root.count, "labels": len(self.pool)}
+
+    def next_chars(self, prefix: str) -> List[Tuple[str, str, int]]:
+        """Next allowed characters after `prefix` as (char, label, subtree code count).
+
+        Options are resolved once per trie node and cached on it, so repeated
+        keystrokes on the same prefix are plain dict walks.
+        """
+        prefix = prefix.strip().upper()
+        if len(prefix) >= 7:
+            return []
+        node = self.trie.walk(prefix)
+        if node is None:
+            return []
+        keys = self.trie.sorted_keys(node)
+        if node.options is None:
+            pos = len(prefix) + 1
+            node.options = tuple((c, self._label(pos, c, prefix), node.children[c].count) for c in keys)
+        return list(node.options)
+
+    def autocomplete(self, prefix: str, n: int = 10) -> Dict:
+        # Typeahead payload for code builders: next allowed chars plus the first `n` completions
+        prefix = prefix.strip().upper()
+        node = self.trie.walk(prefix) if len(prefix) <= 7 else None
+        if node is None:
+            return {"prefix": prefix, "valid": False, "count": 0, "next": [], "completions": []}
+        return {
+            "prefix": prefix,
+            "valid": len(prefix) == 7 and node.terminal,
+            "count": node.count,
+            "next": self.next_chars(prefix),
+            "completions": self.trie.expand(prefix, limit=n),
+        }
+
+    def _label(self, pos: int, ch: str, code: str = "") -> str:
+        # `code` is the code (or prefix) giving the table context for `ch`.
+        # Axes 4-7 resolve against the first row of that table that also holds
+        # the other known characters of `code`.
+        code = code.strip().upper()
+        if len(code) < min(pos - 1, 3):
+            return ch
+        if pos <= 3:
+            lid = self.head.get(code[:pos-1] + ch)
+        else:
+            lid = None
+            known = [(i, c) for i, c in enumerate(code[3:7]) if i != pos - 4]
+            for row in self.rows.get(code[:3], ()):
+                cand = row[pos-4].get(ch)
+                if cand is None:
+                    continue
+                if all(c in row[i] for i, c in known):
+                    lid = cand
+                    break
+                if lid is None:
+                    lid = cand
+        return (self.pool[lid] if lid is not None else "") or ch
 
-    def _label(self, pos: int, ch: str) -> str:
-        return self.labels.get(pos, {}).get(ch, ch)
+    def iter_axis_labels(self) -> Iterator[Tuple[str, int, str, str]]:
+        # (table prefix, pos, char, label) for every axis 4-7 value of every row
+        for table, rows in self.rows.items():
+            for row in rows:
+                for i, axis in enumerate(row):
+                    for ch, lid in axis.items():
+                        yield table, i + 4, ch, self.pool[lid]
+
+    def axis_labels(self, code: str) -> List[str]:
+        code = code.strip().upper()
+        return [self._label(pos, code[pos-1], code) for pos in range(1, len(code) + 1)]
 
     def explain(self, code: str) -> str:
         code = code.strip().upper()
         if not self.is_valid(code):
             return "Not a legal 2025 PCS code."
-        parts = [f"1:{code[0]} = {self._label(1, code[0])}",
-                 f"2:{code[1]} = {self._label(2, code[1])}",
-                 f"3:{code[2]} = {self._label(3, code[2])}",
-                 f"4:{code[3]} = {self._label(4, code[3])}",
-                 f"5:{code[4]} = {self._label(5, code[4])}",
-                 f"6:{code[5]} = {self._label(6, code[5])}",
-                 f"7:{code[6]} = {self._label(7, code[6])}"]
+        parts = [f"{pos}:{ch} = {label}" for pos, (ch, label) in enumerate(zip(code, self.axis_labels(code)), 1)]
         return " | ".join(parts)
 
     def nearest_explanations(self, token: str) -> str:
@@ -149,8 +314,8 @@ class TablesEngine:
         if node is None:
             return "Prefix not in tables; try a shorter start."
         pos = len(token) + 1
-        opts = sorted(node.children.keys())
+        opts = self.next_chars(token)
         if not opts:
             return "Prefix is a dead end per tables."
-        labels = [f"{pos}:{c}={self._label(pos, c)}" for c in opts]
+        labels = [f"{pos}:{c}={label}" for c, label, _ in opts]
         return "Next allowed chars → " + ", ".join(labels)
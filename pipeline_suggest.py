@@ -5,6 +5,7 @@ import re
 
 from pcs_index import PCSIndex
 from pcs_tables_engine import TablesEngine
+from note_sections import high_yield_text
 
 # Minimal clinical NLP: harvest candidate terms (lowercased, dedup), keep multi-word spans.
 def _extract_terms(text: str) -> List[str]:
@@ -34,14 +35,17 @@ def _extract_terms(text: str) -> List[str]:
 def suggest_codes_from_note(text: str, index: PCSIndex, engine: TablesEngine, topk: int = 50) -> List[str]:
     if not engine or not index:
         return []
+    text = high_yield_text(text)
     terms = _extract_terms(text)
+    words = set(re.findall(r"[a-z0-9]+", text.lower()))
     # search Index for each term; collect codes (full or prefixes) found on the path
     stems: Set[str] = set()
     for t in terms:
         hits = index.search(t, limit=topk) or []
         for h in hits:
-            # codes field may contain a sequence like "0JH" or "0JH6"
-            codes = (h.get("codes") or "").split()
+            # codes may hold partial codes like "0JH" or "0JH6"; follow see/use refs too
+            codes = list(h.get("codes") or [])
+            codes += [c for c, _, _ in index.referenced_codes(h["id"], words)]
             for c in codes:
                 token = re.sub(r"[^0-9A-Z]", "", c.upper())
                 if 1 <= len(token) <= 7:
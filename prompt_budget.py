@@ -0,0 +1,100 @@
+
+from __future__ import annotations
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+import math
+import re
+
+from note_sections import high_yield_text
+
+# Root operations plus approach/device/laterality words: sentences using them carry the coding
+PROCEDURE_TERMS = frozenset("""
+alteration bypass change control creation destruction detachment dilation division drainage excision extirpation
+extraction fragmentation fusion insertion inspection map occlusion reattachment release removal repair replacement
+reposition resection restriction revision supplement transfer transplantation biopsy arthroplasty arthroscopy
+arthroscopic laparoscopic endoscopic percutaneous open incision implant prosthesis graft stent catheter device plate
+screw mesh drain spacer left right bilateral total partial
+""".split())
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English prose and code lists; good enough to budget against
+    return math.ceil(len(text or "") / 4)
+
+def _sentences(text: str) -> List[str]:
+    return [s for s in (" ".join(c.split()) for c in re.split(r"(?<=[.;])\s+|\n+", text or "")) if len(s) >= 4]
+
+def select_spans(text: str, budget: int, terms: Iterable[str] = ()) -> Tuple[str, int]:
+    """Most relevant sentences of the procedural sections within `budget` tokens, in note order.
+
+    Sentences are ranked by how many procedure terms and `terms` (e.g.
+    words from candidate Index paths) they contain; gaps are marked "…".
+    Returns (text, sentences dropped).
+    """
+    sents = list(dict.fromkeys(_sentences(high_yield_text(text))))  # templated notes repeat sentences verbatim
+    if estimate_tokens(" ".join(sents)) <= budget:
+        return " ".join(sents), 0
+    wanted = PROCEDURE_TERMS | {t.lower() for t in terms}
+    scored = []
+    for i, s in enumerate(sents):
+        words = re.findall(r"[a-z]+", s.lower())
+        hits = sum(1 for w in words if w in wanted)
+        scored.append((-hits / math.sqrt(len(words) or 1), i))  # density, so long rambling sentences don't win
+    keep, used = set(), 0
+    for _, i in sorted(scored):
+        cost = estimate_tokens(sents[i]) + 1
+        if used + cost <= budget:
+            keep.add(i)
+            used += cost
+    out, last = [], -1
+    for i in sorted(keep):
+        if last >= 0 and i != last + 1:
+            out.append("…")
+        out.append(sents[i])
+        last = i
+    return " ".join(out), len(sents) - len(keep)
+
+def compact_candidates(codes: Sequence[str], labels=None, confidences: Optional[Dict[str, float]] = None,
+                       prefix_len: int = 4) -> str:
+    """Candidate codes as one line per shared prefix, e.g. "0SRD (Replacement · Knee Joint, Left): 0JZ 0J9 0KZ".
+
+    With `labels` (a callable code -> axis labels, like TablesEngine.axis_labels)
+    the prefix is labelled once, and the remaining axes are spelled out only
+    where the group's codes differ there.
+    """
+    groups: Dict[str, List[str]] = {}
+    for c in codes:
+        groups.setdefault(c[:prefix_len], []).append(c)
+    lines = []
+    for prefix, members in groups.items():
+        head = prefix
+        if labels:
+            names = labels(members[0])
+            head += f" ({' · '.join(names[2:prefix_len])})"
+        tails = " ".join(c[prefix_len:] + (f"({confidences[c]:.2f})" if confidences and c in confidences else "")
+                         for c in members)
+        line = f"{head}: {tails}"
+        if labels and len(members) > 1:
+            # Labels only for axes that vary within the group
+            legend = []
+            for pos in range(prefix_len + 1, 8):
+                chars = dict.fromkeys(c[pos - 1] for c in members if len(c) >= pos)
+                if len(chars) > 1:
+                    by_char = {c[pos - 1]: labels(c)[pos - 1] for c in members if len(c) >= pos}
+                    legend.append(f"{pos}: " + ", ".join(f"{ch}={by_char[ch]}" for ch in chars))
+            if legend:
+                line += " [" + "; ".join(legend) + "]"
+        lines.append(line)
+    return "\n".join(lines)
+
+def build_prompt(template: str, note: str, budget: int, candidates: str = "", terms: Iterable[str] = ()) -> Tuple[str, Dict]:
+    """Fill `template` ({note}, {candidates}) so the whole prompt stays within `budget` tokens.
+
+    The fixed text and candidate list are paid for first; the note gets
+    what is left. Returns (prompt, stats) where stats has the prompt's
+    estimated tokens and how much of the note was dropped.
+    """
+    fixed = estimate_tokens(template.format(note="", candidates=candidates))
+    note_text, dropped = select_spans(note, max(budget - fixed, 0), terms)
+    prompt = template.format(note=note_text, candidates=candidates)
+    stats = {"prompt_tokens": estimate_tokens(prompt), "budget": budget, "note_tokens": estimate_tokens(note_text),
+             "candidate_tokens": estimate_tokens(candidates), "sentences_dropped": dropped}
+    return prompt, stats
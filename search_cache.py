@@ -0,0 +1,97 @@
+
+from __future__ import annotations
+from typing import Callable, Dict, List, Optional, Tuple
+import atexit
+import json
+import sqlite3
+import threading
+import time
+
+from note_cache import LRUCache
+
+Hits = List[Tuple[int, float]]  # (entry position, score)
+
+class SearchCache:
+    """Bounded, thread-safe memo for Index phrase searches.
+
+    Keys are (Index fingerprint, normalized query, limit, cutoff). One instance
+    can be shared by every session in a process; with `path` results are also
+    written to a SQLite file and survive restarts. Since the fingerprint is
+    part of every key, a changed Index is never answered from old results,
+    and sessions on different Index files do not evict each other wholesale.
+    The file keeps at most `max_rows` rows, least recently used first out, so
+    rows of an Index no longer in use age out. Writes are batched: pending
+    rows are committed every `flush_every` misses and by flush().
+    """
+
+    def __init__(self, maxsize: int = 4096, path: Optional[str] = None, max_rows: int = 100_000,
+                 flush_every: int = 64):
+        self._lru = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self.max_rows = max_rows
+        self.flush_every = flush_every
+        self._pending: Dict[Tuple[str, str], str] = {}    # (fp, key) -> hits JSON, not yet written
+        self._touched: Dict[Tuple[str, str], float] = {}  # (fp, key) -> last disk hit, not yet written
+        self.disk_hits = 0
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS search_cache (fp TEXT, key TEXT, hits TEXT, PRIMARY KEY (fp, key))")
+            if "used" not in {row[1] for row in self._db.execute("PRAGMA table_info(search_cache)")}:
+                self._db.execute("ALTER TABLE search_cache ADD COLUMN used REAL DEFAULT 0")
+            self._db.execute("CREATE INDEX IF NOT EXISTS search_cache_used ON search_cache (used)")
+            self._db.commit()
+            atexit.register(self.flush)
+
+    def get_or_compute(self, fp: str, query: str, limit: int, score_cutoff: float, compute: Callable[[], Hits]) -> Hits:
+        key = (fp, query, limit, score_cutoff)
+        hits = self._lru.get(key)
+        if hits is not None:
+            return hits
+        db_key = f"{limit}|{score_cutoff}|{query}"
+        if self._db is not None:
+            with self._lock:
+                pending = self._pending.get((fp, db_key))
+                row = (pending,) if pending else self._db.execute(
+                    "SELECT hits FROM search_cache WHERE fp = ? AND key = ?", (fp, db_key)).fetchone()
+                if row and not pending:
+                    self._touched[(fp, db_key)] = time.time()
+            if row:
+                hits = [(int(i), float(s)) for i, s in json.loads(row[0])]
+                self.disk_hits += 1
+                self._lru.put(key, hits)
+                return hits
+        hits = compute()
+        self._lru.put(key, hits)
+        if self._db is not None:
+            with self._lock:
+                self._pending[(fp, db_key)] = json.dumps(hits)
+                if len(self._pending) + len(self._touched) >= self.flush_every:
+                    self._flush()
+        return hits
+
+    def flush(self):
+        """Write pending rows and recency updates in one transaction, then trim the file to `max_rows`."""
+        if self._db is not None:
+            with self._lock:
+                self._flush()
+
+    def _flush(self):
+        # Caller holds self._lock
+        if not (self._pending or self._touched):
+            return
+        now = time.time()
+        self._db.executemany("INSERT OR REPLACE INTO search_cache (fp, key, hits, used) VALUES (?, ?, ?, ?)",
+                             [(fp, key, hits, now) for (fp, key), hits in self._pending.items()])
+        self._db.executemany("UPDATE search_cache SET used = ? WHERE fp = ? AND key = ?",
+                             [(used, fp, key) for (fp, key), used in self._touched.items()])
+        excess = self._db.execute("SELECT count(*) FROM search_cache").fetchone()[0] - self.max_rows
+        if excess > 0:
+            self._db.execute("DELETE FROM search_cache WHERE rowid IN "
+                             "(SELECT rowid FROM search_cache ORDER BY used LIMIT ?)", (excess,))
+        self._db.commit()
+        self._pending.clear()
+        self._touched.clear()
+
+    def stats(self) -> Dict:
+        return {**self._lru.stats(), "disk_hits": self.disk_hits, "persistent": self._db is not None}
@@ -2,6 +2,9 @@
 import os
 import io
 import json
+import hashlib
+import time
+import pandas as pd
 import streamlit as st
 
 from utils.text_extract import extract_text_from_file
@@ -9,7 +12,12 @@ from utils.index_parser import IndexStore
 from utils.definitions import DefinitionsStore
 from utils.tables_engine import TablesEngine
 from utils.coder import suggest_codes
+from utils.incremental import IncrementalAnalysis
+from search_cache import SearchCache
+from pcs_keys import KeyMaps
 from utils.gemini_api import gemini_rerank_and_explain
+from engine_warmup import Warmup
+from utils.multi_note import code_notes, make_coder, result_rows, results_csv, results_json
 
 st.set_page_config(page_title="ICD-10-PCS Assistant", layout="wide")
 
@@ -22,11 +30,12 @@ with st.sidebar:
     def_file = st.file_uploader("Upload icd10pcs_definitions_2025.xml", type=["xml"], key="def")
 
     st.markdown("---")
+    st.header("Key Files (optional)")
+    bp_file = st.file_uploader("Body Part Key.md", type=["md"], key="bpkey")
+    devagg_file = st.file_uploader("Device Aggregation Table.md", type=["md"], key="devagg")
+    devkey_file = st.file_uploader("Device Key.md", type=["md"], key="devkey")
+    subst_file = st.file_uploader("Substance Key.md", type=["md"], key="substkey")
     st.header("Future Integrations (placeholders)")
-    st.file_uploader("Body Part Key.md", type=["md"], key="bpkey")
-    st.file_uploader("Device Aggregation Table.md", type=["md"], key="devagg")
-    st.file_uploader("Device Key.md", type=["md"], key="devkey")
-    st.file_uploader("Substance Key.md", type=["md"], key="substkey")
     st.file_uploader(".DS_Store (ignored)", type=[], key="dsstore")
     st.file_uploader("Procedure Checklist Folder (.md files)", type=["md"], accept_multiple_files=True, key="checklists")
 
@@ -35,6 +44,12 @@ with st.sidebar:
     use_gemini = st.checkbox("Use Gemini 2.0 Flash for re-ranking and explanations", value=True)
     api_key = st.text_input("GEMINI_API_KEY", value=os.getenv("GEMINI_API_KEY", ""), type="password")
     gemini_model = st.text_input("Model", value="gemini-2.0-flash")
+    prompt_budget = st.number_input("Prompt token budget", min_value=300, max_value=8000, value=1500, step=100,
+                                    help="Estimated tokens; candidates are sent compactly and the note is cut to its most relevant sentences.")
+
+    st.markdown("---")
+    retriever = st.radio("Index matching", ["fuzzy", "tfidf"], horizontal=True,
+                         help="fuzzy: rapidfuzz token-set ratio. tfidf: sparse word + character n-gram TF-IDF (faster on long notes).")
 
 # Load reference stores (allow defaults from /mnt/data if user didn't upload)
 def resolve_default(path_hint):
@@ -58,17 +73,123 @@ with col2:
 with col3:
     st.metric("Definitions XML", "Loaded" if def_bytes else "Missing")
 
-if idx_bytes:
-    index_store = IndexStore.from_bytes(idx_bytes)
+@st.cache_resource(show_spinner=False)
+def get_search_cache() -> SearchCache:
+    # Shared by all sessions in this process; set PCS_SEARCH_CACHE to a file path to persist it
+    return SearchCache(maxsize=8192, path=os.getenv("PCS_SEARCH_CACHE") or None)
+
+@st.cache_resource(show_spinner=False)
+def get_warmup() -> Warmup:
+    # Background parses keyed by XML digest; shared by sessions and reruns
+    return Warmup(max_workers=3)
 
+# Start all three parses in the background; they are awaited only when "Analyze" runs
+warmup = get_warmup()
+digest = lambda b: hashlib.sha1(b).hexdigest()
+search_cache = get_search_cache()
+jobs = {}
+if idx_bytes:
+    jobs["Index"] = warmup.start("index", digest(idx_bytes), lambda report, b=idx_bytes: IndexStore.from_bytes(b, cache=search_cache))
 if def_bytes:
-    defs_store = DefinitionsStore.from_bytes(def_bytes)
+    jobs["Definitions"] = warmup.start("definitions", digest(def_bytes), lambda report, b=def_bytes: DefinitionsStore.from_bytes(b))
+if tbl_bytes:
+    jobs["Tables"] = warmup.start("tables", digest(tbl_bytes), lambda report, b=tbl_bytes: TablesEngine.from_bytes(b, progress=report))
+for job in jobs.values():
+    st.caption(("✅ " if job.done() and not job.failed() else "⏳ ") + job.describe())
 
-tables_engine = TablesEngine.from_bytes(tbl_bytes) if tbl_bytes else TablesEngine.none_engine()
+def await_stores():
+    # (index_store, defs_store, tables_engine), blocking on whatever is still parsing
+    pending = [job for job in jobs.values() if not job.done()]
+    if pending:
+        with st.spinner("Finishing reference parses: " + "; ".join(job.describe() for job in pending)):
+            for job in pending:
+                job.future.exception()
+    out = {}
+    for name, job in jobs.items():
+        if job.failed():
+            st.warning(job.describe())
+        else:
+            out[name] = job.result()
+    return out.get("Index"), out.get("Definitions"), out.get("Tables") or TablesEngine.none_engine()
 
 st.markdown("---")
 
+@st.cache_resource(show_spinner=False)
+def cached_key_maps(_core, tables_digest: str, bp, dev_agg, dev, sub) -> KeyMaps:
+    # tables_digest only keys the cache; the engine itself is unhashable
+    return KeyMaps.compile(_core, {"body_part": bp, "device_agg": dev_agg, "device": dev, "substance": sub})
+
+def compile_key_maps(tables_engine):
+    if not tables_engine.has_tables:
+        return None
+    return cached_key_maps(tables_engine.core, digest(tbl_bytes),
+                           *(f.getvalue() if f else None for f in (bp_file, devagg_file, devkey_file, subst_file)))
+
 st.header("Upload Procedure Note")
+mode = st.radio("Mode", ["Single note", "Multiple notes"], horizontal=True)
+
+if mode == "Multiple notes":
+    note_files = st.file_uploader("PDF / DOCX / TXT (one file per note)", type=["pdf", "docx", "txt"],
+                                  accept_multiple_files=True, key="notes")
+    workers = st.slider("Notes coded in parallel", 1, 8, 4,
+                        help="Index matching runs in this many worker processes; Gemini round-trips overlap on threads.")
+    page_size = 25
+
+    if st.button("Analyze all notes", type="primary"):
+        if not note_files:
+            st.warning("Please upload one or more notes.")
+            st.stop()
+        index_store, defs_store, tables_engine = await_stores()
+        rerank = None
+        if use_gemini and api_key:
+            rerank = lambda text, sugg: gemini_rerank_and_explain(
+                api_key=api_key, model=gemini_model, text=text, suggestions=sugg, max_prompt_tokens=int(prompt_budget),
+                labels=tables_engine.axis_labels if tables_engine else None)
+        code = make_coder(index_store, tables_engine, defs_store, compile_key_maps(tables_engine), retriever)
+
+        # Results stream in as each note finishes (completion order); statuses update in place
+        files = [(f.name, f.getvalue()) for f in note_files]
+        # Keyed by upload position: two files may share a name
+        labels = [f"{i + 1}. {name}" for i, (name, _) in enumerate(files)]
+        status = ["⏳ queued"] * len(files)
+        results = []
+        progress = st.progress(0.0)
+        status_ph, table_ph = st.empty(), st.empty()
+        status_ph.table([{"Note": n, "Status": v} for n, v in zip(labels, status)])
+        t0 = time.perf_counter()
+        for res in code_notes(files, code, max_workers=workers, rerank=rerank):
+            results.append(res)
+            status[res.index] = (f"✅ {len(res.suggestions)} code(s) in {res.seconds:.1f}s" + (f" ({res.error})" if res.error else "")
+                                 if res.status == "done" else f"❌ {res.error}")
+            progress.progress(len(results) / len(files))
+            status_ph.table([{"Note": n, "Status": v} for n, v in zip(labels, status)])
+            table_ph.dataframe(pd.DataFrame(result_rows(results)[:page_size]), use_container_width=True)
+        st.session_state["multi_results"] = results
+        st.session_state["multi_status"] = [{"Note": n, "Status": v} for n, v in zip(labels, status)]
+        st.session_state["multi_seconds"] = time.perf_counter() - t0
+        status_ph.empty()
+        table_ph.empty()
+        progress.empty()
+
+    results = st.session_state.get("multi_results")
+    if results:
+        slowest = max(r.seconds for r in results)
+        st.caption(f"{len(results)} note(s) in {st.session_state['multi_seconds']:.1f}s wall-clock "
+                   f"(slowest single note {slowest:.1f}s).")
+        st.table(st.session_state["multi_status"])
+        rows = result_rows(results)
+        pages = max(1, -(-len(rows) // page_size))
+        page = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, value=1, step=1)
+        st.dataframe(pd.DataFrame(rows[(page - 1) * page_size:page * page_size]), use_container_width=True)
+        c1, c2 = st.columns(2)
+        with c1:
+            st.download_button("Download all results (JSON)", data=results_json(results),
+                               file_name="pcs_results.json", mime="application/json")
+        with c2:
+            st.download_button("Download all results (CSV)", data=results_csv(results),
+                               file_name="pcs_results.csv", mime="text/csv")
+    st.stop()
+
 note_file = st.file_uploader("PDF / DOCX / TXT", type=["pdf", "docx", "txt"])
 
 default_text = st.text_area("...or paste text directly", height=200, value="")
@@ -88,23 +209,37 @@ if st.button("Analyze & Suggest PCS Codes", type="primary"):
         st.error(f"Failed to extract text: {e}")
         st.stop()
 
-    # Suggest codes
+    index_store, defs_store, tables_engine = await_stores()
+    key_maps = compile_key_maps(tables_engine)
+
+    # Suggest codes; per-sentence results persist across reruns so edits only re-search changed lines
+    analysis = st.session_state.setdefault("analysis", IncrementalAnalysis())
     suggestions = suggest_codes(
         text=text,
         index_store=index_store,
         tables_engine=tables_engine,
         defs_store=defs_store,
+        key_maps=key_maps,
+        analysis=analysis,
+        retriever=retriever,
     )
+    st.caption(f"Searched {analysis.searched} of {len(analysis.sentences)} sentence(s); the rest were unchanged.")
 
     # Optional: rerank/explain with Gemini
     if use_gemini and api_key and suggestions:
         try:
+            prompt_stats = {}
             suggestions = gemini_rerank_and_explain(
                 api_key=api_key,
                 model=gemini_model,
                 text=text,
-                suggestions=suggestions
+                suggestions=suggestions,
+                max_prompt_tokens=int(prompt_budget),
+                labels=tables_engine.axis_labels if tables_engine else None,
+                stats=prompt_stats,
             )
+            st.caption(f"Gemini prompt: ~{prompt_stats.get('prompt_tokens', 0)} tokens (budget {prompt_stats.get('budget', 0)}, "
+                       f"candidates {prompt_stats.get('candidate_tokens', 0)}, {prompt_stats.get('sentences_dropped', 0)} note sentence(s) left out)")
         except Exception as e:
             st.warning(f"Gemini step skipped: {e}")
 
@@ -113,7 +248,6 @@ if st.button("Analyze & Suggest PCS Codes", type="primary"):
     else:
         st.subheader("Suggested PCS Codes")
         # Results table
-        import pandas as pd
         df = pd.DataFrame([{
             "Code": s.get("code"),
             "Confidence": round(s.get("confidence", 0), 3),
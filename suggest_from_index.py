@@ -1,10 +1,14 @@
 
 from __future__ import annotations
-from typing import List, Dict, Tuple
+from typing import List, Dict, Optional, Tuple
 import re
 from rapidfuzz import fuzz
 from pcs_tables_engine import TablesEngine
 from pcs_index import PCSIndex
+from pcs_keys import KeyMaps
+from note_sections import high_yield_text
+from note_cache import NoteCache, note_sentences
+from pcs_scoring import CandidateSet, Weights, top_k
 
 CODE_RE = re.compile(r'^[0-9A-Z]{3,7}$')
 
@@ -21,33 +25,128 @@ def _ngram_terms(text: str, n=(1,2,3)) -> List[str]:
             seen.add(g); out.append(g)
     return out[:500]
 
-def suggest_from_index(note_text: str, index: PCSIndex, engine: TablesEngine, topk_hits=40, max_codes=100) -> List[str]:
-    # Search index with a single combined query (top), plus some targeted n-grams.
-    base_hits = index.search(note_text, limit=topk_hits)
-    # Pull more signal from n-grams (short phrases like "arthroplasty knee", "arthroscopy", etc.)
-    grams = _ngram_terms(note_text, n=(2,3))
-    for g in grams[:50]:
-        base_hits += index.search(g, limit=5)
-
-    # Collect raw code tokens from hits
-    raw = []
-    for hit in base_hits:
-        for c in (hit.get("codes") or []):
+# Fuzzy mining does a full Index scan per query, so a note is capped at about the old budget of one
+# whole-note query plus 50 n-grams: MAX_SENTENCES x (1 + SENTENCE_GRAMS), with n-grams shared across sentences.
+MAX_SENTENCES = 16   # fuzzy: sentences searched per note
+SENTENCE_GRAMS = 2   # n-gram searches per sentence, on top of the sentence itself
+STOPWORDS = frozenset("a an and as at by for from in into of on or the then to under was were with".split())
+
+def search_sentences(sentences: List[str], retriever: str = "fuzzy") -> List[str]:
+    # Distinct sentences, in note order, that are mined; TF-IDF scores any number in one sparse product
+    sentences = list(dict.fromkeys(sentences))
+    return sentences if retriever == "tfidf" else sentences[:MAX_SENTENCES]
+
+def _sentence_grams(sent: str) -> List[str]:
+    # Short phrases like "arthroplasty knee" pull more signal than the whole sentence; skip "of the ..." fragments
+    grams = []
+    for g in _ngram_terms(sent, n=(2,3)):
+        toks = g.split()
+        if toks[0] not in STOPWORDS and toks[-1] not in STOPWORDS:
+            grams.append(g)
+            if len(grams) == SENTENCE_GRAMS:
+                break
+    return grams
+
+def _hits(sentences: List[str], index: PCSIndex, topk_hits: int, retriever: str) -> List[List[Dict]]:
+    # Index hits per sentence: the sentence as one query plus its first few n-grams
+    if retriever == "tfidf":
+        # Every sentence scored against all entries in one sparse product
+        return index.search_many(sentences, limit=topk_hits, method=retriever)
+    gram_hits: Dict[str, List[Dict]] = {}  # each n-gram searched once per note, however many sentences share it
+    out = []
+    for sent in sentences:
+        hits = list(index.search(sent, limit=topk_hits))
+        for g in _sentence_grams(sent):
+            if g not in gram_hits:
+                gram_hits[g] = index.search(g, limit=5)
+            hits += gram_hits[g]
+        out.append(hits)
+    return out
+
+def score_hits(hits: List[Dict], index: PCSIndex, engine: TablesEngine, key_matches: list, words: set,
+               weights: Optional[Weights] = None) -> Dict[str, float]:
+    # Keep the best-scoring occurrence of each Index entry
+    best: Dict[int, Dict] = {}
+    for hit in hits:
+        if hit["id"] not in best or hit["score"] > best[hit["id"]]["score"]:
+            best[hit["id"]] = hit
+
+    # Codes from hits, plus entries they point to via see/use, as feature rows for one scoring pass
+    cands = CandidateSet()
+    for hit in best.values():
+        depth = len(hit["titles"]) - 1  # below the letter
+        codes = [(c, 0) for c in (hit.get("codes") or [])]
+        codes += [(c, hops) for c, _, hops in index.referenced_codes(hit["id"], words)]
+        for c, hops in codes:
             # some nodes store multi-codes in a single string; split on non-alnum
             for tok in re.split(r'[^0-9A-Z]+', c.upper()):
-                if CODE_RE.match(tok):
-                    raw.append((tok, hit["path"], hit["score"]))
+                if not CODE_RE.match(tok):
+                    continue
+                constraints = KeyMaps.constraints(key_matches, tok)
+                if len(tok) == 7:
+                    if engine.is_valid(tok):
+                        cands.add([tok], hit["score"], depth=depth, exact=True, hops=hops, hints=constraints)
+                else:
+                    # use strict table expansion; only legal completions returned
+                    cands.add(engine.expand(tok, limit=80, constraints=constraints), hit["score"],
+                              depth=depth, hops=hops, hints=constraints)
+    return cands.scores(weights)
 
-    # Expand using tables where needed; keep only legal 7-char codes
+def score_sentences(sentences: List[str], index: PCSIndex, engine: TablesEngine, topk_hits=40, key_matches=(),
+                    retriever: str = "fuzzy", weights: Optional[Weights] = None) -> Dict[str, Dict[str, float]]:
+    """sentence -> code scores, each sentence searched and scored on its own.
+
+    `key_matches` (body part / device / substance mentions) come from the
+    whole note, so e.g. laterality stated once still constrains every
+    sentence's table walk.
+    """
+    out: Dict[str, Dict[str, float]] = {}
+    for sent, hits in zip(sentences, _hits(sentences, index, topk_hits, retriever)):
+        words = set(re.findall(r"[a-z0-9]+", sent.lower()))
+        out[sent] = score_hits(hits, index, engine, key_matches, words, weights)
+    return out
+
+def merge_scores(per_sentence: Dict[str, Dict[str, float]], sentences: List[str]) -> Dict[str, float]:
+    # A code's note score is its best score in any of the note's current sentences
     scored: Dict[str, float] = {}
-    for tok, path, score in raw:
-        if len(tok) == 7 and engine.is_valid(tok):
-            scored[tok] = max(scored.get(tok, 0), score/100.0 + 0.2)  # bonus for exact 7-char from index
-        elif 3 <= len(tok) <= 6:
-            # use strict table expansion; only legal completions returned
-            for code in engine.expand(tok, limit=80):
-                scored[code] = max(scored.get(code, 0), score/100.0)
-
-    # Rank by score
-    ranked = sorted(scored.items(), key=lambda x: (-x[1], x[0]))
-    return [c for c,_ in ranked[:max_codes]]
+    for sent in sentences:
+        for code, score in per_sentence.get(sent, {}).items():
+            if score > scored.get(code, float("-inf")):
+                scored[code] = score
+    return scored
+
+def rank_from_index(note_text: str, index: PCSIndex, engine: TablesEngine, topk_hits=40, max_codes=100,
+                    keys: Optional[KeyMaps] = None, cache: Optional[NoteCache] = None,
+                    retriever: str = "fuzzy", weights: Optional[Weights] = None) -> List[Tuple[str, float]]:
+    # retriever: "fuzzy" (rapidfuzz) or "tfidf" (pcs_retrieval); `weights` tune pcs_scoring.
+    # Cached scores depend on both (and on keys / topk_hits), so use a separate `cache` per setting.
+    # Mine only the procedural sections (Procedure, Technique, Findings, ...), not history/meds
+    focus = high_yield_text(note_text)
+    kind, cached = cache.lookup(focus) if cache else (None, None)
+    if kind == "exact":
+        scored = cached.scores
+    else:
+        sentences = search_sentences(note_sentences(focus), retriever)
+        # Body part / device / substance mentions become axis constraints for the table walk
+        key_matches = keys.match(focus) if keys else []
+        context = tuple(sorted(t for t, _ in key_matches))
+        per_sentence: Dict[str, Dict[str, float]] = {}
+        if kind == "near" and cached.extra.get("context") == context:
+            # Templated near-duplicate: reuse the scores of sentences it shares, score only the ones that differ
+            per_sentence = {s: cached.per_sentence[s] for s in sentences if s in cached.per_sentence}
+        changed = [s for s in sentences if s not in per_sentence]
+        if changed:
+            per_sentence.update(score_sentences(changed, index, engine, topk_hits, key_matches, retriever, weights))
+        # Only the note's current sentences count, so nothing carries over from sentences it dropped
+        scored = merge_scores(per_sentence, sentences)
+        if cache:
+            cache.store(focus, scored, sentences, per_sentence=per_sentence, context=context)
+
+    # Rank by score (partial selection, no full sort)
+    return top_k(scored, max_codes)
+
+def suggest_from_index(note_text: str, index: PCSIndex, engine: TablesEngine, topk_hits=40, max_codes=100,
+                       keys: Optional[KeyMaps] = None, cache: Optional[NoteCache] = None,
+                       retriever: str = "fuzzy", weights: Optional[Weights] = None) -> List[str]:
+    # Codes only, best first; rank_from_index also returns their scores
+    return [c for c, _ in rank_from_index(note_text, index, engine, topk_hits, max_codes, keys, cache, retriever, weights)]
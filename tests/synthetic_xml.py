@@ -0,0 +1,56 @@
+# Small synthetic Tables / Index XML shared by the tests
+
+# A few tables across three body systems; the second row of each table allows
+# other devices for other body parts, so label lookups exercise the row rule.
+SYSTEMS = {
+    "S": ("Lower Joints", ["Hip Joint, Right", "Hip Joint, Left", "Knee Joint, Right", "Knee Joint, Left"]),
+    "R": ("Upper Joints", ["Shoulder Joint, Right", "Shoulder Joint, Left", "Elbow Joint, Right", "Elbow Joint, Left"]),
+    "Q": ("Lower Bones", ["Femoral Shaft, Right", "Femoral Shaft, Left", "Tibia, Right", "Tibia, Left"]),
+}
+PARTS = "9BCD"
+OPERATIONS = {"R": "Replacement", "B": "Excision", "H": "Insertion"}
+ROWS = {  # operation -> [(approaches, devices, qualifiers)] per row
+    "R": [({"0": "Open"}, {"J": "Synthetic Substitute", "K": "Nonautologous Tissue Substitute"},
+           {"9": "Cemented", "A": "Uncemented", "Z": "No Qualifier"}),
+          ({"0": "Open"}, {"7": "Autologous Tissue Substitute"}, {"Z": "No Qualifier"})],
+    "B": [({"0": "Open", "3": "Percutaneous", "4": "Percutaneous Endoscopic"}, {"Z": "No Device"},
+           {"X": "Diagnostic", "Z": "No Qualifier"})],
+    "H": [({"0": "Open", "3": "Percutaneous"}, {"4": "Internal Fixation Device", "5": "External Fixation Device"},
+           {"Z": "No Qualifier"}),
+          ({"4": "Percutaneous Endoscopic"}, {"M": "Stimulator Lead"}, {"Z": "No Qualifier"})],
+}
+
+def _axis(pos, title, labels):
+    inner = "".join(f'<label code="{c}">{t}</label>' for c, t in labels.items())
+    return f'<axis pos="{pos}" values="{len(labels)}"><title>{title}</title>{inner}</axis>'
+
+def tables_xml() -> bytes:
+    out = ['<?xml version="1.0" encoding="UTF-8"?><ICD10PCS.tabular><version>2025</version>']
+    for bs, (system, parts) in SYSTEMS.items():
+        for op, operation in OPERATIONS.items():
+            out.append("<pcsTable>" + _axis(1, "Section", {"0": "Medical and Surgical"})
+                       + _axis(2, "Body System", {bs: system}) + _axis(3, "Operation", {op: operation}))
+            for r, (approaches, devices, qualifiers) in enumerate(ROWS[op]):
+                body = dict(zip(PARTS, parts)) if r == 0 else dict(zip(PARTS[2:], parts[2:]))
+                out.append(f'<pcsRow codes="{len(body)}">' + _axis(4, "Body Part", body) + _axis(5, "Approach", approaches)
+                           + _axis(6, "Device", devices) + _axis(7, "Qualifier", qualifiers) + "</pcsRow>")
+            out.append("</pcsTable>")
+    out.append("</ICD10PCS.tabular>")
+    return "".join(out).encode()
+
+def index_xml() -> bytes:
+    out = ['<?xml version="1.0" encoding="UTF-8"?><ICD10PCS.index><version>2025</version>']
+    for op, operation in sorted(OPERATIONS.items(), key=lambda kv: kv[1]):
+        out.append(f"<letter><title>{operation[0]}</title><mainTerm><title>{operation}</title>")
+        for bs, (system, parts) in SYSTEMS.items():
+            out.append(f'<term level="2"><title>{system}</title><codes>0{bs}{op}</codes>')
+            for part, label in zip(PARTS, parts):
+                out.append(f'<term level="3"><title>{label}</title><codes>0{bs}{op}{part}</codes></term>')
+            out.append("</term>")
+        out.append("</mainTerm></letter>")
+    out.append('<letter><title>A</title><mainTerm><title>Arthroplasty</title>'
+               '<see>Replacement, Lower Joints <tab>0SR</tab></see>'
+               '<term level="2"><title>Knee</title><term level="3"><title>Left</title><codes>0SRD0JZ</codes></term></term>'
+               '</mainTerm><mainTerm><title>Hemiarthroplasty</title><use>Replacement</use></mainTerm></letter>')
+    out.append("</ICD10PCS.index>")
+    return "".join(out).encode()
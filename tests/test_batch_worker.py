@@ -0,0 +1,111 @@
+import multiprocessing
+import time
+
+import pytest
+
+from batch_worker import SqliteWorkQueue, WorkQueue, coordinate
+from pcs_sqlite import compile_db
+
+from synthetic_xml import index_xml, tables_xml
+
+NOTES = ["Left total knee arthroplasty, cemented.", "Percutaneous excision of right tibia lesion, diagnostic.",
+         "Open insertion of internal fixation device, left femoral shaft.", "Open replacement of right hip joint."]
+
+@pytest.fixture
+def queue(tmp_path):
+    q = SqliteWorkQueue(str(tmp_path / "q.db"), max_attempts=2)
+    q.enqueue([(f"n{i}", f"note {i}") for i in range(20)])
+    return q
+
+def test_work_queue_is_abstract():
+    with pytest.raises(TypeError):
+        WorkQueue()
+
+def test_enqueue_is_idempotent(queue):
+    assert queue.enqueue([("n0", "again"), ("n20", "new")]) == 1
+    assert queue.progress()["pending"] == 21
+
+def _claim_all(path, worker, out):
+    q = SqliteWorkQueue(path)
+    got = []
+    while True:
+        tasks = q.claim(worker, 3, lease_s=60)
+        if not tasks:
+            break
+        got += [t.note_id for t in tasks]
+    out.put(got)
+
+def test_claims_are_exclusive_across_processes(queue):
+    out = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=_claim_all, args=(queue.path, f"w{i}", out)) for i in range(4)]
+    for p in procs:
+        p.start()
+    claimed = [out.get(timeout=30) for _ in procs]
+    for p in procs:
+        p.join()
+    flat = [n for got in claimed for n in got]
+    assert sorted(flat) == sorted(f"n{i}" for i in range(20))  # every note once, none twice
+    assert queue.progress()["leased"] == 20
+
+def test_expired_lease_is_reclaimed(queue):
+    first = queue.claim("a", 20, lease_s=0.05)
+    assert len(first) == 20 and queue.claim("b", 20, lease_s=60) == []
+    time.sleep(0.1)
+    again = queue.claim("b", 5, lease_s=60)
+    assert [t.note_id for t in again] == [t.note_id for t in first[:5]]
+    assert all(t.attempts == 2 for t in again)
+    # The old holder's lease is gone: its extend() and fail() no longer touch the note
+    queue.fail("a", "n0", "late")
+    assert queue.claim("c", 20, lease_s=60)[0].note_id == "n5"
+
+def test_max_attempts_ends_in_failed(queue):
+    for _ in range(2):
+        tasks = queue.claim("a", 20, lease_s=60)
+        assert "n0" in [t.note_id for t in tasks]
+        for t in tasks:
+            queue.fail("a", t.note_id, "boom")
+    assert queue.claim("a", 20, lease_s=60) == []
+    p = queue.progress()
+    assert (p["failed"], p["pending"], p["leased"]) == (20, 0, 0)
+
+def test_expired_lease_without_attempts_left_ends_in_failed(queue):
+    queue.claim("a", 20, lease_s=0.01)
+    time.sleep(0.05)
+    queue.claim("b", 20, lease_s=0.01)
+    time.sleep(0.05)
+    assert queue.claim("c", 20, lease_s=60) == []
+    assert queue.progress()["failed"] == 20
+
+def test_complete_is_idempotent(queue):
+    queue.claim("a", 1, lease_s=0.01)
+    time.sleep(0.05)
+    queue.claim("b", 1, lease_s=60)
+    assert queue.complete("b", "n0", {"codes": ["0SRD0JZ"]}, 0.1) is True
+    # The expired holder finishing late does not overwrite the stored result
+    assert queue.complete("a", "n0", {"codes": []}, 0.2) is False
+    (note_id, worker, result, _, _), = queue.results()
+    assert (note_id, worker, result) == ("n0", "b", {"codes": ["0SRD0JZ"]})
+    assert queue.progress()["done"] == 1
+
+@pytest.fixture
+def notes_dir(tmp_path):
+    d = tmp_path / "notes"
+    d.mkdir()
+    for i in range(12):
+        (d / f"n{i:02d}.txt").write_text(NOTES[i % len(NOTES)])
+    return d
+
+@pytest.mark.parametrize("prefork", [False, True])
+def test_multi_process_run(tmp_path, notes_dir, prefork):
+    (tmp_path / "tables.xml").write_bytes(tables_xml())
+    (tmp_path / "index.xml").write_bytes(index_xml())
+    store = str(tmp_path / "pcs.db")
+    compile_db(store, tables_xml(), index_xml())
+    queue_path = str(tmp_path / "q.db")
+    report = coordinate(queue_path, None if prefork else store, [str(notes_dir)], workers=3,
+                        prefork=(str(tmp_path / "tables.xml"), str(tmp_path / "index.xml")) if prefork else None,
+                        batch=2, lease=30)
+    assert (report["done"], report["failed"], report["pending"], report["leased"]) == (12, 0, 0, 0)
+    assert sum(w["notes"] for w in report["workers"].values()) == 12
+    results = {n: r["codes"] for n, _, r, _, _ in SqliteWorkQueue(queue_path).results()}
+    assert "0SRD0J9" in results["n00.txt"] or "0SRD0JZ" in results["n00.txt"]
@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+from llm_batch import BATCH_PROMPT, BatchItem, FakeGemini, GeminiRestClient, LLMBatcher, pack, split_response
+from prompt_budget import estimate_tokens
+
+CODES = ["0SRD0J9", "0SRD0JZ", "0SRC0J9", "0SBD0ZX", "0SBD3ZZ", "0QHB04Z"]
+
+def items(n, codes=CODES, words=60):
+    return [BatchItem(f"n{i}", " ".join(f"sentence {i} word{j}." for j in range(words)), codes[i % 3:]) for i in range(n)]
+
+@pytest.fixture
+def fake():
+    with FakeGemini() as server:
+        yield server
+
+def test_pack_respects_budget_and_max_notes():
+    batch_items = items(20)
+    budget, max_notes = 1500, 4
+    batches = pack(batch_items, budget=budget, note_budget=400, max_notes=max_notes)
+    fixed = estimate_tokens(BATCH_PROMPT)
+    for batch in batches:
+        assert len(batch) <= max_notes
+        assert fixed + sum(estimate_tokens(section) for _, section in batch) <= budget
+    packed = [item.note_id for batch in batches for item, _ in batch]
+    assert sorted(packed) == sorted(i.note_id for i in batch_items)
+    assert len(batches) < len(batch_items)  # several notes share a request
+
+def test_batched_reply_is_split_per_note(fake):
+    batch_items = items(5)
+    batcher = LLMBatcher(GeminiRestClient(api_key="", base_url=fake.url), budget=8000, max_notes=8)
+    results = batcher.run(batch_items)
+    assert batcher.stats["calls"] == 1 and fake.requests == 1
+    for item in batch_items:
+        assert [c["code"] for c in results[item.note_id]] == item.codes
+
+def test_codes_outside_candidates_are_dropped():
+    a, b = BatchItem("a", "left knee", ["0SRD0J9", "0SRD0JZ"]), BatchItem("b", "tibia lesion")
+    reply = json.dumps({"notes": [
+        {"id": "a", "codes": [{"code": "0srd0jz", "confidence": 0.9}, {"code": "0SRC0J9", "confidence": 0.8}]},
+        {"id": "b", "codes": [{"code": "0QBJ0ZX"}, {"code": "0QBJ0Z"}, {"code": "XXXXXXX"}]},
+        {"id": "unknown", "codes": [{"code": "0SRD0J9"}]},
+    ]})
+    got = split_response(reply, [a, b], is_valid=lambda c: c.startswith("0Q"))
+    assert [c["code"] for c in got["a"]] == ["0SRD0JZ"]  # 0SRC0J9 was not a candidate of note a
+    assert [c["code"] for c in got["b"]] == ["0QBJ0ZX"]  # no candidates: only valid 7-char codes
+    assert set(got) == {"a", "b"}
+    assert split_response("not json", [a, b]) == {}
+
+def test_failed_batch_falls_back_to_single_notes():
+    # Every 2nd request is malformed: batch 1 ok, batch 2 fails, then n2 retried ok and n3 retried and fails
+    with FakeGemini(fail_every=2) as server:
+        batcher = LLMBatcher(GeminiRestClient(api_key="", base_url=server.url), budget=8000, max_notes=2)
+        batch_items = items(4)
+        results = batcher.run(batch_items)
+    assert batcher.stats == {**batcher.stats, "batches": 2, "calls": 4, "fallbacks": 2, "failed": 1}
+    for item in batch_items[:3]:
+        assert [c["code"] for c in results[item.note_id]] == item.codes
+    assert results["n3"] is None
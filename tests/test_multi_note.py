@@ -0,0 +1,28 @@
+import pytest
+
+pytest.importorskip("fitz")
+pytest.importorskip("docx")
+
+from utils.multi_note import code_notes, results_csv
+
+def fake_code(text):
+    return [{"code": "0SRD0JZ", "confidence": 0.9, "why": text}]
+
+def test_results_keep_upload_position_for_duplicate_names():
+    files = [("op.txt", b"first note"), ("op.txt", b"second note"), ("other.txt", b"third note")]
+    results = sorted(code_notes(files, fake_code, max_workers=2), key=lambda r: r.index)
+    assert [(r.index, r.name, r.status) for r in results] == [(0, "op.txt", "done"), (1, "op.txt", "done"),
+                                                              (2, "other.txt", "done")]
+    assert [r.suggestions[0]["why"] for r in results] == ["first note", "second note", "third note"]
+    assert all(r.text == "" for r in results)
+    assert results_csv(results).count("0SRD0JZ") == 3
+
+def test_rerank_runs_after_matching_and_failures_keep_suggestions():
+    files = [("a.txt", b"alpha"), ("b.txt", b"beta")]
+    reranked = {r.name: r for r in code_notes(files, fake_code, 2, rerank=lambda text, s: [{**s[0], "why": "llm " + text}])}
+    assert reranked["a.txt"].suggestions[0]["why"] == "llm alpha"
+
+    def broken(text, suggestions):
+        raise RuntimeError("quota")
+    kept = list(code_notes(files, fake_code, 2, rerank=broken))
+    assert all(r.status == "done" and r.suggestions and "quota" in r.error for r in kept)
@@ -0,0 +1,60 @@
+from note_cache import NoteCache, fingerprint
+from pcs_index import PCSIndex
+from pcs_tables_engine import TablesEngine
+from suggest_from_index import MAX_SENTENCES, suggest_from_index
+
+from synthetic_xml import index_xml, tables_xml
+
+BOILERPLATE = ("The patient was brought to the operating room and placed supine. General anesthesia was induced. "
+               "The extremity was prepped and draped in the usual sterile fashion. A timeout was performed. "
+               "Estimated blood loss was minimal. The patient tolerated the procedure well and went to recovery. ")
+
+def test_exact_hit_ignores_case_space_and_dates():
+    cache = NoteCache()
+    cache.store("Left knee replacement on 01/02/2025.", {"0SRD0JZ": 1.0})
+    kind, entry = cache.lookup("LEFT  knee replacement on 03/04/2025")
+    assert kind == "exact" and entry.scores == {"0SRD0JZ": 1.0}
+    # Levels and counts are not volatile: a different level is a different note
+    assert fingerprint("L4 laminectomy") != fingerprint("L5 laminectomy")
+    assert cache.stats()["exact_hits"] == 1
+
+def test_near_duplicate_hit_and_threshold():
+    cache = NoteCache(threshold=0.8)
+    cache.store(BOILERPLATE + "Left knee replacement with cemented synthetic substitute.", {"0SRD0J9": 1.0})
+    kind, entry = cache.lookup(BOILERPLATE + "Right knee replacement with cemented synthetic substitute.")
+    assert kind == "near" and entry.scores == {"0SRD0J9": 1.0}
+    assert cache.lookup("Percutaneous excision of a right tibia lesion for diagnosis.") == (None, None)
+    stats = cache.stats()
+    assert (stats["near_hits"], stats["misses"]) == (1, 1)
+
+def test_eviction_drops_exact_and_near_entries():
+    cache = NoteCache(maxsize=2)
+    notes = ["Left total knee arthroplasty, cemented.", "Percutaneous excision of right tibia lesion.",
+             "Open insertion of internal fixation device, left femoral shaft."]
+    for i, note in enumerate(notes):
+        cache.store(note, {str(i): 1.0})
+    assert cache.stats()["evictions"] == 1 and cache.stats()["size"] == 2
+    # The least recently used note is gone from both the LRU and its LSH bands
+    assert cache.lookup(notes[0]) == (None, None)
+    assert cache.lookup(notes[2])[0] == "exact"
+
+def test_near_duplicate_scores_equal_a_fresh_run():
+    engine, index = TablesEngine.from_bytes(tables_xml()), PCSIndex.from_bytes(index_xml())
+    first = BOILERPLATE + "Open excision of the left knee joint, diagnostic."
+    second = BOILERPLATE + "Open replacement of the left knee joint with synthetic substitute, cemented."
+    for retriever in ("fuzzy", "tfidf"):
+        cache = NoteCache()
+        suggest_from_index(first, index, engine, cache=cache, retriever=retriever)
+        reused = suggest_from_index(second, index, engine, cache=cache, retriever=retriever)
+        assert cache.stats()["near_hits"] == 1
+        # Nothing from the dropped excision sentence carries over
+        assert reused == suggest_from_index(second, index, engine, retriever=retriever)
+
+def test_fuzzy_searches_per_note_are_capped():
+    engine, index = TablesEngine.from_bytes(tables_xml()), PCSIndex.from_bytes(index_xml())
+    calls = []
+    search = index.search
+    index.search = lambda *a, **k: calls.append(a[0]) or search(*a, **k)
+    note = " ".join(f"Step {k}: the left knee joint was exposed and component {k} was cemented." for k in range(40))
+    suggest_from_index(note, index, engine)
+    assert len(calls) <= MAX_SENTENCES * 3 and len(calls) == len(set(calls))
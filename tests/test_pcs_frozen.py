@@ -0,0 +1,76 @@
+import os
+import sys
+
+import pytest
+
+from pcs_frozen import FrozenIndexTree, FrozenTablesEngine, build_engines, measure
+from pcs_index import IndexTree, PCSIndex
+from pcs_tables_engine import TablesEngine
+from suggest_from_index import suggest_from_index
+
+from synthetic_xml import index_xml, tables_xml
+
+NOTES = [
+    "Left total knee arthroplasty, cemented. Synthetic substitute placed through an open approach.",
+    "Percutaneous excision of right tibia lesion, diagnostic.",
+    "Open insertion of internal fixation device, left femoral shaft.",
+]
+
+@pytest.fixture(scope="module")
+def engines():
+    plain_tables = TablesEngine.from_bytes(tables_xml())
+    tree = IndexTree.from_bytes(index_xml())
+    tree.retriever()
+    return {
+        "plain": (plain_tables, PCSIndex(tree)),
+        "frozen": (FrozenTablesEngine.freeze(plain_tables), PCSIndex(FrozenIndexTree.freeze(tree))),
+    }
+
+def test_tables_parity(engines):
+    plain, frozen = engines["plain"][0], engines["frozen"][0]
+    codes = plain.expand("0", limit=10000)
+    assert codes and frozen.expand("0", limit=10000) == codes
+    prefixes = sorted({c[:n] for c in codes for n in range(1, 8)}) + ["", "0SRD0J", "0SRX", "1", "0SRD0JZZ"]
+    for p in prefixes:
+        assert frozen.is_valid(p) == plain.is_valid(p), p
+        assert frozen.is_potential_prefix(p) == plain.is_potential_prefix(p), p
+        assert frozen.next_chars(p) == plain.next_chars(p), p
+        assert frozen.autocomplete(p) == plain.autocomplete(p), p
+        assert frozen.nearest_explanations(p) == plain.nearest_explanations(p), p
+    for c in codes:
+        assert frozen.axis_labels(c) == plain.axis_labels(c), c
+        assert frozen.explain(c) == plain.explain(c), c
+    for hints in ({5: {"0"}, 7: {"9", "Z"}}, {4: {"X"}}, {3: {"B"}, 6: {"Z"}}, {1: {"0"}, 8: {"Z"}}):
+        for prefix, limit in (("0SR", 100), ("0", 3), ("0SRD0JZ", 5), ("0SX", 5)):
+            expected = plain.expand(prefix, limit=limit, constraints=hints)
+            assert frozen.expand(prefix, limit=limit, constraints=hints) == expected, (hints, prefix, limit)
+    assert sorted(frozen.iter_axis_labels()) == sorted(plain.iter_axis_labels())
+
+def test_index_and_suggest_parity(engines):
+    (plain_tables, plain_index), (frozen_tables, frozen_index) = engines["plain"], engines["frozen"]
+    assert frozen_index.tree.paths()[:] == plain_index.tree.paths()
+    for query in ["knee replacement left", "arthroplasty", "excision tibia", "hemiarthroplasty", "fixation femoral"]:
+        for method in ("fuzzy", "tfidf"):
+            assert frozen_index.search(query, method=method) == plain_index.search(query, method=method), (query, method)
+    for note in NOTES:
+        for method in ("fuzzy", "tfidf"):
+            expected = suggest_from_index(note, plain_index, plain_tables, retriever=method)
+            assert expected
+            assert suggest_from_index(note, frozen_index, frozen_tables, retriever=method) == expected
+
+def test_build_engines_frozen_flag():
+    frozen = build_engines(tables_xml(), index_xml(), frozen=True)
+    plain = build_engines(tables_xml(), index_xml(), frozen=False)
+    assert isinstance(frozen["tables"], FrozenTablesEngine) and isinstance(frozen["index"].tree, FrozenIndexTree)
+    assert not isinstance(plain["tables"], FrozenTablesEngine)
+
+@pytest.mark.skipif(not sys.platform.startswith("linux") or not os.path.exists("/proc/self/smaps_rollup"),
+                    reason="measure() reads /proc/<pid>/smaps_rollup")
+def test_prefork_private_growth():
+    report = measure(tables_xml(), index_xml(), NOTES, workers=2, frozen=True, rounds=3)
+    assert report["exit_codes"] == [0, 0]
+    assert len(report["per_worker"]) == 2
+    for w in report["per_worker"]:
+        # Warm lookups on frozen engines should not copy shared pages. A worker can still see ~2 MiB
+        # turn private when the parent or a sibling touches or drops its copy, whatever the work done.
+        assert w["private_growth_kib"] < 8192, w
@@ -0,0 +1,42 @@
+import sqlite3
+
+from search_cache import SearchCache
+
+def rows(path):
+    return sqlite3.connect(path).execute("SELECT count(*) FROM search_cache").fetchone()[0]
+
+def test_memo_and_fingerprint_isolation():
+    cache = SearchCache(maxsize=8)
+    assert cache.get_or_compute("a", "knee", 5, 70, lambda: [(1, 90.0)]) == [(1, 90.0)]
+    assert cache.get_or_compute("a", "knee", 5, 70, lambda: [(9, 0.0)]) == [(1, 90.0)]
+    # Another Index: computed afresh, and the first one's entry is still there
+    assert cache.get_or_compute("b", "knee", 5, 70, lambda: [(2, 80.0)]) == [(2, 80.0)]
+    assert cache.get_or_compute("a", "knee", 5, 70, lambda: [(9, 0.0)]) == [(1, 90.0)]
+
+def test_disk_writes_are_batched_and_survive_restart(tmp_path):
+    path = str(tmp_path / "sc.db")
+    cache = SearchCache(maxsize=8, path=path, flush_every=3)
+    for q in ("a", "b"):
+        cache.get_or_compute("fp", q, 5, 70, lambda: [(1, 90.0)])
+    assert rows(path) == 0  # below flush_every: nothing committed yet
+    cache.get_or_compute("fp", "c", 5, 70, lambda: [(1, 90.0)])
+    assert rows(path) == 3
+    cache.get_or_compute("fp", "d", 5, 70, lambda: [(4, 75.0)])
+    cache.flush()
+    reopened = SearchCache(maxsize=8, path=path)
+    assert reopened.get_or_compute("fp", "d", 5, 70, lambda: []) == [(4, 75.0)]
+    assert reopened.stats()["disk_hits"] == 1
+
+def test_disk_table_is_bounded_lru(tmp_path):
+    path = str(tmp_path / "sc.db")
+    cache = SearchCache(maxsize=2, path=path, max_rows=4, flush_every=1)
+    for i in range(4):
+        cache.get_or_compute("old", f"q{i}", 5, 70, lambda: [(i, 90.0)])
+    # A disk hit on q0 makes it recent; new rows then push out the least recently used
+    fresh = SearchCache(maxsize=2, path=path, max_rows=4, flush_every=1)
+    fresh.get_or_compute("old", "q0", 5, 70, lambda: [])
+    for i in range(3):
+        fresh.get_or_compute("new", f"q{i}", 5, 70, lambda: [(i, 80.0)])
+    assert rows(path) == 4
+    kept = {(fp, key.split("|")[-1]) for fp, key in sqlite3.connect(path).execute("SELECT fp, key FROM search_cache")}
+    assert kept == {("old", "q0"), ("new", "q0"), ("new", "q1"), ("new", "q2")}
@@ -1,10 +1,14 @@
 
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Set, Tuple
 import re
 from rapidfuzz import fuzz
-from .index_parser import IndexStore
+from .index_parser import IndexEntry, IndexStore
 from .tables_engine import TablesEngine
 from .definitions import DefinitionsStore
+from .incremental import IncrementalAnalysis, merge_candidates, split_sentences
+from pcs_keys import KeyMaps
+from pcs_scoring import CandidateSet, Weights, top_k
+from note_sections import high_yield_text
 
 # Simple keyword hints for approach & diagnostic qualifier
 APPROACH_HINTS = {
@@ -28,62 +32,114 @@ def is_biopsy(text: str) -> bool:
     t = text.lower()
     return any(w in t for w in ["biopsy", "bx", "diagnostic sample", "diagnostic excision"])
 
-def suggest_codes(text: str, index_store: IndexStore, tables_engine: TablesEngine, defs_store: DefinitionsStore) -> List[Dict[str, Any]]:
+# Stems match as prefixes (implants, prosthesis); short words must end there ("leading", "drainage" are not devices)
+DEVICE_RE = re.compile(r"\b(implant|prosthe|graft|stent|catheter|device|pacemaker|defibrillator|screw|mesh|generator|spacer"
+                       r"|(?:lead|plate|rod|port|drain|pump)s?\b)", re.I)
+
+def expansion_hints(text: str) -> Dict[int, Set[str]]:
+    # Axis pos -> preferred chars, applied while walking the tables (soft per node)
+    hints: Dict[int, Set[str]] = {}
+    approach_ch = detect_approach(text)
+    if approach_ch:
+        hints[5] = {approach_ch}
+    if not DEVICE_RE.search(text):
+        hints[6] = {"Z"}  # no device documented
+    if is_biopsy(text):
+        hints[7] = {"X"}  # diagnostic qualifier
+    return hints
+
+def definition_evidence(defs_store: DefinitionsStore, path: str) -> List[str]:
+    # Root operation / term definitions for the Index path (e.g. "E > Excision > Knee Joint")
+    if not defs_store:
+        return []
+    for part in path.split(" > ")[1:]:
+        for d in defs_store.find_all(part):
+            if d.text:
+                return [f"{d.title}: {d.text}"]
+    return []
+
+def candidates_from_hits(hits: List[Tuple[str, int, IndexEntry]], index_store: IndexStore, tables_engine: TablesEngine,
+                         defs_store: DefinitionsStore, hints: Dict[int, Set[str]], key_matches: list, words: Set[str],
+                         weights: Optional[Weights] = None) -> List[Dict[str, Any]]:
+    # Every code found becomes a feature row (pcs_scoring); one scoring pass ranks them all
+    biopsy = 7 in hints
+    cands = CandidateSet()
+
+    for path, score, entry in hits:
+        evidence = [path] + entry.uses[:2] + entry.sees[:1] + definition_evidence(defs_store, path)
+        depth = len(path.split(" > ")) - 1
+        # Codes on the entry itself, then codes of entries it points to via see/use
+        sources = [(code, 0, f"Matched Index path: {path} (score {score}).") for code in entry.codes]
+        for code, target, hops in index_store.referenced_codes(entry, words):
+            sources.append((code, hops, f"Matched Index path: {path} (score {score}), followed to {index_store.path_of(target)}."))
+
+        for code, hops, why in sources:
+            c = code.strip().upper()
+            code_hints = {**hints, **KeyMaps.constraints(key_matches, c)}
+            if len(c) == 7:
+                cands.add([c], score, depth=depth, exact=True, hops=hops, hints=code_hints,
+                          meta=(why, evidence, tables_engine.is_valid(c)))
+                if biopsy and c[6] != "X" and tables_engine.is_valid(c[:6] + "X"):
+                    # Diagnostic-qualifier variant, only where the table allows it; the qualifier hint ranks it up
+                    cands.add([c[:6] + "X"], score, depth=depth, exact=True, hops=hops, hints=code_hints,
+                              meta=(why + " Diagnostic qualifier for biopsy.", evidence, True))
+            elif 3 <= len(c) <= 6:
+                # Partial codes: walk the tables under the prefix, pruned by note hints (take a few)
+                cands.add(tables_engine.expand_from_prefix(c, hints=code_hints, limit=5), score, depth=depth, hops=hops,
+                          hints=code_hints, meta=(f"Index partial code {c} expanded within the tables using note hints.", evidence, True))
+
+    suggestions = []
+    for code, score, row in cands.top(weights=weights):
+        why, evidence, validated = cands.meta[row]
+        suggestions.append({
+            "code": code,
+            "score": score,
+            "confidence": round(min(0.99, max(0.0, score)), 4),
+            "validated": validated,
+            "why": why,
+            "evidence": evidence,
+            "features": cands.features(row),
+        })
+    return suggestions
+
+def suggest_codes(text: str, index_store: IndexStore, tables_engine: TablesEngine, defs_store: DefinitionsStore,
+                  key_maps: Optional[KeyMaps] = None, analysis: Optional[IncrementalAnalysis] = None,
+                  retriever: str = "fuzzy", weights: Optional[Weights] = None) -> List[Dict[str, Any]]:
+    # retriever: "fuzzy" (rapidfuzz token_set_ratio) or "tfidf" (sparse TF-IDF, pcs_retrieval)
     if not index_store:
         return []
+    cutoff = 72 if retriever == "fuzzy" else None  # None: the retriever's own default
 
-    # Extract key phrases (very light v1)
-    phrases = re.findall(r"[A-Za-z][A-Za-z \-/]{3,}", text)
-    query = " ".join(phrases[:60])  # cap length
+    # Procedural sections only (Procedure, Technique, Findings, ...)
+    text = high_yield_text(text)
 
-    hits = index_store.search(query, topk=30, score_cutoff=72)
+    hints = expansion_hints(text)
+    # Body part / device / substance mentions (key files + table labels)
+    key_matches = key_maps.match(text) if key_maps else []
 
-    approach_ch = detect_approach(text)
-    biopsy = is_biopsy(text)
+    if analysis is None:
+        # Extract key phrases (very light v1)
+        phrases = re.findall(r"[A-Za-z][A-Za-z \-/]{3,}", text)
+        query = " ".join(phrases[:60])  # cap length
 
-    suggestions: List[Dict[str, Any]] = []
-    seen = set()
+        hits = index_store.search(query, topk=30, score_cutoff=cutoff, method=retriever)
+        words = set(re.findall(r"[a-z0-9]+", text.lower()))
+        suggestions = candidates_from_hits(hits, index_store, tables_engine, defs_store, hints, key_matches, words, weights)
+    else:
+        # Per-sentence search; only sentences changed since the previous run are searched again
+        context = (tuple(sorted((k, tuple(sorted(v))) for k, v in hints.items())), tuple(sorted(t for t, _ in key_matches)),
+                   weights)
+        per_sentence = analysis.update(
+            split_sentences(text),
+            context,
+            search=lambda s: index_store.search(s, topk=10, score_cutoff=cutoff, method=retriever),
+            build=lambda s, hits: candidates_from_hits(hits, index_store, tables_engine, defs_store, hints, key_matches,
+                                                      set(re.findall(r"[a-z0-9]+", s.lower())), weights),
+            # A different Index or Tables upload invalidates every cached sentence
+            search_context=(retriever, cutoff, index_store.tree.fingerprint, tables_engine.meta.get("digest")),
+        )
+        suggestions = merge_candidates(per_sentence)
 
-    for path, score, entry in hits:
-        # Prefer codes present in the entry
-        for code in entry.codes:
-            c = code.strip().upper()
-            if len(c) == 7 and c not in seen:
-                validated = tables_engine.is_valid(c)
-                why = f"Matched Index path: {path} (score {score})."
-                if biopsy and c.endswith("Z"):
-                    # some tables use qualifier X for diagnostic biopsies (not universal)
-                    c = c[:-1] + "X"
-                suggestions.append({
-                    "code": c,
-                    "confidence": min(0.99, score/100.0),
-                    "validated": validated,
-                    "why": why,
-                    "evidence": [path] + entry.uses[:2] + entry.sees[:1]
-                })
-                seen.add(c)
-
-        # If partial codes exist (e.g., 3-4 chars), try to complete with defaults
-        for code in entry.codes:
-            c = code.strip().upper()
-            if c in seen:
-                continue
-            if len(c) in (3,4):
-                expanded = tables_engine.expand_from_prefix(c)
-                if approach_ch:
-                    expanded = [e for e in expanded if len(e)==7 and e[4]==approach_ch] or expanded
-                # take a few
-                for e in expanded[:5]:
-                    if e not in seen:
-                        suggestions.append({
-                            "code": e,
-                            "confidence": min(0.85, score/100.0 - 0.05),
-                            "validated": tables_engine.is_valid(e),
-                            "why": f"Index partial code {c} expanded to plausible codes (tables-lite).",
-                            "evidence": [path] + entry.uses[:2] + entry.sees[:1]
-                        })
-                        seen.add(e)
-
-    # De-dup and sort
-    suggestions.sort(key=lambda x: (-x["confidence"], x["code"]))
-    return suggestions[:30]
+    # Top 30 by score (partial selection)
+    by_code = {s["code"]: s for s in suggestions}
+    return [by_code[c] for c, _ in top_k({c: s["score"] for c, s in by_code.items()}, 30)]
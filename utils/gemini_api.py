@@ -1,39 +1,55 @@
 
-from typing import List, Dict, Any
+from typing import Callable, List, Dict, Any, Optional
 import os
 
 # Uses the new google-genai client:
 # pip install google-genai
 from google import genai
 
+from prompt_budget import build_prompt, compact_candidates
+from pcs_scoring import Weights, rerank_with_llm
+
 BASE_SYS_MSG = """You are assisting with ICD-10-PCS coding.
 - Never invent a PCS code; all codes come from the official Index/Tables.
 - Your job: re-rank given candidate codes and write a short, coder-friendly rationale.
 - If documentation is ambiguous, prefer multiple codes with clear notes about ambiguity.
 """
 
-def gemini_rerank_and_explain(api_key: str, model: str, text: str, suggestions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    if not api_key:
-        return suggestions
+PROMPT = BASE_SYS_MSG + """
+Procedure note (most relevant procedural sentences):
+{note}
 
-    client = genai.Client(api_key=api_key)
+Candidates to re-rank and explain, one line per shared code prefix ("prefix (labels): suffix(conf) ..."; axes that differ are labelled in [...]):
+{candidates}
 
-    # Build prompt with current candidates
-    candidates_str = "\n".join([
-        f"- {s.get('code','(partial)')} | conf={s.get('confidence',0):.2f} | why={s.get('why','')} | evidence={'; '.join(s.get('evidence',[])[:3])}"
-        for s in suggestions
-    ])
+Return JSON list with keys: code (full 7 characters), confidence, why (1–3 lines), evidence (<=3 short quotes).
+"""
 
-    prompt = f"""{BASE_SYS_MSG}
+def gemini_rerank_and_explain(api_key: str, model: str, text: str, suggestions: List[Dict[str, Any]],
+                              weights: Optional[Weights] = None, max_prompt_tokens: int = 1500,
+                              labels: Optional[Callable[[str], List[str]]] = None,
+                              stats: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """Re-rank `suggestions` with the model's confidence as a scoring feature.
 
-Procedure note:
-{text[:4000]}
+    The prompt stays within `max_prompt_tokens` (estimated); `labels` (e.g.
+    TablesEngine.axis_labels) names the axes of the candidate codes. When
+    `stats` is given it receives the prompt's token counts.
+    """
+    if not api_key:
+        return suggestions
 
-Candidates to re-rank and explain:
-{candidates_str}
+    # GEMINI_BASE_URL points the client at another endpoint (e.g. llm_batch.FakeGemini)
+    base_url = os.getenv("GEMINI_BASE_URL")
+    client = genai.Client(api_key=api_key, http_options={"base_url": base_url} if base_url else None)
 
-Return JSON list with keys: code, confidence, why (1–3 lines), evidence (<=3 short quotes).
-"""
+    # Candidates as compact per-prefix code lists; the note gets whatever budget is left
+    codes = [s["code"] for s in suggestions if s.get("code")]
+    conf = {s["code"]: float(s.get("confidence", 0)) for s in suggestions if s.get("code")}
+    terms = " ".join(" ".join([s.get("why", "")] + list(s.get("evidence", [])[:3])) for s in suggestions).split()
+    prompt, prompt_stats = build_prompt(PROMPT, text, max_prompt_tokens,
+                                        candidates=compact_candidates(codes, labels=labels, confidences=conf), terms=terms)
+    if stats is not None:
+        stats.update(prompt_stats)
 
     res = client.models.generate_content(
         model=model,
@@ -46,21 +62,11 @@ Return JSON list with keys: code, confidence, why (1–3 lines), evidence (<=3 s
     )
 
     try:
-        enriched = res.text
         import json
-        parsed = json.loads(enriched)
-        # Merge back into original list (keep only codes we already proposed)
-        codes_set = {s.get("code") for s in suggestions}
-        final = []
-        for item in parsed:
-            if item.get("code") in codes_set:
-                final.append({
-                    **next(s for s in suggestions if s.get("code")==item.get("code")),
-                    "confidence": float(item.get("confidence", 0)),
-                    "why": item.get("why", ""),
-                    "evidence": item.get("evidence", [])
-                })
+        parsed = json.loads(res.text)
+        # The model's confidence is one more scoring feature next to the Index/Tables evidence
+        ranked = rerank_with_llm(suggestions, parsed, weights)
         # Fallback if parse fails to preserve original order
-        return final or suggestions
+        return ranked or suggestions
     except Exception:
         return suggestions
@@ -0,0 +1,69 @@
+
+from typing import Any, Callable, Dict, Hashable, List
+import re
+
+def split_sentences(text: str) -> List[str]:
+    out = []
+    for chunk in re.split(r"(?<=[.;])\s+|\n+", text or ""):
+        s = " ".join(chunk.split())
+        if len(s) >= 4:
+            out.append(s)
+    return out
+
+def merge_candidates(per_sentence: List[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    # One row per code, keeping the most confident sentence's candidate
+    best: Dict[str, Dict[str, Any]] = {}
+    for cands in per_sentence:
+        for c in cands:
+            cur = best.get(c["code"])
+            if cur is None or c.get("score", c["confidence"]) > cur.get("score", cur["confidence"]):
+                best[c["code"]] = c
+    return [dict(c) for c in best.values()]
+
+class IncrementalAnalysis:
+    """Per-sentence search results for one note, reused across edits.
+
+    update() diffs the new sentence list against the previous version by
+    sentence text: unchanged (or merely moved) sentences reuse their hits and
+    only new/edited ones are searched. Candidate lists are rebuilt from the
+    cached hits when the note-level context (approach, biopsy, key-file
+    matches) changes; the hits themselves are dropped when the search
+    context (retriever, cutoff, ...) changes.
+    """
+
+    def __init__(self):
+        self.sentences: List[str] = []
+        self.hits: Dict[str, Any] = {}
+        self.candidates: Dict[str, List[Dict[str, Any]]] = {}
+        self.context: Hashable = None
+        self.search_context: Hashable = None
+        self.searched = 0  # sentences searched on the last update
+
+    def update(self, sentences: List[str], context: Hashable,
+               search: Callable[[str], Any],
+               build: Callable[[str, Any], List[Dict[str, Any]]],
+               search_context: Hashable = None) -> List[List[Dict[str, Any]]]:
+        if search_context != self.search_context:
+            # Hits from another retriever / cutoff are not reusable
+            self.hits = {}
+            self.candidates = {}
+            self.search_context = search_context
+        if context != self.context:
+            self.candidates = {}
+            self.context = context
+
+        self.searched = 0
+        for s in sentences:
+            if s not in self.hits:
+                self.hits[s] = search(s)
+                self.candidates.pop(s, None)
+                self.searched += 1
+            if s not in self.candidates:
+                self.candidates[s] = build(s, self.hits[s])
+
+        # Forget sentences that left the note
+        keep = set(sentences)
+        self.hits = {s: h for s, h in self.hits.items() if s in keep}
+        self.candidates = {s: c for s, c in self.candidates.items() if s in keep}
+        self.sentences = list(sentences)
+        return [self.candidates[s] for s in sentences]
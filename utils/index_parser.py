@@ -1,78 +1,76 @@
 
-from dataclasses import dataclass
 from typing import List, Dict, Optional, Tuple, Any
-from lxml import etree
-from rapidfuzz import fuzz, process
 
-@dataclass
+from pcs_index import IndexTree
+
 class IndexEntry:
-    path: str               # hierarchical path of titles
-    title: str              # current node title
-    codes: List[str]        # codes found under this node
-    uses: List[str]         # 'use' synonyms
-    sees: List[str]         # 'see' references (raw text)
+    """Lightweight view of one Index node; fields are read from the shared IndexTree."""
+    __slots__ = ("tree", "node")
+
+    def __init__(self, tree: IndexTree, node: int):
+        self.tree = tree
+        self.node = node
+
+    @property
+    def path(self) -> str:
+        # hierarchical path of titles
+        return " > ".join(self.tree.titles_of(self.node))
+
+    @property
+    def title(self) -> str:
+        return self.tree.title(self.node)
+
+    def _collect(self, *fields: Dict[int, Tuple[str, ...]]) -> List[str]:
+        out: List[str] = []
+        for n in self.tree.subtree(self.node):
+            for f in fields:
+                out.extend(f.get(n, ()))
+        return out
+
+    @property
+    def codes(self) -> List[str]:
+        # codes found under this node (including nested terms and see/use refs)
+        return self._collect(self.tree.codes, self.tree.nested)
+
+    @property
+    def uses(self) -> List[str]:
+        return self._collect(self.tree.uses)
+
+    @property
+    def sees(self) -> List[str]:
+        # 'see' references (raw text)
+        return self._collect(self.tree.sees)
+
+    def __repr__(self) -> str:
+        return f"IndexEntry(path={self.path!r}, codes={self.codes!r})"
 
 class IndexStore:
-    def __init__(self, entries: List[IndexEntry]):
-        self.entries = entries
-        # Build searchable corpus of phrases
-        self.corpus = [e.path for e in entries]
+    def __init__(self, tree: IndexTree):
+        self.tree = tree
+
+    @property
+    def corpus(self) -> List[str]:
+        # Searchable corpus of phrases, materialized once by the tree
+        return self.tree.paths()
+
+    @property
+    def entries(self) -> List[IndexEntry]:
+        return [IndexEntry(self.tree, n) for n in self.tree.entries]
 
     @classmethod
-    def from_bytes(cls, b: bytes) -> "IndexStore":
-        root = etree.fromstring(b)
-        entries: List[IndexEntry] = []
-
-        def collect(node, path_parts):
-            # Titles
-            title_el = node.find("title")
-            title = title_el.text if title_el is not None else ""
-            path = " > ".join([*path_parts, title]).strip(" >")
-
-            # Codes
-            codes = [c.text for c in node.findall(".//code")] + [c.text for c in node.findall(".//codes")]
-            codes = [c.strip() for c in codes if c is not None]
-
-            # Uses
-            uses = [u.text for u in node.findall(".//use") if u is not None and u.text]
-
-            # See refs (store raw inner text)
-            sees = []
-            for sel in node.findall(".//see"):
-                # Combine element text and any child text
-                txt = "".join(sel.itertext())
-                if txt:
-                    sees.append(txt)
-
-            if title:
-                entries.append(IndexEntry(path=path, title=title, codes=codes, uses=uses, sees=sees))
-
-            # Recurse into term children
-            for child in node.findall("term"):
-                collect(child, [*path_parts, title])
-
-        # Walk all letters → mainTerm nodes
-        for letter in root.findall("letter"):
-            for main in letter.findall("mainTerm"):
-                collect(main, [letter.findtext("title","")])
-
-        return cls(entries)
-
-    def search(self, phrase: str, topk: int = 25, score_cutoff: int = 75) -> List[Tuple[str, int, IndexEntry]]:
-        if not phrase.strip():
-            return []
-        results = process.extract(
-            query=phrase,
-            choices=self.corpus,
-            scorer=fuzz.token_set_ratio,
-            limit=topk,
-            score_cutoff=score_cutoff
-        )
-        # Map back to entries by path
-        path_to_entry = {e.path: e for e in self.entries}
-        hits: List[Tuple[str,int,IndexEntry]] = []
-        for path, score, _ in results:
-            entry = path_to_entry.get(path)
-            if entry:
-                hits.append((path, score, entry))
-        return hits
+    def from_bytes(cls, b: bytes, cache=None) -> "IndexStore":
+        return cls(IndexTree.from_bytes(b, cache=cache))
+
+    def path_of(self, node: int) -> str:
+        return " > ".join(self.tree.titles_of(node))
+
+    def referenced_codes(self, entry: IndexEntry, words: Optional[set] = None) -> List[Tuple[str, int, int]]:
+        # (code, target node, hops) from the see/use graph; no extra fuzzy searches
+        return self.tree.referenced_codes(entry.node, words)
+
+    def search(self, phrase: str, topk: int = 25, score_cutoff: Optional[int] = 75,
+               method: str = "fuzzy") -> List[Tuple[str, int, IndexEntry]]:
+        # Shared (optionally memoized) tree search; method "tfidf" uses the sparse retriever
+        paths = self.corpus
+        return [(paths[idx], score, IndexEntry(self.tree, self.tree.entries[idx]))
+                for idx, score in self.tree.search(phrase, limit=topk, score_cutoff=score_cutoff, method=method)]
@@ -0,0 +1,140 @@
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+from concurrent.futures import FIRST_COMPLETED, Executor, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from io import BytesIO
+import csv
+import io
+import json
+import multiprocessing
+import sys
+import time
+
+from utils.text_extract import extract_text_from_file
+from utils.incremental import IncrementalAnalysis
+
+@dataclass
+class NoteResult:
+    name: str
+    index: int = 0  # position in the upload list; names need not be unique
+    status: str = "queued"  # queued -> done / failed
+    suggestions: List[Dict[str, Any]] = field(default_factory=list)
+    error: str = ""
+    seconds: float = 0.0
+    chars: int = 0
+    text: str = field(default="", repr=False)  # extracted text, kept only until the optional re-rank
+
+def code_note(name: str, data: bytes, code: Callable[[str], List[Dict[str, Any]]], index: int = 0) -> NoteResult:
+    # Extract + code one uploaded file; errors are kept on the result instead of raised
+    t0 = time.perf_counter()
+    res = NoteResult(name, index)
+    try:
+        buf = BytesIO(data)
+        buf.name = name
+        text = extract_text_from_file(buf)
+        res.chars = len(text)
+        res.text = text
+        res.suggestions = code(text)
+        res.status = "done"
+    except Exception as e:
+        res.status, res.error = "failed", str(e)
+    res.seconds = round(time.perf_counter() - t0, 2)
+    return res
+
+_worker_code: Optional[Callable[[str], List[Dict[str, Any]]]] = None  # set in each matching worker
+
+def _install_coder(code: Callable[[str], List[Dict[str, Any]]]):
+    # Pool initializer: forked workers inherit `code` (engines and all) instead of unpickling it
+    global _worker_code
+    _worker_code = code
+
+def _match(name: str, data: bytes, index: int) -> NoteResult:
+    return code_note(name, data, _worker_code, index)
+
+def _match_pool(max_workers: int, code: Callable[[str], List[Dict[str, Any]]]) -> Tuple[Executor, Callable[..., NoteResult]]:
+    # Index matching is CPU-bound Python, so it runs in forked processes that share the parent's engines.
+    # Elsewhere it falls back to threads, which serialize on the GIL.
+    if sys.platform.startswith("linux"):
+        return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("fork"),
+                                   initializer=_install_coder, initargs=(code,)), _match
+    return (ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pcs-note"),
+            lambda name, data, index: code_note(name, data, code, index))
+
+def _rerank(res: NoteResult, rerank: Callable[[str, List[Dict[str, Any]]], List[Dict[str, Any]]]) -> NoteResult:
+    # Keeps the Index suggestions when the re-rank fails
+    t0 = time.perf_counter()
+    try:
+        res.suggestions = rerank(res.text, res.suggestions)
+    except Exception as e:
+        res.error = f"Gemini step skipped: {e}"
+    res.seconds = round(res.seconds + time.perf_counter() - t0, 2)
+    return res
+
+def code_notes(files: Sequence[tuple], code: Callable[[str], List[Dict[str, Any]]], max_workers: int = 4,
+               rerank: Optional[Callable[[str, List[Dict[str, Any]]], List[Dict[str, Any]]]] = None) -> Iterator[NoteResult]:
+    """Code (name, bytes) notes in parallel, yielding each result as it finishes.
+
+    Extraction and Index matching (`code(text)`) run in `max_workers` forked
+    processes on Linux (threads elsewhere), so wall-clock time approaches
+    the sum of the notes divided by the workers rather than the plain sum. The optional
+    `rerank(text, suggestions)` (the Gemini round-trip, I/O-bound) runs on a
+    thread pool here as each note's matching finishes. Neither may touch
+    Streamlit. Each result carries its position in `files`.
+    """
+    matching, match = _match_pool(max_workers, code)
+    network = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pcs-rerank") if rerank else None
+    try:
+        matches = {matching.submit(match, name, data, i) for i, (name, data) in enumerate(files)}
+        pending = set(matches)
+        while pending:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                res = fut.result()
+                if fut in matches and network is not None and res.status == "done" and res.suggestions:
+                    pending.add(network.submit(_rerank, res, rerank))
+                    continue
+                res.text = ""  # only needed for the re-rank; don't keep every note around
+                yield res
+    finally:
+        matching.shutdown(cancel_futures=True)
+        if network is not None:
+            network.shutdown(cancel_futures=True)
+
+def make_coder(index_store, tables_engine, defs_store, key_maps=None, retriever: str = "fuzzy"):
+    # code(text) for code_notes: suggest_codes with a fresh per-note IncrementalAnalysis
+    from utils.coder import suggest_codes
+    if index_store:
+        # Build the lazily made search structures now, so forked workers share them instead of each building its own
+        index_store.tree.search_keys()
+        if retriever == "tfidf":
+            index_store.tree.retriever()
+
+    def code(text: str) -> List[Dict[str, Any]]:
+        return suggest_codes(text=text, index_store=index_store, tables_engine=tables_engine, defs_store=defs_store,
+                             key_maps=key_maps, analysis=IncrementalAnalysis(), retriever=retriever)
+    return code
+
+def result_rows(results: Sequence[NoteResult]) -> List[Dict[str, Any]]:
+    # One flat row per (note, code) for the combined table / CSV
+    rows = []
+    for r in results:
+        for s in r.suggestions:
+            rows.append({
+                "Note": r.name,
+                "Code": s.get("code"),
+                "Confidence": round(s.get("confidence", 0), 3),
+                "Validated": s.get("validated", False),
+                "Reason": s.get("why", ""),
+                "Evidence": "; ".join(s.get("evidence", [])[:3]),
+            })
+    return rows
+
+def results_json(results: Sequence[NoteResult]) -> str:
+    return json.dumps([{"note": r.name, "status": r.status, "error": r.error, "seconds": r.seconds,
+                        "suggestions": r.suggestions} for r in results], indent=2)
+
+def results_csv(results: Sequence[NoteResult]) -> str:
+    out = io.StringIO()
+    w = csv.DictWriter(out, fieldnames=["Note", "Code", "Confidence", "Validated", "Reason", "Evidence"])
+    w.writeheader()
+    w.writerows(result_rows(results))
+    return out.getvalue()
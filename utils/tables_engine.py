@@ -1,58 +1,52 @@
 
 from dataclasses import dataclass
-from typing import List, Optional, Dict
-from lxml import etree
+from typing import Callable, Collection, List, Optional, Dict
+import hashlib
 import re
 
+from pcs_tables_engine import TablesEngine as TablesTrieEngine
+
 VALID_CODE_RE = re.compile(r"^[0-9A-Z]{7}$")
+VERSION_RE = re.compile(rb"<version>\s*([^<]*?)\s*</version>")
 
 @dataclass
 class TablesEngine:
     has_tables: bool
     meta: Dict
+    core: Optional[TablesTrieEngine] = None  # the real Tables trie (pcs_tables_engine)
 
     @classmethod
     def none_engine(cls) -> "TablesEngine":
         return cls(has_tables=False, meta={})
 
     @classmethod
-    def from_bytes(cls, b: Optional[bytes]) -> "TablesEngine":
+    def from_bytes(cls, b: Optional[bytes], progress: Optional[Callable[..., None]] = None) -> "TablesEngine":
         if not b:
             return cls.none_engine()
         try:
-            # NOTE: Full PCS tables parsing is complex. This v1 stores the XML root and basic metadata.
-            root = etree.fromstring(b)
-            version = root.findtext("version") or "unknown"
-            return cls(has_tables=True, meta={"version": version})
+            core = TablesTrieEngine.from_bytes(b, progress=progress)
         except Exception:
             return cls.none_engine()
+        m = VERSION_RE.search(b[:4096])
+        meta = {"version": m.group(1).decode("utf-8", "ignore") if m else "unknown", **core.stats(),
+                "digest": hashlib.sha1(b).hexdigest()}
+        return cls(has_tables=core.stats()["codes"] > 0, meta=meta, core=core)
 
     def is_valid(self, code: str) -> bool:
-        # If we don't have the tables, only do a superficial validation.
         if not VALID_CODE_RE.match(code or ""):
             return False
         if not self.has_tables:
             # Can't verify against combinational rules; treat as "format valid, tables unknown".
             return False
-        # TODO: Implement full combinational validation from tables.
-        return False
+        return self.core.is_valid(code)
 
-    def expand_from_prefix(self, prefix: str) -> List[str]:
-        # Without full tables, we can't true-expand. Return common defaults when plausible.
-        # If prefix length is 3–4, we can try to finish with device 'Z' and qualifier 'Z' and approaches [0,3,X].
+    def expand_from_prefix(self, prefix: str, hints: Optional[Dict[int, Collection[str]]] = None, limit: int = 50) -> List[str]:
+        # Legal completions only. `hints` (axis pos -> preferred chars) prune the trie walk,
+        # so e.g. an approach hint never generates codes for other approaches that exist.
         prefix = (prefix or "").strip().upper()
-        results: List[str] = []
-        if len(prefix) == 3:
-            for body_part in "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789":
-                for approach in ["0","3","4","X"]:  # open, percutaneous, percutaneous endoscopic, external (best-effort)
-                    code = prefix + body_part + approach + "Z" + "Z"
-                    if VALID_CODE_RE.match(code):
-                        results.append(code)
-            return results[:200]  # cap
-        if len(prefix) == 4:
-            for approach in ["0","3","4","X"]:
-                code = prefix + approach + "Z" + "Z"
-                if VALID_CODE_RE.match(code):
-                    results.append(code)
-            return results
-        return []
+        if not self.has_tables or not prefix:
+            return []
+        return self.core.expand(prefix, limit=limit, constraints=hints)
+
+    def axis_labels(self, code: str) -> List[str]:
+        return self.core.axis_labels(code) if self.core else list(code)